@@ -36,9 +36,10 @@ CREATE TABLE IF NOT EXISTS kubedoor.k8s_res_control
     pod_qps_ai Float32 DEFAULT -1,
     pod_load_ai Float32 DEFAULT -1,
     pod_g1gc_qps_ai Float32 DEFAULT -1,
-    update_ai DateTime('Asia/Shanghai')
+    update_ai DateTime('Asia/Shanghai'),
+    ver DateTime64(6, 'Asia/Shanghai') MATERIALIZED now64(6) COMMENT '行版本,每次修改插入新版本,读取时用FINAL取最新版本'
 )
-ENGINE = MergeTree
+ENGINE = ReplacingMergeTree(ver)
 PRIMARY KEY (env,namespace,deployment)
 ORDER BY (env,namespace,deployment)
 SETTINGS index_granularity = 8192;
@@ -64,7 +65,7 @@ CREATE TABLE IF NOT EXISTS kubedoor.k8s_resources
     pod_jvm_max_mb Float32
 )
 ENGINE = MergeTree
-PARTITION BY toYYYYMM(date)
+PARTITION BY toYYYYMMDD(date)
 PRIMARY KEY (date,env,namespace,deployment)
 ORDER BY (date,env,namespace,deployment)
 TTL toDateTime(date) + toIntervalDay(365)
@@ -87,9 +88,10 @@ CREATE TABLE IF NOT EXISTS kubedoor.k8s_pod_alert_days
     `container` String,
     `pod` String,
     `description` String,
-    `operate` String
+    `operate` String,
+    `ver` DateTime64(6, 'Asia/Shanghai') MATERIALIZED now64(6) COMMENT '行版本,每次修改插入新版本,读取时用FINAL取最新版本'
 )
-ENGINE = MergeTree
+ENGINE = ReplacingMergeTree(ver)
 PARTITION BY toYYYYMMDD(start_time)
 PRIMARY KEY (start_time,
   fingerprint,
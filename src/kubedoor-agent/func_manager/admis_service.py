@@ -9,6 +9,7 @@ from kubernetes_asyncio.client.rest import ApiException
 from loguru import logger
 
 import utils
+from func_manager.ws_sender import PRIORITY_CONTROL
 
 
 class AdmisService:
@@ -89,7 +90,8 @@ class AdmisService:
         response_future = asyncio.get_event_loop().create_future()
         self.request_futures[uid] = response_future
         await self.ws_conn.send_json(
-            {"type": "admis", "request_id": uid, "namespace": namespace, "deployment": deployment_name}
+            {"type": "admis", "request_id": uid, "namespace": namespace, "deployment": deployment_name},
+            priority=PRIORITY_CONTROL,
         )
         try:
             result = await asyncio.wait_for(response_future, timeout=30)
@@ -13,6 +13,7 @@ from kubernetes_asyncio.client.rest import ApiException
 from loguru import logger
 from utils import PROM_K8S_TAG_VALUE, MSG_TOKEN
 from func_manager.event_monitor_config import *
+from func_manager.ws_sender import PRIORITY_BULK
 
 
 class K8sEventMonitor:
@@ -109,7 +110,7 @@ class K8sEventMonitor:
             # 构造WebSocket消息
             ws_message = {"type": "k8s_event", "data": event_data, "timestamp": datetime.now().isoformat()}
 
-            await self.ws_conn.send_json(ws_message)
+            await self.ws_conn.send_json(ws_message, priority=PRIORITY_BULK)
 
             # 更新统计信息
             self.event_count += 1
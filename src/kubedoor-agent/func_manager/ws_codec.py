@@ -0,0 +1,103 @@
+"""
+agent与master之间WebSocket消息的编解码
+
+连接时通过 /ws?codec=<name> 请求编码，name格式为 <base>[+deflate]:
+- base: json(文本帧) 或 msgpack(二进制帧，需要安装msgpack)
+- +deflate: 启用WebSocket permessage-deflate压缩
+master回复 {"type": "codec", "codec": "<协商结果>"} 之前一律发送json，
+因此连接不认识codec参数的旧master时保持原有协议。
+"""
+
+import json
+from aiohttp import WSMsgType
+from loguru import logger
+
+try:
+    import msgpack
+except ImportError:  # msgpack为可选依赖，缺失时只提供json
+    msgpack = None
+
+DEFAULT_CODEC = "json"
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, data):
+        return json.dumps(data)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True, default=str)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {"json": JsonCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def resolve_requested(requested):
+    """根据本地可用编码修正要请求的编码名，返回 (编码名, 是否启用deflate)"""
+    base, _, option = (requested or DEFAULT_CODEC).lower().partition("+")
+    if base not in CODECS:
+        logger.warning(f"本地不支持WebSocket编码 {base}，改用 {DEFAULT_CODEC}")
+        base = DEFAULT_CODEC
+    deflate = option == "deflate"
+    return (f"{base}+deflate" if deflate else base), deflate
+
+
+class CodecWebSocket:
+    """按协商编码收发消息的WebSocket包装，send_json/send_str与原WebSocket用法一致"""
+
+    def __init__(self, ws, requested):
+        self.ws = ws
+        # 二进制帧只会是master按本端请求的编码发来的
+        self.requested = CODECS[requested.partition("+")[0]]
+        # 收到master确认之前使用json
+        self.codec = CODECS[DEFAULT_CODEC]
+
+    def accept(self, codec_name):
+        """master确认编码后切换发送编码"""
+        codec = CODECS.get((codec_name or "").partition("+")[0])
+        if codec is None:
+            logger.warning(f"master确认了本地不支持的编码 {codec_name}，继续使用 {self.codec.name}")
+            return
+        self.codec = codec
+        logger.info(f"WebSocket消息编码已协商为 {codec_name}")
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    async def send_json(self, data):
+        payload = self.codec.encode(data)
+        if self.codec.binary:
+            await self.ws.send_bytes(payload)
+        else:
+            await self.ws.send_str(payload)
+
+    async def send_str(self, data):
+        await self.ws.send_str(data)
+
+    async def close(self, *args, **kwargs):
+        return await self.ws.close(*args, **kwargs)
+
+    def decode(self, msg):
+        """解码收到的消息帧，文本帧按JSON解析，二进制帧按请求的编码解析，解析失败抛出ValueError"""
+        if msg.type == WSMsgType.BINARY:
+            return self.requested.decode(msg.data)
+        return json.loads(msg.data)
+
+    def __aiter__(self):
+        return self.ws.__aiter__()
@@ -1,4 +1,4 @@
-import asyncio, utils, json, sys
+import asyncio, utils, json, sys, codecs
 from functools import partial
 from urllib.parse import urlencode
 from aiohttp import ClientSession, ClientWebSocketResponse, WSMsgType, web
@@ -22,6 +22,8 @@ from func_manager.event_monitor_config import *
 from func_manager.admis_service import AdmisService
 from scaler.balance_node_pod_service import BalanceNodeService
 from func_manager.mcp_service import MCPService
+from func_manager import ws_codec
+from func_manager import ws_sender
 from scaler.scale_service import ScaleService
 
 
@@ -107,16 +109,40 @@ async def handle_http_request(
     await ws.send_json({"type": "response", "request_id": request_id, "response": response_data})
 
 
+async def handle_stream_request(ws: ClientWebSocketResponse, request_id: str, query: dict, path: str):
+    """GET请求的响应体不做解析，按 response_chunk 分块原样发送给master"""
+    seq = 0
+    try:
+        async with ClientSession() as session:
+            logger.info(f"分块转发请求: GET {path}?{urlencode(query)}")
+            async with session.get(path, params=query, ssl=False) as resp:
+                # 分块边界可能切断多字节字符，增量解码
+                decoder = codecs.getincrementaldecoder('utf-8')('replace')
+                header = {"status": resp.status, "content_type": resp.content_type}
+                async for data in resp.content.iter_chunked(utils.RESPONSE_CHUNK_SIZE):
+                    chunk = {"type": "response_chunk", "request_id": request_id, "seq": seq, **header}
+                    await ws.send_json({**chunk, "data": decoder.decode(data), "last": False})
+                    header = {}
+                    seq += 1
+                chunk = {"type": "response_chunk", "request_id": request_id, "seq": seq, **header}
+                await ws.send_json({**chunk, "data": decoder.decode(b"", final=True), "last": True})
+    except Exception as e:
+        logger.error(f"分块转发请求失败: {path} {e}")
+        await ws.send_json({"type": "response_chunk", "request_id": request_id, "seq": seq, "error": str(e), "last": True})
+
+
 async def process_request(ws: ClientWebSocketResponse):
     """处理服务端发送的请求"""
     async for msg in ws:
-        if msg.type == WSMsgType.TEXT:
+        if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
             try:
-                data = json.loads(msg.data)
-            except json.JSONDecodeError:
+                data = ws.decode(msg)
+            except ValueError:
                 logger.error(f"收到无法解析的消息：{msg.data}")
                 continue
-            if data.get("type") == "admis":
+            if data.get("type") == "codec":
+                ws.accept(data.get("codec"))
+            elif data.get("type") == "admis":
                 request_id = data.get("request_id")
                 deploy_res = data.get("deploy_res")
                 logger.info(f"收到 admis 消息：{request_id} {deploy_res}")
@@ -133,7 +159,10 @@ async def process_request(ws: ClientWebSocketResponse):
                     if data["path"].startswith('/api/pod/')
                     else 'https://127.0.0.1' + data["path"]
                 )
-                asyncio.create_task(handle_http_request(ws, request_id, method, query, body, path))
+                if data.get("stream") and method == "GET":
+                    asyncio.create_task(handle_stream_request(ws, request_id, query, path))
+                else:
+                    asyncio.create_task(handle_http_request(ws, request_id, method, query, body, path))
             elif data.get("type") == "start_pod_logs":
                 # 开始Pod日志流
                 connection_id = data.get("connection_id")
@@ -158,12 +187,13 @@ async def heartbeat(ws: ClientWebSocketResponse):
     """定期发送心跳"""
     while True:
         try:
-            await ws.send_json({"type": "heartbeat"})
+            await ws.send_json({"type": "heartbeat"}, priority=ws_sender.PRIORITY_CONTROL)
             logger.debug("成功发送心跳")
             await asyncio.sleep(HEARTBEAT_INTERVAL)
         except Exception as e:
+            # 连接已断开，抛出异常让connect_to_server重新连接
             logger.error(f"心跳发送失败：{e}")
-            break
+            raise
 
 
 async def monitor_health_check():
@@ -197,6 +227,8 @@ async def monitor_health_check():
                 logger.debug(
                     f"📊 事件监控状态: 已处理 {event_monitor.event_count} 个事件, WebSocket健康: {event_monitor.is_websocket_healthy()}"
                 )
+                if ws_conn is not None:
+                    logger.debug(f"📊 WebSocket发送队列: {ws_conn.metrics()}")
                 last_check_time = current_time
 
         except Exception as e:
@@ -206,12 +238,18 @@ async def monitor_health_check():
 
 async def connect_to_server():
     """连接到 WebSocket 服务端，并处理连接断开的情况"""
-    uri = f"{utils.KUBEDOOR_MASTER}/ws?env={utils.PROM_K8S_TAG_VALUE}&ver={VERSION}"
+    codec_name, deflate = ws_codec.resolve_requested(utils.WS_CODEC)
+    # caps声明支持的协议扩展: stream=分块返回大响应
+    query = urlencode({"env": utils.PROM_K8S_TAG_VALUE, "ver": VERSION, "codec": codec_name, "caps": "stream"})
+    uri = f"{utils.KUBEDOOR_MASTER}/ws?{query}"
     while True:
         try:
             async with ClientSession() as session:
-                async with session.ws_connect(uri, ssl=False) as ws:
+                # compress=15 向master请求permessage-deflate，master未同意时自动不压缩
+                async with session.ws_connect(uri, ssl=False, compress=15 if deflate else 0) as raw_ws:
                     logger.info("成功连接到服务端")
+                    # 心跳、响应、事件、日志共用一个发送队列，按优先级发送
+                    ws = ws_sender.PrioritySender(ws_codec.CodecWebSocket(raw_ws, codec_name), "master")
                     global ws_conn
                     ws_conn = ws
                     if admis_service:
@@ -257,6 +295,8 @@ async def connect_to_server():
                         if admis_service:
                             admis_service.set_ws_conn(None)
                         raise task_e
+                    finally:
+                        await ws.stop()
 
         except Exception as e:
             logger.error(f"连接到服务端失败：{e}")
@@ -283,7 +323,7 @@ async def stream_pod_logs(
         logger.info(f"开始获取Pod日志: {namespace}/{pod_name}")
 
         # 发送连接成功消息
-        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "status": "connected"})
+        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "status": "connected"}, priority=ws_sender.PRIORITY_BULK)
 
         # 使用kubernetes_asyncio的日志流API
         log_stream = await core_v1.read_namespaced_pod_log(
@@ -315,14 +355,14 @@ async def stream_pod_logs(
 
     except asyncio.CancelledError:
         logger.info(f"Pod日志流被取消: {connection_id}")
-        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "status": "disconnected"})
+        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "status": "disconnected"}, priority=ws_sender.PRIORITY_BULK)
     except ApiException as e:
         error_msg = f"Kubernetes API错误: {e.status} - {e.reason}"
         logger.error(f"Pod日志流API异常: {connection_id}, 错误: {error_msg}")
-        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "error": error_msg})
+        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "error": error_msg}, priority=ws_sender.PRIORITY_BULK)
     except Exception as e:
         logger.error(f"Pod日志流异常: {connection_id}, 错误: {e}")
-        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "error": str(e)})
+        await ws.send_json({"type": "pod_logs", "connection_id": connection_id, "error": str(e)}, priority=ws_sender.PRIORITY_BULK)
     finally:
         # 清理任务
         if connection_id in pod_logs_tasks:
@@ -6,6 +6,7 @@ from datetime import datetime, UTC
 import pytz
 import logging
 import hashlib
+import threading
 
 logging.basicConfig(level=getattr(logging, utils.LOG_LEVEL), format='%(asctime)s - %(levelname)s - %(message)s')
 pool = ChPool(
@@ -18,6 +19,15 @@ pool = ChPool(
     connections_max=10,
 )
 
+# 同一指纹的告警串行处理: 追加新版本读取的是上一次写入的版本，并发的firing不会丢失count_firing的增量，
+# 也不会重复插入新记录；按指纹哈希分配固定数量的锁，内存有界(单进程部署)
+_alert_locks = [threading.Lock() for _ in range(64)]
+
+
+def alert_lock(fingerprint):
+    return _alert_locks[int(fingerprint[:8], 16) % len(_alert_locks)]
+
+
 MSG_TOKEN = utils.MSG_TOKEN
 MSG_TYPE = utils.MSG_TYPE
 DEFAULT_AT = utils.DEFAULT_AT
@@ -214,15 +224,31 @@ def process_single_alert(alert):
         }
         send_resolved = False if labels.get('send_resolved', True) == 'false' else True
 
-        if alert['status'] == 'firing':
-            handle_firing_alert(alert_data, send_resolved)
-        else:
-            handle_resolved_alert(alert_data, send_resolved)
+        with alert_lock(fingerprint):
+            if alert['status'] == 'firing':
+                handle_firing_alert(alert_data, send_resolved)
+            else:
+                handle_resolved_alert(alert_data, send_resolved)
 
     except Exception as e:
         logging.error(f"处理告警失败: {str(e)}", exc_info=True)
 
 
+def versioned_update(assignments):
+    """
+    k8s_pod_alert_days为ReplacingMergeTree(ver)，修改告警时插入替换了字段的新版本行，
+    不使用ALTER UPDATE(mutation会重写整个part)，条件参数为 day 和 fingerprint
+    """
+    replace = ", ".join(f"{expr} AS `{column}`" for column, expr in assignments.items())
+    return f"""
+        INSERT INTO kubedoor.k8s_pod_alert_days
+        SELECT * REPLACE ({replace})
+        FROM kubedoor.k8s_pod_alert_days FINAL
+        WHERE toDate(start_time) = %(day)s AND fingerprint = %(fingerprint)s
+        SETTINGS prefer_column_name_to_alias = 1
+    """
+
+
 def handle_firing_alert(alert_data, send_resolved):
     check_query = f"""
         SELECT 1 FROM kubedoor.k8s_pod_alert_days
@@ -237,16 +263,27 @@ def handle_firing_alert(alert_data, send_resolved):
     if existing:
         # 获取当前时间并格式化为字符串
         current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        update_query = f"""
-            ALTER TABLE kubedoor.k8s_pod_alert_days
-            UPDATE count_firing = count_firing + 1, end_time = '{current_time}', 
-            alert_status = 'firing', operate = '未处理', description = '{alert_data['description']}'
-            WHERE toDate(start_time) = '{alert_data['start_time'].split()[0]}' and 
-            fingerprint = '{alert_data['fingerprint']}'
-        """
+        # 追加新版本代替ALTER UPDATE，读取时用FINAL取最新版本
+        update_query = versioned_update(
+            {
+                "count_firing": "count_firing + 1",
+                "end_time": "toDateTime(%(end_time)s, 'Asia/Shanghai')",
+                "alert_status": "'firing'",
+                "operate": "'未处理'",
+                "description": "%(description)s",
+            }
+        )
 
         with pool.get_client() as client:
-            client.execute(update_query)
+            client.execute(
+                update_query,
+                {
+                    "day": alert_data['start_time'].split()[0],
+                    "fingerprint": alert_data['fingerprint'],
+                    "end_time": current_time,
+                    "description": alert_data['description'],
+                },
+            )
         logging.info(f"更新告警计数: {alert_data['fingerprint']}: {alert_data['alert_name']}")
     else:
         # 插入新记录
@@ -287,15 +324,24 @@ def handle_resolved_alert(alert_data, send_resolved):
         existing = client.execute(check_query)
 
     if existing:
-        update_query = f"""
-            ALTER TABLE kubedoor.k8s_pod_alert_days
-            UPDATE alert_status = 'resolved', end_time = '{alert_data['end_time']}', 
-            count_resolved = count_resolved + 1, description = '{alert_data['description']}'
-            WHERE toDate(start_time) = '{alert_data['start_time'].split()[0]}' AND 
-            fingerprint = '{alert_data['fingerprint']}'
-        """
+        update_query = versioned_update(
+            {
+                "alert_status": "'resolved'",
+                "end_time": "toDateTime(%(end_time)s, 'Asia/Shanghai')",
+                "count_resolved": "count_resolved + 1",
+                "description": "%(description)s",
+            }
+        )
         with pool.get_client() as client:
-            client.execute(update_query)
+            client.execute(
+                update_query,
+                {
+                    "day": alert_data['start_time'].split()[0],
+                    "fingerprint": alert_data['fingerprint'],
+                    "end_time": alert_data['end_time'],
+                    "description": alert_data['description'],
+                },
+            )
 
         logging.info(f"标记告警解决: {alert_data['fingerprint']}: {alert_data['alert_name']}")
         return True, ''
@@ -409,10 +455,11 @@ def handle_custom_alert():
         alert_status = data['alert_status']
 
         # 根据alert_status调用相应的处理函数
-        if alert_status == 'firing':
-            result, msg = handle_firing_alert(alert_data, send_resolved)
-        else:
-            result, msg = handle_resolved_alert(alert_data, send_resolved)
+        with alert_lock(fingerprint):
+            if alert_status == 'firing':
+                result, msg = handle_firing_alert(alert_data, send_resolved)
+            else:
+                result, msg = handle_resolved_alert(alert_data, send_resolved)
         if result:
             return jsonify({'status': 'success', 'message': '自定义告警处理完成'}), 200
         else:
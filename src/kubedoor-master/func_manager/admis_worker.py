@@ -0,0 +1,107 @@
+"""
+准入(admis)查询的异步处理
+
+agent的admis请求不在读取WebSocket的协程里直接查询ClickHouse，而是交给本模块:
+- 每个请求一个任务，查询使用独立的ClickHouse连接池(ADMIS_WORKERS个连接)，不与其它查询争用
+- 超过ADMIS_DEADLINE_SECONDS(需小于webhook的30秒超时)未完成时直接回复失败
+- ADMIS_BATCH_WINDOW秒内到达的请求合并为一次批量查询(批量扩缩容、重启时同时到达大量请求)，
+  最多ADMIS_BATCH_MAX个
+这样admis突发时心跳、事件等消息仍能及时处理。
+"""
+
+import asyncio
+import os
+from loguru import logger
+
+import utils
+from func_manager import ws_sender
+from func_manager.ck_async import ClickHousePool
+
+ADMIS_WORKERS = int(os.environ.get('ADMIS_WORKERS', '8'))
+ADMIS_DEADLINE_SECONDS = float(os.environ.get('ADMIS_DEADLINE_SECONDS', '20'))
+ADMIS_BATCH_WINDOW = float(os.environ.get('ADMIS_BATCH_WINDOW', '0.005'))
+ADMIS_BATCH_MAX = int(os.environ.get('ADMIS_BATCH_MAX', '200'))
+
+_pool = ClickHousePool(size=ADMIS_WORKERS, timeout=ADMIS_DEADLINE_SECONDS, name="admis", **utils.CK_CONNECTION)
+# 进行中的admis任务，防止任务对象被回收
+_tasks = set()
+# 等待合并查询的请求: { (env, namespace, deployment): Future }
+_pending = {}
+_flush_handle = None
+stats = {"total": 0, "timeout": 0, "inflight": 0, "batches": 0, "batched": 0}
+
+
+async def _query_batch(batch):
+    """批量查询一组准入请求，超过期限或出错时整批返回503"""
+    keys = list(batch)
+    stats["batches"] += 1
+    stats["batched"] += len(keys)
+    try:
+        results = await asyncio.wait_for(utils.get_deploy_admis_batch(keys, pool=_pool), ADMIS_DEADLINE_SECONDS)
+    except asyncio.TimeoutError:
+        stats["timeout"] += len(keys)
+        for env, namespace, deployment in keys:
+            content = f"master(admis)返回:【{env}】【{namespace}】【{deployment}】查询数据库超过 {ADMIS_DEADLINE_SECONDS} 秒"
+            logger.error(content)
+        results = {key: [503, '查询数据库超时'] for key in keys}
+    except Exception as e:
+        logger.error(f"master(admis)批量查询{len(keys)}个服务失败：{e}")
+        results = {key: [503, '查询数据库异常'] for key in keys}
+    for key, future in batch.items():
+        if not future.done():
+            future.set_result(results[key])
+
+
+def _flush():
+    global _flush_handle
+    if _flush_handle is not None:
+        _flush_handle.cancel()
+        _flush_handle = None
+    if not _pending:
+        return
+    batch = dict(_pending)
+    _pending.clear()
+    task = asyncio.create_task(_query_batch(batch))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+
+
+async def lookup(env, namespace, deployment):
+    """查询准入结果，同一时间窗口内的请求合并查询"""
+    global _flush_handle
+    key = (env, namespace, deployment)
+    future = _pending.get(key)
+    if future is None:
+        future = asyncio.get_running_loop().create_future()
+        _pending[key] = future
+    if len(_pending) >= ADMIS_BATCH_MAX:
+        _flush()
+    elif _flush_handle is None:
+        _flush_handle = asyncio.get_running_loop().call_later(ADMIS_BATCH_WINDOW, _flush)
+    # 同一服务的多个请求共用一个Future，shield避免其中一个被取消时影响其它请求
+    return await asyncio.shield(future)
+
+
+async def _handle(sender, env, request_id, namespace, deployment):
+    stats["inflight"] += 1
+    try:
+        deploy_res = await lookup(env, namespace, deployment)
+    finally:
+        stats["inflight"] -= 1
+    await sender.send_json(
+        {"type": "admis", "request_id": request_id, "deploy_res": deploy_res},
+        priority=ws_sender.PRIORITY_CONTROL,
+    )
+
+
+def submit(sender, env, request_id, namespace, deployment):
+    """后台处理admis请求，结果通过sender回复给agent，调用方不等待"""
+    stats["total"] += 1
+    task = asyncio.create_task(_handle(sender, env, request_id, namespace, deployment))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return task
+
+
+async def close():
+    await _pool.close()
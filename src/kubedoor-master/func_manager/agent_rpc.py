@@ -0,0 +1,144 @@
+import asyncio
+import json
+import uuid
+from loguru import logger
+
+# 等待agent响应的请求: { "request_id": {"env": "env", "conn": "连接ID", "path": "/api/xxx", "future": Future} }
+# 分块响应的请求用 "queue": Queue 代替 "future"
+# conn为发送请求时该env的连接ID，agent重连后旧连接断开只清理旧连接上的请求
+_pending_requests = {}
+
+# 按分块方式返回的接口，只对不带namespace的全集群查询分块
+STREAM_ROUTES = {"/api/agent/pods", "/api/nodes/list"}
+# agent在 /ws?caps= 中声明支持分块响应
+CAP_STREAM = "stream"
+
+DEFAULT_TIMEOUT_SECONDS = 120
+# 按接口配置等待agent响应的超时时间（秒），未配置的接口使用默认值
+ROUTE_TIMEOUT_SECONDS = {
+    "/api/agent/namespaces": 30,
+    "/api/agent/pods": 60,
+    "/api/agent/services": 30,
+    "/api/agent/ingresses": 30,
+    "/api/agent/configmaps": 30,
+    "/api/agent/statefulsets": 30,
+    "/api/agent/daemonsets": 30,
+    "/api/nodes/list": 60,
+    "/api/events": 60,
+}
+
+
+class AgentDisconnectedError(Exception):
+    """agent连接断开，等待中的请求不会再收到响应"""
+
+
+def new_request_id():
+    """生成不会冲突的请求ID"""
+    return uuid.uuid4().hex
+
+
+def new_conn_id():
+    """每个agent连接的ID，区分同一env先后建立的连接"""
+    return uuid.uuid4().hex
+
+
+def get_timeout(path):
+    return ROUTE_TIMEOUT_SECONDS.get(path, DEFAULT_TIMEOUT_SECONDS)
+
+
+def register(env, request_id, path="", conn=None):
+    """为请求注册Future，agent响应到达时由resolve完成"""
+    future = asyncio.get_running_loop().create_future()
+    _pending_requests[request_id] = {"env": env, "conn": conn, "path": path, "future": future}
+    return future
+
+
+def should_stream(path, query, caps):
+    return CAP_STREAM in caps and path in STREAM_ROUTES and not query.get("namespace")
+
+
+def register_stream(env, request_id, path="", conn=None):
+    """为分块响应的请求注册队列，agent的 response_chunk 由feed_chunk按顺序放入"""
+    queue = asyncio.Queue()
+    _pending_requests[request_id] = {"env": env, "conn": conn, "path": path, "queue": queue, "seq": 0}
+    return queue
+
+
+def feed_chunk(request_id, chunk):
+    """收到agent的分块时放入对应队列，序号不连续时以异常结束该请求"""
+    entry = _pending_requests.get(request_id)
+    if entry is None or "queue" not in entry:
+        logger.warning(f"收到无等待者的分块响应(可能已超时或前端已断开): request_id={request_id}")
+        return False
+    if chunk.get("seq") != entry["seq"]:
+        _pending_requests.pop(request_id)
+        entry["queue"].put_nowait(ValueError(f"分块序号错误: 期望 {entry['seq']}，收到 {chunk.get('seq')}"))
+        return False
+    entry["seq"] += 1
+    if chunk.get("last"):
+        _pending_requests.pop(request_id)
+    entry["queue"].put_nowait(chunk)
+    return True
+
+
+async def next_chunk(queue, path):
+    """等待下一个分块，两个分块之间超过接口超时时间抛出asyncio.TimeoutError"""
+    chunk = await asyncio.wait_for(queue.get(), timeout=get_timeout(path))
+    if isinstance(chunk, Exception):
+        raise chunk
+    return chunk
+
+
+def resolve(request_id, response):
+    """收到agent响应时完成对应的Future，返回是否有等待者"""
+    entry = _pending_requests.pop(request_id, None)
+    if entry is None:
+        logger.warning(f"收到无等待者的响应(可能已超时或前端已断开): request_id={request_id}")
+        return False
+    if "queue" in entry:
+        # agent未分块返回时，整个响应作为最后一个分块
+        data = json.dumps({"success": True, **response})
+        entry["queue"].put_nowait({"seq": entry["seq"], "data": data, "last": True})
+    elif not entry["future"].done():
+        entry["future"].set_result(response)
+    return True
+
+
+def discard(request_id):
+    """请求结束(超时、取消、完成)后清理，重复调用无副作用"""
+    entry = _pending_requests.pop(request_id, None)
+    if entry is not None and "future" in entry and not entry["future"].done():
+        entry["future"].cancel()
+
+
+def fail_env(env, conn=None):
+    """agent断开时让该env等待中的请求立即失败，指定conn时只处理该连接上发出的请求"""
+    request_ids = [
+        request_id
+        for request_id, entry in _pending_requests.items()
+        if entry["env"] == env and (conn is None or entry["conn"] == conn)
+    ]
+    for request_id in request_ids:
+        entry = _pending_requests.pop(request_id)
+        error = AgentDisconnectedError(f"agent {env} 连接已断开")
+        if "queue" in entry:
+            entry["queue"].put_nowait(error)
+        elif not entry["future"].done():
+            entry["future"].set_exception(error)
+    if request_ids:
+        logger.warning(f"agent {env} 断开，清理 {len(request_ids)} 个等待中的请求")
+    return len(request_ids)
+
+
+async def wait_response(request_id, future, path):
+    """等待agent响应，超时抛出asyncio.TimeoutError，调用方取消时清理等待项"""
+    try:
+        return await asyncio.wait_for(future, timeout=get_timeout(path))
+    finally:
+        discard(request_id)
+
+
+def pending_count(env=None):
+    if env is None:
+        return len(_pending_requests)
+    return sum(1 for entry in _pending_requests.values() if entry["env"] == env)
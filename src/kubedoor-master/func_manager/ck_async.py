@@ -0,0 +1,93 @@
+"""
+master访问ClickHouse的异步接口
+
+clickhouse_driver是同步库，ClickHousePool把查询放到专用线程池中执行:
+- 每个工作线程持有一个长连接(Client不是线程安全的)，线程数即连接数，连接不再每次查询后断开
+- 参数使用clickhouse_driver的 %(name)s 绑定，不拼接SQL
+- 每个查询有超时时间，同时通过max_execution_time让ClickHouse端终止超时查询
+"""
+
+import asyncio
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from clickhouse_driver import Client
+from loguru import logger
+
+from func_manager import query_cache
+
+CK_POOL_SIZE = int(os.environ.get('CK_POOL_SIZE', '8'))
+CK_QUERY_TIMEOUT = float(os.environ.get('CK_QUERY_TIMEOUT', '30'))
+# 超过该耗时的查询记录警告日志(秒)
+CK_SLOW_QUERY_SECONDS = float(os.environ.get('CK_SLOW_QUERY_SECONDS', '3'))
+
+
+class ClickHousePool:
+    """线程池 + 每线程一个clickhouse_driver连接，所有方法均为协程"""
+
+    def __init__(self, size=CK_POOL_SIZE, timeout=CK_QUERY_TIMEOUT, name="ck", **connection):
+        self.size = size
+        self.timeout = timeout
+        self.name = name
+        self.connection = connection
+        self._executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix=name)
+        self._local = threading.local()
+        self._clients = []
+        self._clients_lock = threading.Lock()
+        self.stats = {"queries": 0, "errors": 0, "timeouts": 0, "inflight": 0}
+
+    def _client(self):
+        client = getattr(self._local, "client", None)
+        if client is None:
+            client = Client(
+                **self.connection,
+                send_receive_timeout=int(self.timeout) + 5,
+                settings={"max_execution_time": int(self.timeout)},
+            )
+            self._local.client = client
+            with self._clients_lock:
+                self._clients.append(client)
+        return client
+
+    def _execute(self, query, params, kwargs):
+        return self._client().execute(query, params, **kwargs)
+
+    async def execute(self, query, params=None, timeout=None, **kwargs):
+        """
+        执行查询并返回结果行，INSERT时params为数据行列表(columnar=True时为列列表)
+        超时抛出asyncio.TimeoutError，其它错误原样抛出clickhouse_driver的异常
+        """
+        timeout = timeout or self.timeout
+        loop = asyncio.get_running_loop()
+        begin = time.perf_counter()
+        self.stats["queries"] += 1
+        self.stats["inflight"] += 1
+        try:
+            return await asyncio.wait_for(
+                loop.run_in_executor(self._executor, self._execute, query, params, kwargs), timeout
+            )
+        except asyncio.TimeoutError:
+            self.stats["timeouts"] += 1
+            logger.error(f"[{self.name}] ClickHouse查询超过 {timeout} 秒: {query[:200]}")
+            raise
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            self.stats["inflight"] -= 1
+            # 写入完成(或失败)后清理相关表的查询缓存
+            query_cache.invalidate_sql(query)
+            cost = time.perf_counter() - begin
+            if cost > CK_SLOW_QUERY_SECONDS:
+                logger.warning(f"[{self.name}] ClickHouse慢查询 {cost:.2f}s: {query[:200]}")
+
+    def metrics(self):
+        return {"size": self.size, "connections": len(self._clients), **self.stats}
+
+    async def close(self):
+        self._executor.shutdown(wait=False)
+        with self._clients_lock:
+            for client in self._clients:
+                client.disconnect()
+            self._clients.clear()
@@ -0,0 +1,178 @@
+"""
+/api/sql 查询结果的流式转发
+
+- 所有请求共用一个带连接池的aiohttp会话访问ClickHouse HTTP接口
+- ClickHouse返回一块就向前端写出一块，master不缓存完整结果
+- JSON/JSONCompact等单个对象格式的结果在开头插入 "success": true，与原来的响应格式一致；
+  前端通过 default_format 指定的其它格式(Native、ArrowStream、CSV等)原样转发
+- 前端断开连接或结果超过SQL_RESULT_MAX_BYTES时用KILL QUERY终止ClickHouse上的查询
+- 可缓存的SELECT结果写入query_cache，INSERT完成后清理涉及表的缓存
+"""
+
+import asyncio
+import json
+import os
+import uuid
+import aiohttp
+from aiohttp import web
+from loguru import logger
+
+import utils
+from func_manager import query_cache
+from func_manager import versioned_tables
+
+SQL_RESULT_MAX_BYTES = int(os.environ.get('SQL_RESULT_MAX_BYTES', str(512 * 1024 * 1024)))
+SQL_STREAM_CHUNK_SIZE = 64 * 1024
+SQL_HTTP_POOL_SIZE = int(os.environ.get('SQL_HTTP_POOL_SIZE', '20'))
+DEFAULT_FORMAT = "JSONCompact"
+# 输出为单个JSON对象的格式，转发时在对象开头插入success字段
+JSON_OBJECT_FORMATS = {"JSON", "JSONCompact", "JSONStrings", "JSONCompactStrings"}
+# 非JSON结果(INSERT的空响应、错误信息等)按原格式包装时最多读取的字节数
+MAX_TEXT_BYTES = 1024 * 1024
+
+# 后台执行的KILL QUERY任务，防止任务对象被回收
+_kill_tasks = set()
+
+
+class ResultTooLargeError(Exception):
+    """查询结果超过SQL_RESULT_MAX_BYTES"""
+
+
+class StreamAbortedError(Exception):
+    """响应头已发出后转发失败，调用方不能再返回其它响应，只能中断连接"""
+
+
+def create_session():
+    """创建访问ClickHouse的共享会话，程序退出时关闭"""
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=SQL_HTTP_POOL_SIZE),
+        timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+    )
+
+
+async def kill_query(query_id):
+    try:
+        await utils.ck.execute("KILL QUERY WHERE query_id = %(query_id)s ASYNC", {"query_id": query_id})
+        logger.warning(f"📐已终止ClickHouse查询 {query_id}")
+    except Exception as e:
+        logger.error(f"📐终止ClickHouse查询 {query_id} 失败: {e}")
+
+
+async def _write_json_object(write, chunks):
+    """把 { ... } 改写为 {"success": true, ... } 写出"""
+    async for chunk in chunks:
+        head = chunk.lstrip()
+        if not head:
+            continue
+        if head[:1] == b"{":
+            await write(b'{"success": true,' + head[1:])
+        else:
+            await write(head)
+        break
+    async for chunk in chunks:
+        await write(chunk)
+
+
+async def forward(request, session, sql, authorization):
+    """执行SQL并把结果流式写给前端"""
+    output_format = request.query.get("default_format", DEFAULT_FORMAT)
+    query_id = f"kubedoor-{uuid.uuid4().hex}"
+    params = {
+        "add_http_cors_header": "1",
+        "default_format": output_format,
+        "query_id": query_id,
+        # 前端断开后ClickHouse端也取消只读查询
+        "cancel_http_readonly_queries_on_client_close": "1",
+    }
+    if sql.strip().lower().startswith('select') and versioned_tables.references_versioned(sql):
+        # 版本表只返回每行的最新版本，k8s_events等普通表不需要FINAL
+        params["final"] = "1"
+    headers = {
+        'Authorization': authorization,
+        'Cache-Control': 'no-cache',
+        'Pragma': 'no-cache',
+        'Content-Type': 'text/plain',
+    }
+    url = f'http://{utils.CK_HOST}:{utils.CK_HTTP_PORT}/'
+
+    lookup = query_cache.make_key(sql, fmt=output_format)
+    if lookup:
+        cached = query_cache.get(lookup)
+        if cached is not None:
+            logger.info(f"♻SQL: 从缓存中获取 {len(cached['body'])} 字节")
+            return web.Response(body=cached["body"], content_type=cached["content_type"], charset=cached["charset"])
+
+    resp = None
+    size = 0
+    finished = False
+    try:
+        async with session.post(url, params=params, data=sql.encode("utf-8"), headers=headers) as ck_resp:
+            ck_format = ck_resp.headers.get("X-ClickHouse-Format", output_format)
+            if ck_resp.status != 200 or (ck_format not in JSON_OBJECT_FORMATS and output_format in JSON_OBJECT_FORMATS):
+                # 错误信息和INSERT等非JSON结果按原来的方式包装
+                text = (await ck_resp.content.read(MAX_TEXT_BYTES)).decode("utf-8", errors="replace")
+                finished = True
+                if ck_resp.content_type == 'application/json':
+                    return web.json_response({"success": True, **json.loads(text)})
+                return web.json_response({"success": True, "msg": text})
+
+            resp = web.StreamResponse(status=200)
+            resp.content_type = ck_resp.content_type
+            if ck_resp.charset:
+                resp.charset = ck_resp.charset
+            await resp.prepare(request)
+
+            async def chunks():
+                nonlocal size
+                async for chunk in ck_resp.content.iter_chunked(SQL_STREAM_CHUNK_SIZE):
+                    size += len(chunk)
+                    if size > SQL_RESULT_MAX_BYTES:
+                        raise ResultTooLargeError(f"查询结果超过 {SQL_RESULT_MAX_BYTES} 字节")
+                    yield chunk
+
+            # 不超过缓存上限的结果同时保存一份用于缓存
+            body = [] if lookup else None
+
+            async def write(data):
+                nonlocal body
+                if body is not None:
+                    body.append(data)
+                    if size > query_cache.MAX_ENTRY_BYTES:
+                        body = None
+                await resp.write(data)
+
+            if ck_format in JSON_OBJECT_FORMATS:
+                await _write_json_object(write, chunks())
+            else:
+                async for chunk in chunks():
+                    await write(chunk)
+            await resp.write_eof()
+            finished = True
+            if body is not None:
+                query_cache.put(
+                    lookup,
+                    {"body": b"".join(body), "content_type": resp.content_type, "charset": resp.charset},
+                    size,
+                )
+            logger.info(f"📐SQL: 数据查询完成，{ck_format} {size} 字节")
+            return resp
+    except ResultTooLargeError as e:
+        logger.error(f"📐{e}，终止查询 {query_id}")
+        if resp is None:
+            return web.json_response({"error": str(e)}, status=413)
+        raise StreamAbortedError(str(e)) from e
+    except asyncio.CancelledError:
+        logger.warning(f"📐请求已取消，终止查询 {query_id}")
+        raise
+    except (ConnectionResetError, aiohttp.ClientError) as e:
+        if resp is None:
+            raise
+        logger.warning(f"📐转发查询结果中断，终止查询 {query_id}: {e!r}")
+        raise StreamAbortedError(repr(e)) from e
+    finally:
+        query_cache.invalidate_sql(sql)
+        if not finished:
+            # KILL QUERY不能在已取消的任务中等待，放到后台执行
+            task = asyncio.ensure_future(kill_query(query_id))
+            _kill_tasks.add(task)
+            task.add_done_callback(_kill_tasks.discard)
@@ -13,6 +13,7 @@ from aiohttp import web
 from loguru import logger
 
 from k8s_event import get_clickhouse_client
+from func_manager import query_cache
 
 
 def _serialize_value(value: Any) -> Any:
@@ -32,9 +33,17 @@ def _rows_to_dicts(rows: Sequence[Sequence[Any]], columns: Sequence[str]) -> Lis
 
 
 async def _run_query(sql: str, params: List[Any]) -> List[Sequence[Any]]:
+    lookup = query_cache.make_key(sql, params)
+    if lookup:
+        rows = query_cache.get(lookup)
+        if rows is not None:
+            return rows
     client = get_clickhouse_client()
     loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(None, lambda: client.pool.execute_query(sql, params or None))
+    rows = await loop.run_in_executor(None, lambda: client.pool.execute_query(sql, params or None))
+    if lookup:
+        query_cache.put(lookup, rows)
+    return rows
 
 
 def _build_exception_events_sql(env: str | None) -> tuple[str, List[Any], List[str]]:
@@ -122,8 +131,8 @@ def _build_pod_alerts_sql(env: str | None) -> tuple[str, List[Any], List[str]]:
             pod,
             description,
             count_firing
-        FROM kubedoor.k8s_pod_alert_days
-        PREWHERE
+        FROM kubedoor.k8s_pod_alert_days FINAL
+        WHERE
             (
                 toDate(end_time) = today()
                 OR toDate(start_time) = today()
@@ -164,7 +173,7 @@ def _build_alert_daily_sql(env: str | None) -> tuple[str, List[Any], List[str]]:
             end
         ) AS day_label,
         sum(count_firing) AS daily_alert_count
-    FROM kubedoor.k8s_pod_alert_days
+    FROM kubedoor.k8s_pod_alert_days FINAL
     PREWHERE
         toDate(start_time) >= today() - 9
         AND toDate(start_time) <= today()
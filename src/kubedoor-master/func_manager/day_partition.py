@@ -0,0 +1,118 @@
+"""
+按天分区的高峰期数据重新写入
+
+k8s_resources 按 toYYYYMMDD(date) 分区，一个分区包含同一天所有env的数据。
+重新采集某个env某一天的数据时不再 delete(mutation) 后插入，而是:
+1. 清空暂存表 k8s_resources_staging 中该天的分区
+2. 把新采集的数据(列式INSERT)和该天其它env(或其它时间)的数据写入暂存表，只读取一个分区
+3. ALTER TABLE ... REPLACE PARTITION ... FROM 原子替换正式表中的该天分区
+期间查询看到的始终是完整的一天数据。
+
+替换本身只修改元数据，但第2步每次都要复制该天其它env的全部数据，代价与当天的总行数成正比。
+因此同一天的多个env合并写入: 等待该天的锁期间到达的其它env的数据，由拿到锁的一方一起写入暂存表并只替换一次，
+peak_scheduler并发采集多个K8S时，同时完成的env只复制一次其它数据。
+同一天的替换通过 session_registry 的锁在所有master副本之间串行执行(多副本共享暂存表，
+且后执行的REPLACE PARTITION会覆盖先执行的结果)。
+"""
+
+import asyncio
+from loguru import logger
+
+import utils
+from func_manager import session_registry
+
+TABLE = "kubedoor.k8s_resources"
+STAGING_TABLE = "kubedoor.k8s_resources_staging"
+INSERT_BATCH_SIZE = 10000
+
+# 等待写入的数据: { 分区: [(date, env, columns, Future), ...] }
+_pending = {}
+_staging_ready = False
+
+
+def partition_of(date):
+    """date所在分区，与 toYYYYMMDD(date) 一致"""
+    return int(date.strftime("%Y%m%d"))
+
+
+async def day_data_count(date, env):
+    """该env在date的数据行数，只按分区键和主键过滤"""
+    rows = await utils.ck.execute(
+        f"SELECT count() FROM {TABLE} WHERE toYYYYMMDD(date) = %(partition)s AND date = %(date)s AND env = %(env)s",
+        {"partition": partition_of(date), "date": date, "env": env},
+    )
+    return rows[0][0] if rows else 0
+
+
+async def _ensure_staging():
+    global _staging_ready
+    if not _staging_ready:
+        # 结构、分区与正式表相同，REPLACE PARTITION要求两表一致
+        await utils.ck.execute(f"CREATE TABLE IF NOT EXISTS {STAGING_TABLE} AS {TABLE}")
+        _staging_ready = True
+
+
+async def _replace_partition(partition, batch):
+    """把batch中各env的新数据和该天其余数据写入暂存表，替换正式表的分区"""
+    await _ensure_staging()
+    params = {"partition": partition, "keys": utils._in_values((date, env) for date, env, _, _ in batch)}
+    for date, env, _, _ in batch:
+        existing = await day_data_count(date, env)
+        if existing:
+            logger.info(f"表k8s_resources已有{env} {date}的数据{existing}条，替换分区{partition}")
+    await utils.ck.execute(f"ALTER TABLE {STAGING_TABLE} DROP PARTITION %(partition)s", params)
+    try:
+        for _, _, columns, _ in batch:
+            for i in range(0, len(columns[0]), INSERT_BATCH_SIZE):
+                await utils.ck.execute(
+                    f"INSERT INTO {STAGING_TABLE} VALUES",
+                    [column[i : i + INSERT_BATCH_SIZE] for column in columns],
+                    columnar=True,
+                )
+        await utils.ck.execute(
+            f"INSERT INTO {STAGING_TABLE} SELECT * FROM {TABLE} "
+            "WHERE toYYYYMMDD(date) = %(partition)s AND (date, env) NOT IN %(keys)s",
+            params,
+        )
+        await utils.ck.execute(f"ALTER TABLE {TABLE} REPLACE PARTITION %(partition)s FROM {STAGING_TABLE}", params)
+    finally:
+        await utils.ck.execute(f"ALTER TABLE {STAGING_TABLE} DROP PARTITION %(partition)s", params)
+
+
+async def reload_day(date, env, columns):
+    """
+    用columns替换env在date的高峰期数据，与同一天同时等待写入的其它env合并为一次分区替换
+
+    Args:
+        date: 高峰期结束时间，即k8s_resources的date字段
+        env: K8S名称
+        columns: 新采集的数据，按k8s_resources字段顺序的列，如PeakColumns.columns()
+
+    Returns:
+        True 已替换；False columns为空，未修改该env已有的数据
+    """
+    if not columns or not len(columns[0]):
+        # Prometheus无数据或超时，保留该env已有的数据，不参与分区替换
+        logger.warning(f"{env} {date}未采集到高峰期数据，保留已有数据，不替换分区")
+        return False
+    partition = partition_of(date)
+    future = asyncio.get_running_loop().create_future()
+    _pending.setdefault(partition, []).append((date, env, columns, future))
+    async with session_registry.registry.lock(f"k8s_resources:{partition}"):
+        # 等待锁期间已被其它调用合并写入时直接返回结果
+        if not future.done():
+            batch = _pending.pop(partition)
+            try:
+                await _replace_partition(partition, batch)
+            except Exception as e:
+                for *_, waiter in batch:
+                    if not waiter.done():
+                        waiter.set_exception(e)
+            else:
+                for *_, waiter in batch:
+                    if not waiter.done():
+                        waiter.set_result(True)
+                envs = ", ".join(sorted({env for _, env, _, _ in batch}))
+                total = sum(len(columns[0]) for _, _, columns, _ in batch)
+                logger.info(f"🌊高峰期数据写入CK: {envs} 共{total}条，已替换分区{partition}")
+    return await future
@@ -0,0 +1,170 @@
+"""
+高峰期指标的列式合并
+
+merged_dict 查询的pod_num和各项指标都是Prometheus即时向量，按 (K8S, 命名空间, ReplicaSet) 合并为k8s_resources的一行。
+原实现为每个序列拼接字符串键、构造嵌套dict和行列表；这里改为:
+- pod_num的结果建立一次键到行号的索引，维度列和pod数直接生成列
+- 每项指标按索引把值写入预先填充为-1的array('d')列，一个序列只做一次字典查找
+- 结果按k8s_resources的字段顺序输出为列，直接用于clickhouse_driver的列式INSERT(columnar=True)
+
+python3 -m func_manager.peak_columns 运行5万序列的合并耗时和内存对比
+"""
+
+from array import array
+from datetime import datetime
+
+# k8s_resources的字段，顺序与建表语句一致
+COLUMNS = (
+    "date",
+    "env",
+    "namespace",
+    "deployment",
+    "pod_count",
+    "p95_pod_load",
+    "p95_pod_cpu_pct",
+    "p95_pod_wss_mb",
+    "p95_pod_wss_pct",
+    "limit_pod_cpu_m",
+    "limit_pod_mem_mb",
+    "request_pod_cpu_m",
+    "request_pod_mem_mb",
+    "p95_pod_qps",
+    "p95_pod_g1gc_qps",
+    "pod_jvm_max_mb",
+)
+# 不从Prometheus采集、固定为-1的字段数
+UNCOLLECTED_COLUMNS = 3
+
+
+class PeakColumns:
+    """一个K8S一天的高峰期数据，按列保存"""
+
+    def __init__(self, env_key, pod_num_result):
+        self.env_key = env_key
+        # (K8S, 命名空间, ReplicaSet) -> 行号
+        self.index = {}
+        self.date, self.env, self.namespace, self.deployment = [], [], [], []
+        self.pod_count = array('i')
+        self.metrics = []
+        timestamps = {}
+        dimension_columns = self._dimension_columns()
+        for x in pod_num_result:
+            metric = x['metric']
+            key = (metric[env_key], metric.get('namespace'), metric.get('owner_name'))
+            ts, value = x['value']
+            # 即时查询所有序列的时间戳相同，只转换一次
+            endtime = timestamps.get(ts)
+            if endtime is None:
+                endtime = timestamps[ts] = datetime.fromtimestamp(int(ts))
+            row = [endtime, key[0], key[1], metric.get('workload'), int(value)]
+            i = self.index.get(key)
+            if i is None:
+                self.index[key] = len(self.env)
+                for column, item in zip(dimension_columns, row):
+                    column.append(item)
+            else:
+                # 重复的序列以最后一个为准
+                for column, item in zip(dimension_columns, row):
+                    column[i] = item
+
+    def _dimension_columns(self):
+        return self.date, self.env, self.namespace, self.deployment, self.pod_count
+
+    def __len__(self):
+        return len(self.env)
+
+    def join(self, result):
+        """按键合并一项指标，没有数据的行为-1，返回该指标匹配的序列数"""
+        column = array('d', [-1.0]) * len(self)
+        index = self.index
+        env_key = self.env_key
+        matched = 0
+        for x in result:
+            metric = x['metric']
+            i = index.get((metric[env_key], metric.get('namespace'), metric.get('owner_name')))
+            if i is not None:
+                column[i] = float(x['value'][1])
+                matched += 1
+        self.metrics.append(column)
+        return matched
+
+    def columns(self):
+        """按k8s_resources字段顺序的列"""
+        fixed = [array('d', [-1.0]) * len(self) for _ in range(UNCOLLECTED_COLUMNS)]
+        return [*self._dimension_columns(), *self.metrics, *fixed]
+
+    def rows(self):
+        """按行输出，兼容按行处理的调用方"""
+        return [list(row) for row in zip(*self.columns())]
+
+
+def _synthetic_vector(series, env_key, with_workload=False, seed=0):
+    result = []
+    for i in range(series):
+        metric = {env_key: "bench", "namespace": f"ns-{i % 200}", "owner_name": f"svc-{i}-6d8f9c7b5"}
+        if with_workload:
+            # pod_num，值为pod数
+            metric["workload"] = f"svc-{i}"
+            value = str(i % 10 + 1)
+        else:
+            value = str((i * 7 + seed) % 1000 / 10)
+        result.append({"metric": metric, "value": [1700000000, value]})
+    return result
+
+
+def _benchmark(series=50000, metrics=8):
+    """对比原来的字符串键+行列表与列式合并的耗时和内存"""
+    import time
+    import tracemalloc
+
+    env_key = "k8s"
+    pod_num = _synthetic_vector(series, env_key, with_workload=True)
+    # 每项指标缺少约1%的序列，顺序与pod_num不同
+    metric_results = [list(reversed(_synthetic_vector(series - series // 100, env_key, seed=m))) for m in range(metrics)]
+
+    def dict_join():
+        workload_dict = {}
+        for x in pod_num:
+            k8s = x['metric'][env_key]
+            ns = x['metric'].get('namespace')
+            replicaset = x['metric'].get('owner_name')
+            endtime = datetime.fromtimestamp(int(x["value"][0]))
+            workload_dict[f'{k8s}@{ns}@{replicaset}'] = [endtime, k8s, ns, x['metric'].get('workload'), int(x['value'][1])]
+        for result in metric_results:
+            workload_metrics_dict = {}
+            for x in result:
+                k8s = x['metric'][env_key]
+                ns = x['metric'].get('namespace')
+                replicaset = x['metric'].get('owner_name')
+                workload_metrics_dict[f'{k8s}@{ns}@{replicaset}'] = float(x['value'][1])
+            for k in workload_dict.keys():
+                if k in workload_metrics_dict:
+                    workload_dict[k].append(workload_metrics_dict[k])
+                else:
+                    workload_dict[k].append(-1)
+        return [v + [-1, -1, -1] for v in workload_dict.values()]
+
+    def columnar_join():
+        data = PeakColumns(env_key, pod_num)
+        for result in metric_results:
+            data.join(result)
+        return data.columns()
+
+    outputs = {}
+    for name, func in (("字符串键+行列表", dict_join), ("列式合并", columnar_join)):
+        begin = time.perf_counter()
+        outputs[name] = func()
+        cost = time.perf_counter() - begin
+        # tracemalloc会明显拖慢执行，内存单独再执行一次统计
+        tracemalloc.start()
+        func()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        print(f"{name:10} {series}序列 x {metrics + 1}项指标: 耗时 {cost * 1000:.0f}ms, 内存峰值 {peak / 1024 / 1024:.1f}MB")
+    rows = outputs["字符串键+行列表"]
+    columns = outputs["列式合并"]
+    assert [list(row) for row in zip(*columns)] == rows, "两种合并结果不一致"
+
+
+if __name__ == "__main__":
+    _benchmark()
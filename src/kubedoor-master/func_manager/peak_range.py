@@ -0,0 +1,288 @@
+"""
+高峰期指标的区间查询计算(PEAK_BACKEND=range)
+
+promql.query_dict 中的高峰期指标形如 quantile_over_time(0.80, 内层表达式[1h30m:]) * 系数，
+Prometheus/VictoriaMetrics需要在一次查询中对整个高峰期的每个步长计算内层表达式并保存所有点，
+是共享TSDB上最重的一类查询，集群较大时经常超时。这里改为:
+- 内层表达式用 query_range 按PEAK_RANGE_CHUNK_SECONDS分段查询，单次查询的时间范围和内存都是有界的
+- 每个序列的点流式累加到本地的统计量中: min/max直接比较；分位数在点数不超过PEAK_RANGE_EXACT_POINTS时
+  保存所有点精确计算(默认1.5小时高峰期、15秒步长为360个点，与PromQL结果一致)，超过后转为P²算法估计，
+  每个序列只保存5个标记点，内存有界
+- 取点的时间与子查询一致(高峰期结束时间往前、按步长对齐)，最后乘以表达式中的系数，
+  结果与即时查询的向量格式相同，后续的合并和写入k8s_resources不变
+
+只用于utils.get_prom_data中query_dict的高峰期指标。promql.deployment_node/deployment_image
+是按单个服务过滤的即时查询(没有高峰期子查询)，仍由prom_client直接查询，不受PEAK_BACKEND影响。
+
+python3 -m func_manager.peak_range 对比P²与精确分位数的误差；
+tests/test_peak_range.py 用模拟Prometheus验证两种计算方式结果一致
+"""
+
+import math
+import os
+import re
+from array import array
+from loguru import logger
+
+from func_manager import prom_client
+
+PEAK_RANGE_STEP = int(os.environ.get('PEAK_RANGE_STEP', '15'))
+PEAK_RANGE_CHUNK_SECONDS = int(os.environ.get('PEAK_RANGE_CHUNK_SECONDS', '900'))
+# 每个序列精确计算分位数时最多保存的点数，P²初始化至少需要20个点
+PEAK_RANGE_EXACT_POINTS = max(int(os.environ.get('PEAK_RANGE_EXACT_POINTS', '480')), 20)
+
+_OVER_TIME_RE = re.compile(
+    r"^\s*(?P<func>quantile|max|min)_over_time\(\s*(?:(?P<q>[0-9.]+)\s*,)?\s*(?P<inner>.*)"
+    r"\[(?P<range>[0-9smhdw]+):\]\s*\)\s*(?P<scale>(?:[*/]\s*[0-9.]+\s*)*)$",
+    re.DOTALL,
+)
+_DURATION_RE = re.compile(r"(\d+)([smhdw])")
+_DURATION_UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+
+
+def parse_duration(text):
+    """1h30m 等PromQL时长的秒数"""
+    return sum(int(n) * _DURATION_UNITS[unit] for n, unit in _DURATION_RE.findall(text))
+
+
+def parse_over_time(query):
+    """
+    拆分 func_over_time([q,] 内层[时长:]) 系数 形式的查询
+
+    Returns:
+        (func, q, 内层表达式, 时长秒数, 系数)，不是该形式时返回None
+    """
+    match = _OVER_TIME_RE.match(query)
+    if not match:
+        return None
+    scale = 1.0
+    for op, number in re.findall(r"([*/])\s*([0-9.]+)", match.group("scale")):
+        scale = scale * float(number) if op == "*" else scale / float(number)
+    q = float(match.group("q")) if match.group("q") else None
+    return match.group("func"), q, match.group("inner").strip(), parse_duration(match.group("range")), scale
+
+
+def quantile(values, q):
+    """与PromQL quantile_over_time一致的精确分位数(线性插值)"""
+    values = sorted(values)
+    rank = q * (len(values) - 1)
+    lower = math.floor(rank)
+    upper = min(lower + 1, len(values) - 1)
+    weight = rank - lower
+    return values[lower] * (1 - weight) + values[upper] * weight
+
+
+class P2Quantile:
+    """P²算法的流式分位数估计，不超过5个点时返回精确值"""
+
+    __slots__ = ("p", "n", "heights", "positions", "desired", "increments")
+
+    def __init__(self, p):
+        self.p = p
+        self.n = 0
+        self.heights = []
+        self.positions = [1, 2, 3, 4, 5]
+        self.desired = [1, 1 + 2 * p, 1 + 4 * p, 3 + 2 * p, 5]
+        self.increments = [0, p / 2, p, (1 + p) / 2, 1]
+
+    @classmethod
+    def from_values(cls, p, values):
+        """用已有的点初始化，标记点取这些点的精确分位数"""
+        sketch = cls(p)
+        values = sorted(values)
+        n = len(values)
+        sketch.n = n
+        sketch.desired = [1 + (n - 1) * f for f in sketch.increments]
+        sketch.positions = [round(d) for d in sketch.desired]
+        sketch.heights = [values[i - 1] for i in sketch.positions]
+        return sketch
+
+    def add(self, x):
+        self.n += 1
+        heights = self.heights
+        if self.n <= 5:
+            heights.append(x)
+            if self.n == 5:
+                heights.sort()
+            return
+        if x < heights[0]:
+            heights[0] = x
+            k = 0
+        elif x >= heights[4]:
+            heights[4] = x
+            k = 3
+        else:
+            k = 0
+            while x >= heights[k + 1]:
+                k += 1
+        positions = self.positions
+        for i in range(k + 1, 5):
+            positions[i] += 1
+        for i in range(5):
+            self.desired[i] += self.increments[i]
+        for i in (1, 2, 3):
+            d = self.desired[i] - positions[i]
+            if (d >= 1 and positions[i + 1] - positions[i] > 1) or (d <= -1 and positions[i - 1] - positions[i] < -1):
+                d = 1 if d > 0 else -1
+                height = self._parabolic(i, d)
+                if not heights[i - 1] < height < heights[i + 1]:
+                    height = heights[i] + d * (heights[i + d] - heights[i]) / (positions[i + d] - positions[i])
+                heights[i] = height
+                positions[i] += d
+
+    def _parabolic(self, i, d):
+        q, n = self.heights, self.positions
+        return q[i] + d / (n[i + 1] - n[i - 1]) * (
+            (n[i] - n[i - 1] + d) * (q[i + 1] - q[i]) / (n[i + 1] - n[i])
+            + (n[i + 1] - n[i] - d) * (q[i] - q[i - 1]) / (n[i] - n[i - 1])
+        )
+
+    def value(self):
+        if self.n == 0:
+            return math.nan
+        if self.n <= 5:
+            return quantile(self.heights, self.p)
+        return self.heights[2]
+
+
+class StreamingQuantile:
+    """不超过PEAK_RANGE_EXACT_POINTS个点时精确计算，超过后转为P²估计"""
+
+    __slots__ = ("p", "values", "sketch")
+
+    def __init__(self, p):
+        self.p = p
+        self.values = array('d')
+        self.sketch = None
+
+    def add(self, x):
+        if self.sketch is not None:
+            self.sketch.add(x)
+            return
+        self.values.append(x)
+        if len(self.values) > PEAK_RANGE_EXACT_POINTS:
+            self.sketch = P2Quantile.from_values(self.p, self.values)
+            self.values = None
+
+    def value(self):
+        if self.sketch is not None:
+            return self.sketch.value()
+        return quantile(self.values, self.p) if self.values else math.nan
+
+
+class _Min:
+    __slots__ = ("v",)
+
+    def __init__(self):
+        self.v = math.inf
+
+    def add(self, x):
+        if x < self.v:
+            self.v = x
+
+    def value(self):
+        return self.v
+
+
+class _Max(_Min):
+    __slots__ = ()
+
+    def __init__(self):
+        self.v = -math.inf
+
+    def add(self, x):
+        if x > self.v:
+            self.v = x
+
+
+def format_value(value):
+    """与Prometheus返回的格式一致，整数不带小数部分(如pod数)"""
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+def _reducer(func, q):
+    if func == "quantile":
+        return StreamingQuantile(q)
+    return _Min() if func == "min" else _Max()
+
+
+def eval_times(end, duration, step=PEAK_RANGE_STEP):
+    """子查询 [duration:step] 在end时的取点范围: (end-duration, end] 内step的整数倍"""
+    start = (math.floor((end - duration) / step) + 1) * step
+    return start, math.floor(end / step) * step
+
+
+async def query(range_url, promql, end, name=None):
+    """
+    用分段的区间查询计算 func_over_time(...[时长:]) 形式的高峰期指标
+
+    Args:
+        range_url: query_range接口地址
+        promql: 完整的查询语句，与即时查询相同
+        end: 高峰期结束时间的时间戳
+    Returns:
+        与即时查询相同格式的向量 [{"metric": {...}, "value": [end, "值"]}]
+    """
+    parsed = parse_over_time(promql)
+    if not parsed:
+        raise ValueError(f"不支持区间计算的查询: {promql[:100]}")
+    func, q, inner, duration, scale = parsed
+    step = PEAK_RANGE_STEP
+    start, last = eval_times(end, duration, step)
+    # 每段包含的点数，段与段之间不重叠
+    chunk = max(PEAK_RANGE_CHUNK_SECONDS // step, 1) * step
+    # { 标签元组: (标签, 统计量) }
+    series = {}
+    chunks = 0
+    while start <= last:
+        chunk_end = min(start + chunk - step, last)
+        # 历史数据分段量大且不会重复查询，不写入查询缓存
+        result = await prom_client.query(
+            range_url, inner, name=f"{name} range#{chunks}", cache=False, start=start, end=chunk_end, step=step
+        )
+        for item in result:
+            labels = item["metric"]
+            key = tuple(sorted(labels.items()))
+            entry = series.get(key)
+            if entry is None:
+                entry = series[key] = (labels, _reducer(func, q))
+            add = entry[1].add
+            for _, value in item["values"]:
+                value = float(value)
+                if not math.isnan(value):
+                    add(value)
+        start = chunk_end + step
+        chunks += 1
+    logger.info(f"区间计算[{name}]: {chunks}段, 序列数{len(series)}")
+    vector = []
+    for labels, reducer in series.values():
+        value = reducer.value()
+        # 所有点都是NaN的序列
+        if math.isfinite(value):
+            vector.append({"metric": labels, "value": [end, format_value(value * scale)]})
+    return vector
+
+
+def _compare(series=1000, q=0.8):
+    """分位数与精确值的相对误差: 1.5小时高峰期(精确计算)和6小时高峰期(P²)，步长15秒"""
+    import random
+
+    random.seed(0)
+    for points in (360, 1440):
+        errors = []
+        for i in range(series):
+            values = [random.lognormvariate(0, 0.5 + i % 5 / 5) * (1 + math.sin(j / 30) / 2) for j in range(points)]
+            estimator = StreamingQuantile(q)
+            for value in values:
+                estimator.add(value)
+            exact = quantile(values, q)
+            errors.append(abs(estimator.value() - exact) / exact)
+        errors.sort()
+        print(
+            f"q={q} {series}序列 x {points}点: 相对误差 中位数 {errors[len(errors) // 2]:.2%}, "
+            f"P99 {errors[int(len(errors) * 0.99)]:.2%}, 最大 {errors[-1]:.2%}"
+        )
+
+
+if __name__ == "__main__":
+    _compare()
@@ -0,0 +1,203 @@
+"""
+高峰期数据采集调度
+
+- 一次采集任务包含多个K8S、每个K8S多天的高峰期数据，每个(K8S, 天)为一个采集单元
+- 不同K8S、不同天的采集单元并发执行，同时执行的单元数受PEAK_CONCURRENCY限制，
+  每个Prometheus的并发查询数由prom_client限制
+- 每个单元写入k8s_resources成功后记录到 kubedoor.k8s_peak_checkpoint，再次采集时跳过
+  高峰时段相同且已完成的天，中断(如master重启)后重新发起同样的采集即从中断处继续；force时全部重新采集
+- 每个K8S的所有天采集完成后更新管控表
+- 最近的采集任务及每个(K8S, 天)的进度保存在内存中，通过 /api/peak_jobs 查询
+"""
+
+import asyncio
+import os
+import time
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from loguru import logger
+
+import utils
+from func_manager import day_partition
+
+PEAK_CONCURRENCY = int(os.environ.get('PEAK_CONCURRENCY', '4'))
+CHECKPOINT_TABLE = "kubedoor.k8s_peak_checkpoint"
+# 内存中保留的采集任务数
+MAX_JOBS = 20
+
+_semaphore = None
+# { job_id: PeakJob }，最新的在右侧
+jobs = OrderedDict()
+
+
+def _get_semaphore():
+    global _semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(PEAK_CONCURRENCY)
+    return _semaphore
+
+
+def peak_end_times(peak_hours, days, now=None):
+    """最近days天中高峰期已结束的天的高峰期结束时间，从近到远"""
+    now = now or datetime.now()
+    _, _, end_time_part = utils.calculate_peak_duration_and_end_time(peak_hours)
+    end_times = []
+    for i in range(0, days):
+        end_time_full = datetime.combine(now.date(), end_time_part) - timedelta(days=i)
+        if now < end_time_full:
+            logger.info(f"今天的高峰期还未结束，跳过{now.date()}的数据采集")
+            continue
+        end_times.append(end_time_full)
+    return end_times
+
+
+async def completed_days(env, peak_hours, end_times):
+    """已按相同高峰时段采集完成的天"""
+    if not end_times:
+        return set()
+    rows = await utils.ck.execute(
+        f"SELECT date FROM {CHECKPOINT_TABLE} FINAL "
+        "WHERE env = %(env)s AND date IN %(dates)s AND peak_hours = %(peak_hours)s",
+        {"env": env, "dates": utils._in_values(end_times), "peak_hours": peak_hours},
+    )
+    return {utils._naive(row[0]) for row in rows}
+
+
+async def save_checkpoint(env, end_time_full, peak_hours, rows):
+    await utils.ck.execute(
+        f"INSERT INTO {CHECKPOINT_TABLE} (env, date, peak_hours, rows) VALUES",
+        [(env, end_time_full, peak_hours, rows)],
+    )
+
+
+class PeakJob:
+    """一次采集任务及其每个(K8S, 天)的进度"""
+
+    def __init__(self, targets, days, force=False):
+        self.id = uuid.uuid4().hex[:12]
+        self.targets = targets
+        self.days = days
+        self.force = force
+        self.created = time.time()
+        self.finished = None
+        # { env: { 日期: {"state": pending|running|done|skipped|failed, ...} } }
+        self.progress = {env: {} for env, _ in targets}
+        # { env: 管控表更新结果 }
+        self.results = {}
+        self.waiter = None
+
+    def set_state(self, env, end_time_full, state, **info):
+        self.progress[env].setdefault(end_time_full.strftime("%Y-%m-%d %H:%M:%S"), {}).update(state=state, **info)
+
+    def summary(self):
+        counts = {}
+        for days in self.progress.values():
+            for item in days.values():
+                counts[item["state"]] = counts.get(item["state"], 0) + 1
+        return {
+            "id": self.id,
+            "days": self.days,
+            "force": self.force,
+            "created": datetime.fromtimestamp(self.created).strftime("%Y-%m-%d %H:%M:%S"),
+            "finished": self.finished and datetime.fromtimestamp(self.finished).strftime("%Y-%m-%d %H:%M:%S"),
+            "counts": counts,
+            "progress": self.progress,
+            "results": self.results,
+        }
+
+
+async def collect_day(job, env, peak_hours, duration_str, end_time_full):
+    """采集并写入一个(K8S, 天)的高峰期数据"""
+    async with _get_semaphore():
+        job.set_state(env, end_time_full, "running")
+        start = time.monotonic()
+        try:
+            logger.info(f"🚀获取{env} {end_time_full}的数据======")
+            # 强制重新采集时不使用查询缓存，重新读取Prometheus中补录的数据
+            data = await utils.merged_dict(utils.PROM_K8S_TAG_KEY, env, duration_str, end_time_full, cache=not job.force)
+            # 按天分区原子替换，已有当天数据时不再先删除
+            await day_partition.reload_day(end_time_full, env, data.columns())
+            await save_checkpoint(env, end_time_full, peak_hours, len(data))
+        except Exception as e:
+            logger.error(f"{env} {end_time_full} 高峰期数据采集失败: {e}")
+            job.set_state(env, end_time_full, "failed", error=str(e), seconds=round(time.monotonic() - start, 2))
+            raise
+        job.set_state(env, end_time_full, "done", rows=len(data), seconds=round(time.monotonic() - start, 2))
+
+
+async def update_control(env_value):
+    """取最近10天cpu使用最高的一天pod数据，写入管控表"""
+    resources = await utils.get_list_from_resources(env_value)
+    if await utils.is_init_or_update(env_value):
+        logger.info(f"🌊{env_value}: 初始化管控表======")
+        flag = await utils.init_control_data(resources)
+    else:
+        logger.info(f"🌊{env_value}: 更新管控表======")
+        flag = await utils.update_control_data(resources)
+    logger.info(f"✨{env_value}: 更新完成")
+    return flag
+
+
+async def run_cluster(job, env, peak_hours):
+    """并发采集一个K8S的所有天，完成后更新管控表，返回与原接口一致的结果"""
+    try:
+        logger.info(f"🐛开始获取{env}，{job.days}天，每日【{peak_hours}】高峰期数据")
+        duration_str, _, _ = utils.calculate_peak_duration_and_end_time(peak_hours)
+        end_times = peak_end_times(peak_hours, job.days)
+        done = set() if job.force else await completed_days(env, peak_hours, end_times)
+        pending = []
+        for end_time_full in end_times:
+            if end_time_full in done:
+                job.set_state(env, end_time_full, "skipped")
+            else:
+                job.set_state(env, end_time_full, "pending")
+                pending.append(end_time_full)
+        if done:
+            logger.info(f"{env}: {len(done)}天已采集完成，跳过")
+
+        results = await asyncio.gather(
+            *(collect_day(job, env, peak_hours, duration_str, end_time_full) for end_time_full in pending),
+            return_exceptions=True,
+        )
+        failed = [r for r in results if isinstance(r, BaseException)]
+        if failed:
+            # 已完成的天记录了进度，重新发起采集时只采集失败的天
+            result = {"message": f"{env}: {len(failed)}天高峰期数据采集失败: {failed[0]}"}, 500
+        else:
+            logger.info(f"🚀{env}: 高峰期数据采集流程结束,开始取最近10天cpu使用最高的一天pod数据, 写入管控表")
+            if await update_control(env):
+                result = {"success": True, "message": f"{env}: 执行完成"}, 200
+            else:
+                result = {"message": f"{env}: 写入管控表执行失败，详情见kubedoor-master日志"}, 500
+    except Exception as e:
+        logger.error(f"Error in table: {e}")
+        result = {"message": str(e)}, 500
+    job.results[env] = result[0]
+    return env, result
+
+
+def create_job(targets, days, force=False):
+    """
+    创建采集任务并加入任务列表
+
+    Args:
+        targets: [(env, peak_hours), ...]
+        days: 采集最近几天(含今天)
+        force: 忽略已完成的进度，全部重新采集
+    """
+    job = PeakJob(targets, days, force)
+    jobs[job.id] = job
+    while len(jobs) > MAX_JOBS:
+        jobs.popitem(last=False)
+    return job
+
+
+async def run_job(job):
+    """所有K8S并发采集，按完成顺序返回 (env, (结果, 状态码))"""
+    tasks = [asyncio.ensure_future(run_cluster(job, env, peak_hours)) for env, peak_hours in job.targets]
+    # 调用方提前退出(如客户端断开)时任务继续在后台执行，job持有引用
+    job.waiter = asyncio.gather(*tasks, return_exceptions=True)
+    job.waiter.add_done_callback(lambda _: setattr(job, "finished", time.time()))
+    for task in asyncio.as_completed(tasks):
+        yield await task
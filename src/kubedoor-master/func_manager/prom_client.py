@@ -0,0 +1,222 @@
+"""
+master访问Prometheus/VictoriaMetrics的异步客户端
+
+- 所有查询共用一个带连接池的aiohttp会话，程序退出时关闭
+- 每个Prometheus地址同时执行的查询数受PROM_CONCURRENCY限制，避免一次采集的大量查询压垮Prometheus
+- 网络错误、超时、429和5xx按退避间隔重试，PromQL错误(4xx)不重试
+- 记录每个查询的耗时、返回的序列数和响应大小，超过PROM_SLOW_QUERY_SECONDS的查询记录警告日志
+
+查询结果缓存，缓存键为 (地址, 查询语句, 查询参数):
+- 未指定time的即时查询把time对齐到PROM_CACHE_STEP的整数倍，同一步长内的相同查询命中同一缓存，缓存PROM_CACHE_TTL秒
+- time(区间查询为end)早于PROM_CACHE_SETTLE_SECONDS之前的查询结果基本不再变化，缓存PROM_CACHE_SETTLED_TTL秒，
+  过期后重新查询以获取延迟写入(如remote write补录)的数据；需要立即读取最新数据时使用cache=False
+- 按响应字节数限制缓存总大小，超过PROM_CACHE_MAX_ENTRY_BYTES的结果不缓存
+- 相同的查询同时只向Prometheus发送一次，等待者共享结果
+- 返回的结果被缓存和其它调用方共享，调用方不能修改
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+import aiohttp
+from loguru import logger
+
+PROM_CONCURRENCY = int(os.environ.get('PROM_CONCURRENCY', '8'))
+PROM_QUERY_TIMEOUT = float(os.environ.get('PROM_QUERY_TIMEOUT', '60'))
+PROM_RETRIES = int(os.environ.get('PROM_RETRIES', '3'))
+PROM_RETRY_BACKOFF = 0.5
+PROM_SLOW_QUERY_SECONDS = float(os.environ.get('PROM_SLOW_QUERY_SECONDS', '5'))
+PROM_CACHE_STEP = int(os.environ.get('PROM_CACHE_STEP', '15'))
+PROM_CACHE_TTL = float(os.environ.get('PROM_CACHE_TTL', '15'))
+PROM_CACHE_SETTLE_SECONDS = int(os.environ.get('PROM_CACHE_SETTLE_SECONDS', '300'))
+PROM_CACHE_SETTLED_TTL = float(os.environ.get('PROM_CACHE_SETTLED_TTL', '3600'))
+PROM_CACHE_MAX_BYTES = int(os.environ.get('PROM_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+PROM_CACHE_MAX_ENTRY_BYTES = int(os.environ.get('PROM_CACHE_MAX_ENTRY_BYTES', str(8 * 1024 * 1024)))
+
+_session = None
+# 每个Prometheus地址一个信号量
+_semaphores = {}
+stats = {"queries": 0, "errors": 0, "retries": 0, "seconds": 0.0, "bytes": 0}
+
+# { key: (过期时间, 结果, 响应字节数) }
+_cache = OrderedDict()
+_cache_bytes = 0
+# 进行中的查询: { key: Task }
+_inflight = {}
+cache_stats = {"hit": 0, "miss": 0, "coalesced": 0, "expired": 0, "put": 0, "skip_large": 0, "evict": 0}
+
+
+class PromQueryError(Exception):
+    """查询失败或返回status不为success"""
+
+
+class _RetryableError(Exception):
+    pass
+
+
+def _get_session():
+    global _session
+    if _session is None or _session.closed:
+        _session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=PROM_CONCURRENCY),
+            timeout=aiohttp.ClientTimeout(total=PROM_QUERY_TIMEOUT, sock_connect=10),
+        )
+        _semaphores.clear()
+    return _session
+
+
+async def close():
+    global _session
+    if _session is not None:
+        await _session.close()
+        _session = None
+
+
+async def _get(session, url, params):
+    async with session.get(url, params=params) as resp:
+        body = await resp.read()
+        if resp.status == 429 or resp.status >= 500:
+            raise _RetryableError(f"HTTP {resp.status}: {body[:200].decode('utf-8', errors='replace')}")
+        if resp.status != 200:
+            raise PromQueryError(f"HTTP {resp.status}: {body[:500].decode('utf-8', errors='replace')}")
+        return body, await resp.json(content_type=None)
+
+
+async def _execute(url, params, name):
+    """向Prometheus发送查询，返回 (data.result, 响应字节数)"""
+    session = _get_session()
+    semaphore = _semaphores.setdefault(url, asyncio.Semaphore(PROM_CONCURRENCY))
+    for attempt in range(PROM_RETRIES + 1):
+        try:
+            async with semaphore:
+                start = time.monotonic()
+                body, data = await _get(session, url, params)
+        except (_RetryableError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+            if attempt < PROM_RETRIES:
+                stats["retries"] += 1
+                delay = PROM_RETRY_BACKOFF * 2**attempt
+                logger.warning(f"Prometheus查询[{name}]失败，{delay}秒后第{attempt + 1}次重试: {e!r}")
+                await asyncio.sleep(delay)
+                continue
+            stats["errors"] += 1
+            raise PromQueryError(f"Prometheus查询[{name}]失败: {e!r}") from e
+        except PromQueryError as e:
+            stats["errors"] += 1
+            raise PromQueryError(f"Prometheus查询[{name}]失败: {e}") from e
+        break
+
+    cost = time.monotonic() - start
+    stats["queries"] += 1
+    stats["seconds"] += cost
+    stats["bytes"] += len(body)
+    if data.get("status") != "success":
+        stats["errors"] += 1
+        raise PromQueryError(f"Prometheus查询[{name}]失败: {data.get('errorType')} {data.get('error')}")
+    result = data["data"]["result"]
+    message = f"Prometheus查询[{name}]: 耗时{cost:.2f}s, 序列数{len(result)}, 响应{len(body)}字节"
+    if cost > PROM_SLOW_QUERY_SECONDS:
+        logger.warning(f"慢查询 {message}")
+    else:
+        logger.info(message)
+    return result, len(body)
+
+
+def _cache_get(key, now):
+    global _cache_bytes
+    entry = _cache.get(key)
+    if entry is None:
+        return None
+    expires, result, size = entry
+    if now >= expires:
+        del _cache[key]
+        _cache_bytes -= size
+        cache_stats["expired"] += 1
+        return None
+    _cache.move_to_end(key)
+    cache_stats["hit"] += 1
+    return result
+
+
+def _cache_put(key, expires, result, size):
+    global _cache_bytes
+    if size > PROM_CACHE_MAX_ENTRY_BYTES:
+        cache_stats["skip_large"] += 1
+        return
+    old = _cache.pop(key, None)
+    if old:
+        _cache_bytes -= old[2]
+    _cache[key] = (expires, result, size)
+    _cache_bytes += size
+    cache_stats["put"] += 1
+    while _cache_bytes > PROM_CACHE_MAX_BYTES:
+        _, (_, _, evicted) = _cache.popitem(last=False)
+        _cache_bytes -= evicted
+        cache_stats["evict"] += 1
+
+
+async def _fetch_and_cache(key, url, params, name):
+    result, size = await _execute(url, params, name)
+    now = time.time()
+    data_time = float(params.get("end", params.get("time", now)))
+    # 已经稳定的历史数据缓存更久
+    expires = now + (PROM_CACHE_SETTLED_TTL if data_time <= now - PROM_CACHE_SETTLE_SECONDS else PROM_CACHE_TTL)
+    _cache_put(key, expires, result, size)
+    return result
+
+
+def _consume_exception(task):
+    # 所有等待者都已取消时，避免"exception was never retrieved"警告
+    if not task.cancelled():
+        task.exception()
+
+
+async def query(url, promql, name=None, cache=True, **params):
+    """
+    执行查询，返回data.result，结果可能来自缓存，调用方不能修改
+
+    Args:
+        url: 查询接口地址，即时查询为utils.get_prom_url()，区间查询为utils.get_prom_range_url()
+        promql: 查询语句
+        name: 日志中显示的查询名称
+        cache: 为False时不读写缓存，用于不会重复的大查询
+        params: 其它查询参数，如time、start/end/step
+    """
+    name = name or promql[:60]
+    params = {"query": promql, **params}
+    now = time.time()
+    if "time" not in params and "end" not in params:
+        # 查询当前数据时对齐到步长，步长内的相同查询共享结果
+        params["time"] = int(now) // PROM_CACHE_STEP * PROM_CACHE_STEP
+    if not cache:
+        result, _ = await _execute(url, params, name)
+        return result
+    key = (url, tuple(sorted((k, str(v)) for k, v in params.items())))
+
+    result = _cache_get(key, now)
+    if result is not None:
+        return result
+    task = _inflight.get(key)
+    if task is None:
+        cache_stats["miss"] += 1
+        task = asyncio.ensure_future(_fetch_and_cache(key, url, params, name))
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+        task.add_done_callback(_consume_exception)
+    else:
+        cache_stats["coalesced"] += 1
+    # 单个等待者取消时不取消共享的查询
+    return await asyncio.shield(task)
+
+
+def cache_metrics():
+    lookups = cache_stats["hit"] + cache_stats["miss"] + cache_stats["coalesced"]
+    return {
+        "entries": len(_cache),
+        "bytes": _cache_bytes,
+        "max_bytes": PROM_CACHE_MAX_BYTES,
+        "inflight": len(_inflight),
+        "hit_ratio": round((cache_stats["hit"] + cache_stats["coalesced"]) / lookups, 3) if lookups else 0,
+        **cache_stats,
+        "prometheus": stats,
+    }
@@ -1,8 +1,8 @@
 import asyncio
-import aiohttp
 from loguru import logger
 
 import utils
+from func_manager import prom_client
 
 
 def build_queries(env=None):
@@ -92,13 +92,9 @@ def build_queries(env=None):
     }
 
 
-async def _fetch(session, url, name, q):
+async def _fetch(url, name, q):
     try:
-        # logger.info("prom_overview query [{}]: {}?query={}", name, url, q)
-        async with session.get(url, params={"query": q}) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            return data.get("data", {}).get("result", [])
+        return await prom_client.query(url, q, name=f"prom_overview {name}")
     except Exception as exc:
         logger.exception("prom_overview query [{}] failed: {}", name, exc)
         return []
@@ -119,10 +115,11 @@ def _format_max_metric(items):
     if not items:
         return ["", 0.0]
     item = items[0]
+    # 结果与prom_client的缓存共享，不能修改
     labels = item.get("metric", {})
     key = utils.PROM_K8S_TAG_KEY
-    key_value = labels.pop(key, "")
-    other_values = [str(v) for v in labels.values()]
+    key_value = labels.get(key, "")
+    other_values = [str(v) for k, v in labels.items() if k != key]
     label_str = "：".join([key_value] + other_values) if key_value else "：".join(other_values)
     value = item.get("value", [None, "0"])[1]
     try:
@@ -135,9 +132,8 @@ def _format_max_metric(items):
 async def get_overview_counts_async(env=None):
     queries = build_queries(env)
     url = utils.get_prom_url()
-    async with aiohttp.ClientSession() as session:
-        tasks = [_fetch(session, url, name, q) for name, q in queries.items()]
-        results = await asyncio.gather(*tasks)
+    tasks = [_fetch(url, name, q) for name, q in queries.items()]
+    results = await asyncio.gather(*tasks)
     final = {}
     max_metrics = {
         "max_pvc_usage_percent",
@@ -0,0 +1,173 @@
+"""
+ClickHouse只读查询的结果缓存
+
+- 缓存键为规范化的SQL(合并引号外的空白)、参数和输出格式
+- 缓存时间按查询涉及的表配置，取其中最短的；涉及未配置的表时不缓存
+- master通过ClickHousePool或/api/sql写入某个表时，清理涉及该表的缓存；
+  查询期间表被写入时，查询结果不写入缓存
+- 告警服务、其它master副本的写入无法感知，依靠较短的TTL过期
+- 按条数(QUERY_CACHE_MAX_ENTRIES)和结果总字节数(QUERY_CACHE_MAX_BYTES)限制，超出时淘汰最久未使用的结果
+"""
+
+import os
+import re
+import sys
+import time
+from collections import OrderedDict
+from loguru import logger
+
+# 表的缓存时间(秒)，未配置的表不缓存
+TABLE_TTL_SECONDS = {
+    "k8s_res_control": 60,
+    "k8s_resources": 600,
+    "k8s_agent_status": 60,
+    # 告警服务直接写入
+    "k8s_pod_alert_days": 15,
+    # 事件持续写入，只按TTL过期，不在每次写入时清理
+    "k8s_events": 10,
+}
+MAX_ENTRIES = int(os.environ.get('QUERY_CACHE_MAX_ENTRIES', '1000'))
+MAX_BYTES = int(os.environ.get('QUERY_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# 超过该大小的结果不缓存(字节)
+MAX_ENTRY_BYTES = int(os.environ.get('QUERY_CACHE_MAX_ENTRY_BYTES', str(2 * 1024 * 1024)))
+# 写入时不清理缓存的表
+NO_INVALIDATE_TABLES = {"k8s_events"}
+
+_READ_TABLE_RE = re.compile(r"\b(?:from|join)\s+(?:[`\"]?\w+[`\"]?\.)?[`\"]?(\w+)", re.IGNORECASE)
+_WRITE_TABLE_RE = re.compile(
+    r"^\s*(?:insert\s+into|alter\s+table|optimize\s+table|truncate\s+table(?:\s+if\s+exists)?)\s+"
+    r"(?:[`\"]?\w+[`\"]?\.)?[`\"]?(\w+)",
+    re.IGNORECASE,
+)
+
+# { key: {"tables": set, "expires": ts, "value": ..., "size": n} }
+_cache = OrderedDict()
+_cache_bytes = 0
+# 每个表的写入次数，用于丢弃查询期间表被写入的结果
+_generation = {}
+stats = {"hit": 0, "miss": 0, "expired": 0, "put": 0, "skip_large": 0, "skip_stale": 0, "evict": 0, "invalidate": 0}
+
+
+def normalize(sql):
+    """合并引号外的连续空白，引号内的内容不变"""
+    parts = re.split(r"('(?:[^'\\]|\\.)*'|\"(?:[^\"\\]|\\.)*\"|`[^`]*`)", sql.strip())
+    return "".join(part if i % 2 else " ".join(part.split()) for i, part in enumerate(parts))
+
+
+def read_tables(sql):
+    return {match.lower() for match in _READ_TABLE_RE.findall(sql)}
+
+
+def written_table(sql):
+    """写操作涉及的表，不是写操作时返回None"""
+    match = _WRITE_TABLE_RE.match(sql)
+    return match.group(1).lower() if match else None
+
+
+class Lookup:
+    """一次可缓存查询的缓存键、TTL和开始查询时各表的写入次数"""
+
+    __slots__ = ("key", "tables", "ttl", "generation")
+
+    def __init__(self, key, tables, ttl):
+        self.key = key
+        self.tables = tables
+        self.ttl = ttl
+        self.generation = tuple(_generation.get(table, 0) for table in sorted(tables))
+
+
+def make_key(sql, params=None, fmt=None):
+    """可缓存的SELECT返回Lookup，否则返回None"""
+    normalized = normalize(sql)
+    if not normalized.lower().startswith(("select", "with")):
+        return None
+    tables = read_tables(normalized)
+    if not tables or not tables.issubset(TABLE_TTL_SECONDS):
+        return None
+    ttl = min(TABLE_TTL_SECONDS[table] for table in tables)
+    return Lookup((normalized, repr(params), fmt), tables, ttl)
+
+
+def _remove(key):
+    global _cache_bytes
+    _cache_bytes -= _cache.pop(key)["size"]
+
+
+def estimate_size(rows):
+    """clickhouse_driver返回的行占用的内存(字节)，用于没有响应字节数的结果"""
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        if isinstance(row, (tuple, list)):
+            size += sum(sys.getsizeof(value) for value in row)
+    return size
+
+
+def get(lookup):
+    """返回缓存的结果，没有时返回None"""
+    entry = _cache.get(lookup.key)
+    if entry is None:
+        stats["miss"] += 1
+        return None
+    if time.time() >= entry["expires"]:
+        _remove(lookup.key)
+        stats["expired"] += 1
+        stats["miss"] += 1
+        return None
+    _cache.move_to_end(lookup.key)
+    stats["hit"] += 1
+    return entry["value"]
+
+
+def put(lookup, value, size=None):
+    """缓存查询结果，size为结果字节数，为None时按行估算"""
+    global _cache_bytes
+    if size is None:
+        size = estimate_size(value)
+    if size > MAX_ENTRY_BYTES:
+        stats["skip_large"] += 1
+        return
+    if tuple(_generation.get(table, 0) for table in sorted(lookup.tables)) != lookup.generation:
+        stats["skip_stale"] += 1
+        return
+    if lookup.key in _cache:
+        _remove(lookup.key)
+    _cache[lookup.key] = {"tables": lookup.tables, "expires": time.time() + lookup.ttl, "value": value, "size": size}
+    _cache_bytes += size
+    stats["put"] += 1
+    while len(_cache) > MAX_ENTRIES or _cache_bytes > MAX_BYTES:
+        _remove(next(iter(_cache)))
+        stats["evict"] += 1
+
+
+def invalidate(table):
+    """清理涉及该表的缓存"""
+    table = table.lower()
+    if table in NO_INVALIDATE_TABLES:
+        return
+    _generation[table] = _generation.get(table, 0) + 1
+    keys = [key for key, entry in _cache.items() if table in entry["tables"]]
+    for key in keys:
+        _remove(key)
+    if keys:
+        stats["invalidate"] += len(keys)
+        logger.info(f"♻{table} 被写入，清理 {len(keys)} 条查询缓存")
+
+
+def invalidate_sql(sql):
+    """sql为写操作时清理其涉及的表的缓存"""
+    table = written_table(sql)
+    if table:
+        invalidate(table)
+
+
+def metrics():
+    lookups = stats["hit"] + stats["miss"]
+    return {
+        "entries": len(_cache),
+        "bytes": _cache_bytes,
+        "max_entries": MAX_ENTRIES,
+        "max_bytes": MAX_BYTES,
+        "hit_ratio": round(stats["hit"] / lookups, 3) if lookups else 0,
+        **stats,
+    }
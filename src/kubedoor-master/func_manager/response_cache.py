@@ -0,0 +1,155 @@
+"""
+agent只读接口的响应缓存
+
+- 每个接口单独配置TTL，过期后的STALE_SECONDS内仍返回旧数据，同时在后台刷新(stale-while-revalidate)
+- 条目总数超过MAX_ENTRIES时按LRU淘汰
+- 任何非GET请求转发给agent时，按env和namespace清理相关缓存
+- 请求agent前记录(env, 接口)的写入次数，期间有写请求清理过该接口时不缓存请求到的旧数据
+- 请求带 flush=true 时跳过缓存直接请求agent
+"""
+
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from loguru import logger
+
+# 接口缓存时间(秒)，未配置的接口不缓存
+ROUTE_TTL_SECONDS = {
+    "/api/agent/namespaces": 3600,
+    "/api/agent/services": 30,
+    "/api/agent/service/endpoints": 10,
+    "/api/agent/service/first-port": 60,
+    "/api/agent/ingresses": 30,
+    "/api/agent/ingress/rules": 30,
+    "/api/agent/configmaps": 30,
+    "/api/agent/statefulsets": 15,
+    "/api/agent/daemonsets": 15,
+}
+# 过期后仍可返回旧数据的时间(秒)
+STALE_SECONDS = int(os.environ.get('RESPONSE_CACHE_STALE_SECONDS', '60'))
+MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', '2000'))
+# 只有这些写操作会影响命名空间列表
+NAMESPACE_WRITE_ROUTES = {"/api/agent/res/ops", "/api/agent/res/delete"}
+
+FRESH = "fresh"
+STALE = "stale"
+
+# { (env, path, query): {"namespace": ns, "expires": ts, "response": {...}} }
+_cache = OrderedDict()
+# 正在后台刷新的缓存键: { key: Task }
+_refreshing = {}
+# 各(env, 接口)被写请求清理的次数: { (env, path): int }
+_generation = {}
+stats = {"hit": 0, "stale": 0, "miss": 0, "evict": 0, "invalidate": 0, "skip_stale": 0}
+
+
+def make_key(env, method, path, query):
+    """可缓存的请求返回缓存键，否则返回None"""
+    if method != "GET" or path not in ROUTE_TTL_SECONDS:
+        return None
+    return (env, path, tuple(sorted((k, v) for k, v in query.items() if k != "flush")))
+
+
+def get(key):
+    """返回 (response, FRESH|STALE)，没有可用缓存时返回 (None, None)"""
+    entry = _cache.get(key)
+    if entry is None:
+        stats["miss"] += 1
+        return None, None
+    now = time.time()
+    if now < entry["expires"]:
+        _cache.move_to_end(key)
+        stats["hit"] += 1
+        logger.info(f"♻从缓存中获取 {key[0]} {key[1]}")
+        return entry["response"], FRESH
+    if now < entry["expires"] + STALE_SECONDS:
+        _cache.move_to_end(key)
+        stats["stale"] += 1
+        logger.info(f"♻返回 {key[0]} {key[1]} 的过期缓存，后台刷新")
+        return entry["response"], STALE
+    del _cache[key]
+    stats["miss"] += 1
+    return None, None
+
+
+def generation(key):
+    """请求agent前调用，返回key所属(env, 接口)当前的写入次数，传给put"""
+    if key is None:
+        return None
+    return _generation.get(key[:2], 0)
+
+
+def put(key, response, generation):
+    """缓存agent的成功响应，generation为请求agent前generation(key)的返回值"""
+    if not isinstance(response, dict) or not response.get("success"):
+        return
+    if _generation.get(key[:2], 0) != generation:
+        # 请求期间该接口被写请求清理过，响应可能是写入前的数据
+        stats["skip_stale"] += 1
+        return
+    env, path, query = key
+    _cache[key] = {
+        "namespace": dict(query).get("namespace") or None,
+        "expires": time.time() + ROUTE_TTL_SECONDS[path],
+        "response": response,
+    }
+    _cache.move_to_end(key)
+    while len(_cache) > MAX_ENTRIES:
+        _cache.popitem(last=False)
+        stats["evict"] += 1
+
+
+def refresh(key, coro_factory):
+    """后台请求agent刷新过期条目，同一个键同时只刷新一次；coro_factory返回 (generation, response)"""
+    if key in _refreshing:
+        return
+
+    async def run():
+        try:
+            generation, response = await coro_factory()
+            put(key, response, generation)
+        except Exception as e:
+            logger.warning(f"♻后台刷新 {key[0]} {key[1]} 缓存失败: {e}")
+        finally:
+            _refreshing.pop(key, None)
+
+    _refreshing[key] = asyncio.create_task(run())
+
+
+def _request_namespaces(query, body):
+    """从写请求的参数中找出涉及的namespace，找不到时返回空集合"""
+    namespaces = set()
+    if query.get("namespace"):
+        namespaces.add(query["namespace"])
+    items = body if isinstance(body, list) else [body]
+    for item in items:
+        if isinstance(item, dict) and isinstance(item.get("namespace"), str):
+            namespaces.add(item["namespace"])
+    return namespaces
+
+
+def invalidate(env, path, query, body):
+    """写请求转发给agent时清理同env、同namespace的缓存，无法确定namespace时清理整个env"""
+    namespaces = _request_namespaces(query, body)
+    for route in ROUTE_TTL_SECONDS:
+        if route != "/api/agent/namespaces" or path in NAMESPACE_WRITE_ROUTES:
+            _generation[(env, route)] = _generation.get((env, route), 0) + 1
+    keys = []
+    for key, entry in _cache.items():
+        if key[0] != env:
+            continue
+        if key[1] == "/api/agent/namespaces" and path not in NAMESPACE_WRITE_ROUTES:
+            continue
+        # 不带namespace的全量列表也包含被修改的资源
+        if not namespaces or entry["namespace"] is None or entry["namespace"] in namespaces:
+            keys.append(key)
+    for key in keys:
+        del _cache[key]
+    if keys:
+        stats["invalidate"] += len(keys)
+        logger.info(f"♻{path} 清理 {env} {sorted(namespaces) or '全部'} 的 {len(keys)} 条缓存")
+
+
+def metrics():
+    return {"entries": len(_cache), "max_entries": MAX_ENTRIES, **stats}
@@ -0,0 +1,151 @@
+"""
+ClickHouse表结构的版本化迁移
+
+- 已执行的迁移记录在 kubedoor.schema_migrations 中，启动时只查询一次最大版本号，已是最新时不再执行任何语句
+- 迁移按版本号顺序执行，每个迁移执行成功后立即记录，失败时从该迁移重试；迁移内容需可重复执行
+- 在后台任务中执行，ClickHouse不可用时按退避间隔重试，master不等待表结构初始化完成即可启动并处理agent连接
+- 修改已有表(索引、投影、字段等)时在MIGRATIONS末尾追加新版本，不修改已发布的迁移
+"""
+
+import asyncio
+import os
+import time
+from loguru import logger
+
+from k8s_event import get_clickhouse_client
+
+MIGRATIONS_TABLE = "kubedoor.schema_migrations"
+# ClickHouse不可用时的重试间隔(秒)，从最小值开始每次翻倍
+SCHEMA_RETRY_MIN_SECONDS = float(os.environ.get('SCHEMA_RETRY_MIN_SECONDS', '2'))
+SCHEMA_RETRY_MAX_SECONDS = float(os.environ.get('SCHEMA_RETRY_MAX_SECONDS', '60'))
+
+
+def _baseline(client):
+    """create_table.sql 中的库和表，已存在的表引擎或分区键不一致时迁移数据"""
+    client.init_table()
+
+
+# (版本号, 说明, SQL语句列表或接收ClickHouseClient的函数)
+MIGRATIONS = [
+    (1, "create_table.sql 建库建表", _baseline),
+    (
+        2,
+        "为k8s_events已有数据生成跳数索引",
+        [
+            # CREATE INDEX 只对之后写入的part生效，已有的part需要MATERIALIZE(后台mutation)
+            "ALTER TABLE kubedoor.k8s_events MATERIALIZE INDEX idx_k8s_namespace_time",
+            "ALTER TABLE kubedoor.k8s_events MATERIALIZE INDEX idx_level_kind",
+            "ALTER TABLE kubedoor.k8s_events MATERIALIZE INDEX idx_reason",
+        ],
+    ),
+    (
+        3,
+        "高峰期数据采集进度表",
+        [
+            """CREATE TABLE IF NOT EXISTS kubedoor.k8s_peak_checkpoint
+    (
+        `env` String,
+        `date` DateTime('Asia/Shanghai') COMMENT '高峰期结束时间，与k8s_resources的date一致',
+        `peak_hours` String,
+        `rows` UInt32,
+        `collected_at` DateTime('Asia/Shanghai') DEFAULT now()
+    )
+    ENGINE = ReplacingMergeTree(collected_at)
+    ORDER BY (env, date)
+    TTL date + INTERVAL 90 DAY"""
+        ],
+    ),
+]
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+status = {"version": None, "latest": LATEST_VERSION, "ready": False, "attempts": 0, "last_error": None}
+_ready = asyncio.Event()
+
+
+def _is_missing(exc):
+    message = str(exc)
+    return "UNKNOWN_TABLE" in message or "UNKNOWN_DATABASE" in message
+
+
+def current_version(client):
+    """已执行的最大版本号，迁移表不存在时为0"""
+    # 直接使用连接，迁移表不存在是首次启动的正常情况，不记录错误日志
+    with client.pool.get_client() as conn:
+        try:
+            rows = conn.query(f"SELECT max(version) FROM {MIGRATIONS_TABLE}").result_rows
+        except Exception as e:
+            if _is_missing(e):
+                return 0
+            raise
+    return rows[0][0] if rows else 0
+
+
+def _ensure_migrations_table(client):
+    client.pool.execute_command("CREATE DATABASE IF NOT EXISTS kubedoor ENGINE=Atomic")
+    client.pool.execute_command(
+        f"""CREATE TABLE IF NOT EXISTS {MIGRATIONS_TABLE}
+    (
+        `version` UInt32,
+        `name` String,
+        `duration_ms` UInt32,
+        `applied_at` DateTime('Asia/Shanghai') DEFAULT now()
+    )
+    ENGINE = ReplacingMergeTree(applied_at)
+    ORDER BY version"""
+    )
+
+
+def migrate():
+    """执行未执行过的迁移，返回当前版本号"""
+    client = get_clickhouse_client()
+    version = current_version(client)
+    status["version"] = version
+    if version >= LATEST_VERSION:
+        logger.info(f"ClickHouse表结构已是最新版本 {version}")
+        return version
+
+    _ensure_migrations_table(client)
+    for number, name, action in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info(f"执行ClickHouse表结构迁移 {number}: {name}")
+        start = time.monotonic()
+        if callable(action):
+            action(client)
+        else:
+            for sql in action:
+                logger.debug(f"执行迁移SQL: {sql[:100]}...")
+                client.pool.execute_command(sql)
+        duration_ms = int((time.monotonic() - start) * 1000)
+        client.pool.execute_command(
+            f"INSERT INTO {MIGRATIONS_TABLE} (version, name, duration_ms) VALUES (%(version)s, %(name)s, %(duration_ms)s)",
+            {"version": number, "name": name, "duration_ms": duration_ms},
+        )
+        status["version"] = number
+        logger.info(f"ClickHouse表结构迁移 {number} 完成，耗时 {duration_ms}ms")
+    return status["version"]
+
+
+async def run():
+    """后台执行迁移，失败时按退避间隔重试直到成功"""
+    delay = SCHEMA_RETRY_MIN_SECONDS
+    while True:
+        status["attempts"] += 1
+        try:
+            await asyncio.to_thread(migrate)
+        except Exception as e:
+            status["last_error"] = str(e)
+            logger.error(f"ClickHouse表结构初始化失败，{delay:.0f}秒后重试: {e}")
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, SCHEMA_RETRY_MAX_SECONDS)
+            continue
+        status["ready"] = True
+        status["last_error"] = None
+        _ready.set()
+        logger.info("ClickHouse表结构初始化成功")
+        return
+
+
+async def wait_ready():
+    """等待表结构初始化完成，依赖表结构的写入在此之后执行"""
+    await _ready.wait()
@@ -0,0 +1,235 @@
+"""
+多副本master共享的agent会话注册表
+
+每个agent的WebSocket只连接到一个master副本，副本在注册表中登记 env -> 副本地址，
+其它副本收到该env的请求时按注册表转发给持有连接的副本。
+注册表同时提供副本之间的互斥锁(lock)，用于不能被多个副本同时执行的ClickHouse写入。
+- SESSION_REGISTRY=memory(默认): 进程内注册表，单副本部署
+- SESSION_REGISTRY=redis: 使用Redis(或兼容协议的服务)共享，地址取REDIS_URL
+"""
+
+import asyncio
+import json
+import os
+import socket
+import time
+import uuid
+from contextlib import asynccontextmanager
+from aiohttp import web, WSMsgType
+from loguru import logger
+
+SESSION_REGISTRY = os.environ.get('SESSION_REGISTRY', 'memory')
+REDIS_URL = os.environ.get('REDIS_URL', 'redis://localhost:6379/0')
+# 注册信息的存活时间，由heartbeat_check定期续期，副本异常退出后自动过期
+SESSION_TTL_SECONDS = int(os.environ.get('SESSION_TTL_SECONDS', '15'))
+REPLICA_ID = os.environ.get('MASTER_REPLICA_ID') or socket.gethostname()
+# 其它副本访问本副本的地址，k8s中通过downward API注入POD_IP
+REPLICA_ADDR = os.environ.get('MASTER_REPLICA_ADDR') or f"http://{os.environ.get('POD_IP', REPLICA_ID)}:80"
+# 标记已被转发过的请求，避免副本之间循环转发
+FORWARDED_HEADER = 'X-KubeDoor-Forwarded'
+FORWARD_CHUNK_SIZE = 256 * 1024
+# 副本之间互斥锁的存活时间，持有锁的副本异常退出后自动释放
+LOCK_TTL_SECONDS = int(os.environ.get('REGISTRY_LOCK_TTL_SECONDS', '600'))
+LOCK_POLL_MAX_SECONDS = 1.0
+
+
+def _session_info(ver, conn=None):
+    return {"replica": REPLICA_ID, "addr": REPLICA_ADDR, "ver": ver, "conn": conn, "last_heartbeat": time.time()}
+
+
+def _owns(owner, conn):
+    """注册信息属于本副本，指定conn时还需是同一个连接"""
+    return owner is not None and owner["replica"] == REPLICA_ID and (conn is None or owner.get("conn") == conn)
+
+
+class MemorySessionRegistry:
+    """进程内注册表，行为与RedisSessionRegistry一致"""
+
+    def __init__(self, ttl=SESSION_TTL_SECONDS):
+        self.ttl = ttl
+        self._sessions = {}
+        self._locks = {}
+
+    def _alive(self, env):
+        info = self._sessions.get(env)
+        if info and time.time() - info["last_heartbeat"] < self.ttl:
+            return info
+        return None
+
+    async def register(self, env, ver, conn=None):
+        """登记本副本的连接conn持有env，已被其它副本持有时返回False"""
+        owner = self._alive(env)
+        if owner and owner["replica"] != REPLICA_ID:
+            return False
+        self._sessions[env] = _session_info(ver, conn)
+        return True
+
+    async def unregister(self, env, conn=None):
+        """删除本副本的注册，指定conn时只删除该连接的注册(agent已重连时保留新连接)"""
+        if _owns(self._sessions.get(env), conn):
+            del self._sessions[env]
+
+    async def refresh(self, env, ver, conn=None):
+        if _owns(self._sessions.get(env), conn):
+            self._sessions[env] = _session_info(ver, conn)
+
+    async def lookup(self, env):
+        return self._alive(env)
+
+    async def list_sessions(self):
+        return {env: info for env in list(self._sessions) if (info := self._alive(env))}
+
+    @asynccontextmanager
+    async def lock(self, name, ttl=LOCK_TTL_SECONDS):
+        """单副本部署时进程内的锁即可互斥"""
+        async with self._locks.setdefault(name, asyncio.Lock()):
+            yield
+
+    async def close(self):
+        pass
+
+
+class RedisSessionRegistry:
+    """基于Redis的注册表，client只需提供redis.asyncio的get/set/delete/mget/scan_iter接口"""
+
+    def __init__(self, client, ttl=SESSION_TTL_SECONDS, prefix='kubedoor:agent_session:', lock_prefix='kubedoor:lock:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+        self.lock_prefix = lock_prefix
+
+    def _key(self, env):
+        return f"{self.prefix}{env}"
+
+    @staticmethod
+    def _load(raw):
+        if raw is None:
+            return None
+        if isinstance(raw, bytes):
+            raw = raw.decode('utf-8')
+        return json.loads(raw)
+
+    async def register(self, env, ver, conn=None):
+        value = json.dumps(_session_info(ver, conn))
+        if await self.client.set(self._key(env), value, ex=self.ttl, nx=True):
+            return True
+        owner = await self.lookup(env)
+        if owner and owner["replica"] != REPLICA_ID:
+            return False
+        await self.client.set(self._key(env), value, ex=self.ttl)
+        return True
+
+    async def unregister(self, env, conn=None):
+        if _owns(await self.lookup(env), conn):
+            await self.client.delete(self._key(env))
+
+    async def refresh(self, env, ver, conn=None):
+        owner = await self.lookup(env)
+        # 已过期时重新登记；同一副本上已是新连接的注册时不覆盖
+        if owner is None or _owns(owner, conn):
+            await self.client.set(self._key(env), json.dumps(_session_info(ver, conn)), ex=self.ttl)
+
+    async def lookup(self, env):
+        return self._load(await self.client.get(self._key(env)))
+
+    async def list_sessions(self):
+        keys = [key async for key in self.client.scan_iter(match=f"{self.prefix}*")]
+        if not keys:
+            return {}
+        sessions = {}
+        for key, raw in zip(keys, await self.client.mget(keys)):
+            info = self._load(raw)
+            if info:
+                key = key.decode('utf-8') if isinstance(key, bytes) else key
+                sessions[key[len(self.prefix) :]] = info
+        return sessions
+
+    @asynccontextmanager
+    async def lock(self, name, ttl=LOCK_TTL_SECONDS):
+        """所有副本之间互斥，等待期间按退避间隔重试，只释放自己持有的锁"""
+        key = f"{self.lock_prefix}{name}"
+        token = uuid.uuid4().hex
+        delay = 0.05
+        while not await self.client.set(key, token, ex=ttl, nx=True):
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, LOCK_POLL_MAX_SECONDS)
+        try:
+            yield
+        finally:
+            owner = await self.client.get(key)
+            if owner is not None and (owner.decode('utf-8') if isinstance(owner, bytes) else owner) == token:
+                await self.client.delete(key)
+
+    async def close(self):
+        await self.client.aclose()
+
+
+def create_registry():
+    if SESSION_REGISTRY == 'redis':
+        # 单副本(memory)部署不加载redis客户端
+        import redis.asyncio as aioredis
+
+        logger.info(f"使用Redis共享agent会话注册表: {REDIS_URL}, 副本: {REPLICA_ID} {REPLICA_ADDR}")
+        return RedisSessionRegistry(aioredis.from_url(REDIS_URL))
+    return MemorySessionRegistry()
+
+
+registry = create_registry()
+
+
+def is_remote(owner):
+    return owner is not None and owner["replica"] != REPLICA_ID
+
+
+async def forward_http(request, session, owner):
+    """把HTTP请求原样转发给持有agent连接的副本"""
+    headers = {k: v for k, v in request.headers.items() if k.lower() not in ('host', 'content-length')}
+    headers[FORWARDED_HEADER] = REPLICA_ID
+    body = await request.read()
+    logger.info(f"🔀转发请求到副本 {owner['replica']}: {request.method} {request.path_qs}")
+    async with session.request(request.method, owner["addr"] + request.path_qs, data=body, headers=headers) as resp:
+        # 大响应(如分块返回的全集群Pod列表)边收边写，不在本副本组装
+        response = web.StreamResponse(status=resp.status)
+        response.content_type = resp.content_type
+        await response.prepare(request)
+        async for data in resp.content.iter_chunked(FORWARD_CHUNK_SIZE):
+            await response.write(data)
+        await response.write_eof()
+        return response
+
+
+async def fetch_remote(session, owner, path, query):
+    """向持有agent连接的副本发起GET请求并返回解析后的JSON"""
+    headers = {FORWARDED_HEADER: REPLICA_ID}
+    async with session.get(owner["addr"] + path, params=query, headers=headers) as resp:
+        return await resp.json(content_type=None)
+
+
+async def forward_pod_logs(request, session, owner):
+    """把前端的Pod日志WebSocket桥接到持有agent连接的副本"""
+    ws = web.WebSocketResponse()
+    await ws.prepare(request)
+    logger.info(f"🔀转发Pod日志连接到副本 {owner['replica']}: {request.path_qs}")
+
+    async def pipe(source, target):
+        async for msg in source:
+            if msg.type == WSMsgType.TEXT:
+                await target.send_str(msg.data)
+            elif msg.type == WSMsgType.BINARY:
+                await target.send_bytes(msg.data)
+            else:
+                break
+
+    try:
+        async with session.ws_connect(
+            owner["addr"] + request.path_qs, headers={FORWARDED_HEADER: REPLICA_ID}
+        ) as upstream:
+            tasks = [asyncio.create_task(pipe(ws, upstream)), asyncio.create_task(pipe(upstream, ws))]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+    except Exception as e:
+        logger.error(f"转发Pod日志连接到副本 {owner['replica']} 失败: {e}")
+    finally:
+        await ws.close()
+    return ws
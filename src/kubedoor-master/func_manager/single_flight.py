@@ -0,0 +1,65 @@
+"""
+相同只读请求的合并(single-flight)
+
+多个前端同时请求同一env的同一只读接口时，只向agent发送一次请求，
+所有等待者共享这一次的结果(包括异常)。请求结束后立即移除，不做缓存。
+"""
+
+import asyncio
+from loguru import logger
+
+# 允许合并的只读接口，只有GET请求会合并
+SINGLE_FLIGHT_ROUTES = {
+    "/api/agent/namespaces",
+    "/api/agent/pods",
+    "/api/agent/services",
+    "/api/agent/service/endpoints",
+    "/api/agent/service/first-port",
+    "/api/agent/ingresses",
+    "/api/agent/ingress/rules",
+    "/api/agent/configmaps",
+    "/api/agent/statefulsets",
+    "/api/agent/statefulset/pods",
+    "/api/agent/daemonsets",
+    "/api/agent/daemonset/pods",
+    "/api/agent/res/content",
+    "/api/nodes",
+    "/api/nodes/list",
+    "/api/events",
+    "/api/get_dpm_pods",
+}
+
+# 进行中的请求: { key: Task }
+_inflight = {}
+stats = {"leader": 0, "shared": 0}
+
+
+def make_key(env, method, path, query):
+    """按env、方法、路径和排序后的查询参数生成合并键，不可合并的请求返回None"""
+    if method != "GET" or path not in SINGLE_FLIGHT_ROUTES:
+        return None
+    return (env, method, path, tuple(sorted(query.items())))
+
+
+def _consume_exception(task):
+    # 所有等待者都已离开时，避免"exception was never retrieved"警告
+    if not task.cancelled():
+        task.exception()
+
+
+async def do(key, coro_factory):
+    """key相同的并发调用共享同一次coro_factory()的结果，key为None时直接执行"""
+    if key is None:
+        return await coro_factory()
+    task = _inflight.get(key)
+    if task is None:
+        stats["leader"] += 1
+        task = asyncio.create_task(coro_factory())
+        _inflight[key] = task
+        task.add_done_callback(lambda t: _inflight.pop(key, None))
+        task.add_done_callback(_consume_exception)
+    else:
+        stats["shared"] += 1
+        logger.debug(f"合并相同请求: env={key[0]}, path={key[2]}")
+    # 单个前端断开不取消共享的请求
+    return await asyncio.shield(task)
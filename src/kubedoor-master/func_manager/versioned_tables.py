@@ -0,0 +1,97 @@
+"""
+追加写入的版本表
+
+k8s_res_control、k8s_pod_alert_days 使用 ReplacingMergeTree(ver)，ver 为插入时自动生成的物化列。
+修改数据时不再执行 ALTER TABLE ... UPDATE(异步mutation会重写整个part)，而是把最新版本的行
+复制一份并替换修改的字段后插入:
+
+    INSERT INTO t SELECT * REPLACE (新值 AS 字段, ...) FROM t FINAL WHERE 条件
+
+读取时使用 FINAL(或 final=1 设置)只返回每个主键最新版本的行，旧版本在后台合并时删除。
+"""
+
+import re
+
+# 版本表及其排序键
+VERSIONED_TABLES = {
+    "k8s_res_control": ("env", "namespace", "deployment"),
+    "k8s_pod_alert_days": ("start_time", "fingerprint", "severity", "env", "alert_group", "alert_name"),
+}
+
+_VERSIONED_TABLE_RE = re.compile(r"\b(?:" + "|".join(VERSIONED_TABLES) + r")\b", re.IGNORECASE)
+_ALTER_UPDATE_RE = re.compile(
+    r"^\s*alter\s+table\s+(?P<table>[`\"\w\.]+)\s+update\s+(?P<assignments>.+?)\s+where\s+(?P<where>.+?)\s*;?\s*$",
+    re.IGNORECASE | re.DOTALL,
+)
+
+
+def table_name(identifier):
+    """db.table 或 table 中的表名"""
+    return identifier.replace("`", "").replace('"', "").split(".")[-1]
+
+
+def is_versioned(identifier):
+    return table_name(identifier) in VERSIONED_TABLES
+
+
+def references_versioned(sql):
+    """SQL中是否引用了版本表，只有这些查询需要FINAL"""
+    return _VERSIONED_TABLE_RE.search(sql) is not None
+
+
+def _split_top_level(text, sep=","):
+    """按顶层的分隔符拆分，忽略引号和括号内的分隔符"""
+    parts, depth, quote, start, i = [], 0, None, 0, 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == "\\":
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in "'\"`":
+            quote = ch
+        elif ch == "(":
+            depth += 1
+        elif ch == ")":
+            depth -= 1
+        elif ch == sep and depth == 0:
+            parts.append(text[start:i])
+            start = i + 1
+        i += 1
+    parts.append(text[start:])
+    return [part.strip() for part in parts if part.strip()]
+
+
+def update_sql(identifier, assignments, where):
+    """
+    生成追加新版本的INSERT语句
+
+    Args:
+        identifier: 表名，可带库名
+        assignments: {字段: SQL表达式}，表达式中可引用该行当前的字段值，如 count_firing + 1
+        where: 选择要修改的行的条件
+    """
+    replace = ", ".join(f"{expr} AS `{column}`" for column, expr in assignments.items())
+    # 条件中的字段名使用原字段值，而不是REPLACE中同名的新值
+    return (
+        f"INSERT INTO {identifier} SELECT * REPLACE ({replace}) FROM {identifier} FINAL WHERE {where} "
+        "SETTINGS prefer_column_name_to_alias = 1"
+    )
+
+
+def rewrite_alter_update(sql):
+    """
+    把对版本表的 ALTER TABLE ... UPDATE ... WHERE ... 改写为追加新版本的INSERT
+    不是版本表或无法解析时返回None
+    """
+    match = _ALTER_UPDATE_RE.match(sql)
+    if not match or not is_versioned(match.group("table")):
+        return None
+    assignments = {}
+    for item in _split_top_level(match.group("assignments")):
+        column, sep, expr = item.partition("=")
+        if not sep or not expr.strip():
+            return None
+        assignments[column.strip().strip("`\"")] = expr.strip()
+    return update_sql(match.group("table"), assignments, match.group("where"))
@@ -0,0 +1,170 @@
+"""
+master与agent之间WebSocket消息的编解码
+
+agent通过 /ws?codec=<name> 选择编码，name格式为 <base>[+deflate]:
+- base: json(文本帧) 或 msgpack(二进制帧，需要安装msgpack)
+- +deflate: 启用WebSocket permessage-deflate压缩
+未携带codec参数的旧agent使用json，不压缩。
+master在连接建立后先用JSON文本帧回复 {"type": "codec", "codec": "<协商结果>"}，
+agent收到后才切换发送编码，因此新agent连接旧master时会一直使用json。
+纯文本的Pod日志行始终以文本帧传输，与编码无关。
+"""
+
+import json
+from aiohttp import WSMsgType
+from loguru import logger
+
+try:
+    import msgpack
+except ImportError:  # msgpack为可选依赖，缺失时只提供json
+    msgpack = None
+
+DEFAULT_CODEC = "json"
+
+
+class JsonCodec:
+    name = "json"
+    binary = False
+
+    def encode(self, data):
+        return json.dumps(data)
+
+    def decode(self, payload):
+        return json.loads(payload)
+
+
+class MsgpackCodec:
+    name = "msgpack"
+    binary = True
+
+    def encode(self, data):
+        return msgpack.packb(data, use_bin_type=True, default=str)
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload, raw=False)
+
+
+CODECS = {"json": JsonCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgpackCodec()
+
+
+def negotiate(requested):
+    """解析agent请求的编码，返回 (codec, deflate, 协商后的名称)，不支持的编码回退为json"""
+    base, _, option = (requested or DEFAULT_CODEC).lower().partition("+")
+    codec = CODECS.get(base)
+    if codec is None:
+        logger.warning(f"不支持的WebSocket编码 {requested}，回退为 {DEFAULT_CODEC}")
+        codec = CODECS[DEFAULT_CODEC]
+    deflate = option == "deflate"
+    name = f"{codec.name}+deflate" if deflate else codec.name
+    return codec, deflate, name
+
+
+class CodecWebSocket:
+    """按协商编码收发消息的WebSocket包装，send_json/send_str与原WebSocket用法一致"""
+
+    def __init__(self, ws, codec):
+        self.ws = ws
+        self.codec = codec
+
+    @property
+    def closed(self):
+        return self.ws.closed
+
+    async def send_json(self, data):
+        payload = self.codec.encode(data)
+        if self.codec.binary:
+            await self.ws.send_bytes(payload)
+        else:
+            await self.ws.send_str(payload)
+
+    async def send_str(self, data):
+        await self.ws.send_str(data)
+
+    async def close(self, *args, **kwargs):
+        return await self.ws.close(*args, **kwargs)
+
+    def decode(self, msg):
+        """解码收到的消息帧，文本帧按JSON解析，二进制帧按协商编码解析，解析失败抛出ValueError"""
+        if msg.type == WSMsgType.BINARY:
+            return self.codec.decode(msg.data)
+        return json.loads(msg.data)
+
+
+def _benchmark():
+    """对比各编码在典型负载上的帧大小与编解码耗时: python3 func_manager/ws_codec.py"""
+    import time
+    import zlib
+
+    pods = [
+        {
+            "name": f"order-service-{i // 3}-7d9f8c6b5d-{i:05d}",
+            "namespace": f"ns-{i % 40}",
+            "status": "Running",
+            "ready": True,
+            "restart_count": i % 7,
+            "node": f"10.0.{i % 250}.{i % 200}",
+            "pod_ip": f"172.16.{i % 250}.{i % 250}",
+            "cpu_usage": round(i * 0.37 % 4, 3),
+            "mem_usage": i * 13 % 8192,
+            "created": "2025-08-28 11:16:47",
+            "containers": [{"name": "app", "image": f"registry.example.com/app/order:{i % 50}", "ready": True}],
+        }
+        for i in range(10000)
+    ]
+    events = [
+        {
+            "type": "k8s_event",
+            "timestamp": "2025-08-28T11:16:47.123456",
+            "data": {
+                "eventUid": f"3f9a{i:08x}-1b2c-4d5e-8f90-a1b2c3d4e5f6",
+                "eventStatus": "MODIFIED",
+                "level": "Warning",
+                "count": i % 100,
+                "kind": "Pod",
+                "k8s": "prod-cluster",
+                "namespace": f"ns-{i % 40}",
+                "name": f"order-service-7d9f8c6b5d-{i:05d}",
+                "reason": "BackOff",
+                "message": "Back-off restarting failed container app in pod order-service",
+                "firstTimestamp": "2025-08-28T11:16:47Z",
+                "lastTimestamp": "2025-08-28T11:20:47Z",
+                "reportingComponent": "kubelet",
+                "reportingInstance": f"10.0.{i % 250}.{i % 200}",
+            },
+        }
+        for i in range(5000)
+    ]
+    payloads = {
+        "pod_list(10000)": [{"type": "response", "request_id": "x", "response": {"success": True, "data": pods}}],
+        "events(5000)": events,
+    }
+    for payload_name, messages in payloads.items():
+        print(f"== {payload_name}")
+        for codec in CODECS.values():
+            begin = time.perf_counter()
+            frames = [codec.encode(m) for m in messages]
+            encode_cost = time.perf_counter() - begin
+            begin = time.perf_counter()
+            for frame in frames:
+                codec.decode(frame)
+            decode_cost = time.perf_counter() - begin
+            raw = [f.encode("utf-8") if isinstance(f, str) else f for f in frames]
+            size = sum(len(f) for f in raw)
+            # 与permessage-deflate相同的raw deflate，每帧独立压缩
+            begin = time.perf_counter()
+            deflated = 0
+            for f in raw:
+                compressor = zlib.compressobj(6, zlib.DEFLATED, -15)
+                deflated += len(compressor.compress(f) + compressor.flush())
+            deflate_cost = time.perf_counter() - begin
+            print(
+                f"{codec.name:8} size={size / 1024:10.1f}KB deflate={deflated / 1024:9.1f}KB "
+                f"encode={encode_cost * 1000:8.1f}ms decode={decode_cost * 1000:8.1f}ms "
+                f"deflate={deflate_cost * 1000:8.1f}ms"
+            )
+
+
+if __name__ == "__main__":
+    _benchmark()
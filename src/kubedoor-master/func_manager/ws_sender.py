@@ -0,0 +1,132 @@
+"""
+WebSocket发送队列
+
+每个连接一个写协程，按优先级从有界队列中取消息发送，避免多个协程直接并发写同一个socket:
+- PRIORITY_CONTROL: 心跳、admis请求与回复等控制消息，总是最先发送
+- PRIORITY_REQUEST: master转发给agent的请求及agent的响应
+- PRIORITY_BULK: K8s事件、Pod日志等大流量消息
+队列满时send_json/send_str会等待(背压)，send_nowait直接丢弃并计数。
+发送失败时关闭WebSocket(接收循环随之结束)，之后的send_json/send_str抛出ConnectionResetError，
+send_nowait返回False，调用方据此感知连接已断开。
+
+kubedoor-master和kubedoor-agent分别打包，各有一份本文件，两份需保持完全一致。
+"""
+
+import asyncio
+import os
+from loguru import logger
+
+PRIORITY_CONTROL = 0
+PRIORITY_REQUEST = 1
+PRIORITY_BULK = 2
+PRIORITY_NAMES = ("control", "request", "bulk")
+
+SEND_QUEUE_SIZE = int(os.environ.get('WS_SEND_QUEUE_SIZE', '1000'))
+
+
+class PrioritySender:
+    """包装WebSocket，send_json/send_str进入优先级队列，由写协程顺序发送，其它属性透传给原WebSocket"""
+
+    def __init__(self, ws, name, maxsize=SEND_QUEUE_SIZE):
+        self.ws = ws
+        self.name = name
+        self._queues = [asyncio.Queue(maxsize) for _ in PRIORITY_NAMES]
+        self._ready = asyncio.Semaphore(0)
+        self.sent = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        # 写协程发送失败的异常，不为None时连接已不可用
+        self.error = None
+        self._writer_task = asyncio.create_task(self._writer())
+
+    def __getattr__(self, item):
+        return getattr(self.ws, item)
+
+    def __aiter__(self):
+        return self.ws.__aiter__()
+
+    def _check(self):
+        if self.error is not None:
+            raise ConnectionResetError(f"[{self.name}] WebSocket已断开: {self.error}")
+
+    async def _put(self, priority, item):
+        self._check()
+        await self._queues[priority].put(item)
+        # 等待队列空间期间写协程可能已失败
+        self._check()
+        self._ready.release()
+        self.max_depth = max(self.max_depth, self.depth())
+
+    async def send_json(self, data, priority=PRIORITY_REQUEST):
+        await self._put(priority, ("json", data))
+
+    async def send_str(self, data, priority=PRIORITY_BULK):
+        await self._put(priority, ("str", data))
+
+    def send_nowait(self, data, priority=PRIORITY_BULK):
+        """不等待的发送，队列满或连接已断开时丢弃消息，返回是否入队"""
+        if self.error is not None:
+            self.dropped += 1
+            return False
+        try:
+            self._queues[priority].put_nowait(("str" if isinstance(data, str) else "json", data))
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return False
+        self._ready.release()
+        self.max_depth = max(self.max_depth, self.depth())
+        return True
+
+    async def _writer(self):
+        while True:
+            await self._ready.acquire()
+            queue = next(q for q in self._queues if not q.empty())
+            kind, data = queue.get_nowait()
+            try:
+                if kind == "json":
+                    await self.ws.send_json(data)
+                else:
+                    await self.ws.send_str(data)
+                self.sent += 1
+            except Exception as e:
+                self.errors += 1
+                self.error = e
+                logger.error(f"[{self.name}] WebSocket发送失败，关闭连接: {e}")
+                await self._fail()
+                return
+
+    async def _fail(self):
+        """写协程失败后丢弃未发送的消息(唤醒等待队列空间的发送方)，并关闭WebSocket"""
+        for queue in self._queues:
+            while not queue.empty():
+                queue.get_nowait()
+                self.dropped += 1
+        try:
+            await self.ws.close()
+        except Exception as e:
+            logger.warning(f"[{self.name}] 关闭WebSocket失败: {e}")
+
+    def depth(self):
+        return sum(q.qsize() for q in self._queues)
+
+    def metrics(self):
+        return {
+            "depth": {name: q.qsize() for name, q in zip(PRIORITY_NAMES, self._queues)},
+            "max_depth": self.max_depth,
+            "maxsize": self._queues[0].maxsize,
+            "sent": self.sent,
+            "dropped": self.dropped,
+            "errors": self.errors,
+            "error": self.error and str(self.error),
+        }
+
+    async def stop(self):
+        """停止写协程，未发送的消息被丢弃(不关闭WebSocket本身)"""
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        if self.depth():
+            logger.warning(f"[{self.name}] 连接关闭，丢弃 {self.depth()} 条未发送消息")
@@ -15,6 +15,7 @@ from .event_processor import (
 )
 from .alert_rule_matcher import AlertRuleMatcher
 from .event_alert_processor import EventAlertProcessor
+from .event_batch_writer import EventBatchWriter, get_event_writer, stop_event_writer
 
 __all__ = [
     'ClickHouseClient',
@@ -27,6 +28,9 @@ __all__ = [
     'get_alert_stats',
     'AlertRuleMatcher',
     'EventAlertProcessor',
+    'EventBatchWriter',
+    'get_event_writer',
+    'stop_event_writer',
 ]
 
 __version__ = '1.0.0'
@@ -7,10 +7,17 @@ ClickHouse客户端模块
 
 import os
 import re
+import time
 from typing import Dict, List, Optional, Any, Tuple
 from datetime import datetime
 from loguru import logger
 from .connection_pool import get_connection_pool
+from .event_batch_writer import EVENT_COLUMNS, to_columns
+
+
+# 迁移表结构时，交换后复制原表新增数据的检查次数和间隔
+MIGRATE_DELTA_ROUNDS = 3
+MIGRATE_DELTA_WAIT_SECONDS = 1
 
 
 class ClickHouseClient:
@@ -87,6 +94,106 @@ class ClickHouseClient:
         )
         return bool(result and result[0][0] > 0)
 
+    def table_layout(self, database: str, table: str) -> Optional[Tuple[str, str]]:
+        """表的引擎和分区键"""
+        result = self.pool.execute_query(
+            "SELECT engine, partition_key FROM system.tables WHERE database = %s AND name = %s",
+            [database, table],
+        )
+        return tuple(result[0]) if result else None
+
+    @staticmethod
+    def _normalize_expr(expr: Optional[str]) -> str:
+        """去掉空白、反引号和最外层括号，用于比较建表语句与system.tables中的表达式"""
+        expr = re.sub(r"[\s`]+", "", expr or "")
+        while expr.startswith("(") and expr.endswith(")"):
+            depth = 0
+            for i, ch in enumerate(expr):
+                depth += {"(": 1, ")": -1}.get(ch, 0)
+                if depth == 0 and i < len(expr) - 1:
+                    return expr
+            expr = expr[1:-1]
+        return expr
+
+    def _statement_layout(self, statement: str) -> Tuple[Optional[str], str]:
+        """建表语句中的引擎名和分区键"""
+        engine = re.search(r"engine\s*=\s*(\w+)", statement, re.IGNORECASE)
+        partition = re.search(r"partition\s+by\s+(.+)", statement, re.IGNORECASE)
+        return (
+            engine.group(1) if engine else None,
+            self._normalize_expr(partition.group(1)) if partition else "",
+        )
+
+    def migrate_table_layout(self, database: str, table: str, statement: str) -> None:
+        """
+        已存在的表与建表语句的引擎或分区键不一致时迁移数据
+
+        如MergeTree改为ReplacingMergeTree(ver)的版本表、按月分区改为按天分区的表: 按新的建表语句创建临时表，
+        复制数据后与原表交换(EXCHANGE TABLES为原子操作)，原表数据保留在 {table}_bak_{时间} 中，确认无误后可手动删除
+
+        迁移期间写入方(agent事件、告警、页面修改)不停止: 复制前停止原表的合并并记录已有的part，只复制这些part；
+        交换后把复制期间原表新增的part再复制到新表，直到没有新的part
+        """
+        engine, partition = self._statement_layout(statement)
+        current = self.table_layout(database, table)
+        if not engine or not current:
+            return
+        current_engine, current_partition = current[0], self._normalize_expr(current[1])
+        if engine == current_engine and partition == current_partition:
+            return
+
+        tmp_table = f"{table}__migrate"
+        backup_table = f"{table}_bak_{datetime.now().strftime('%Y%m%d%H%M%S')}"
+        logger.warning(
+            f"表 {database}.{table} 引擎/分区为 {current_engine}/{current_partition or '无'}，"
+            f"迁移为 {engine}/{partition or '无'}"
+        )
+        create_sql = re.sub(
+            r"(create\s+table\s+(?:if\s+not\s+exists\s+)?)[`\"\w\.]+",
+            lambda m: f"{m.group(1)}{database}.{tmp_table}",
+            statement,
+            count=1,
+            flags=re.IGNORECASE,
+        )
+        self.pool.execute_command(f"DROP TABLE IF EXISTS {database}.{tmp_table}")
+        self.pool.execute_command(create_sql)
+        # 停止合并后part名称不变，新写入的数据只会出现在新的part中
+        self.pool.execute_command(f"SYSTEM STOP MERGES {database}.{table}")
+        try:
+            copied = self._active_parts(database, table)
+            self._copy_parts(database, table, tmp_table, copied)
+            self.pool.execute_command(f"EXCHANGE TABLES {database}.{table} AND {database}.{tmp_table}")
+            # 交换后原表在tmp_table中，复制交换前写入原表的数据；交换时正在进行的写入稍后才出现，重复检查几次
+            for _ in range(MIGRATE_DELTA_ROUNDS):
+                delta = self._active_parts(database, tmp_table) - copied
+                if delta:
+                    logger.warning(f"表 {database}.{table} 迁移期间新写入 {len(delta)} 个part，复制到新表")
+                    self._copy_parts(database, tmp_table, table, delta)
+                    copied |= delta
+                time.sleep(MIGRATE_DELTA_WAIT_SECONDS)
+        finally:
+            self.pool.execute_command(f"SYSTEM START MERGES {database}.{tmp_table}")
+            self.pool.execute_command(f"SYSTEM START MERGES {database}.{table}")
+        self.pool.execute_command(f"RENAME TABLE {database}.{tmp_table} TO {database}.{backup_table}")
+        logger.warning(f"表 {database}.{table} 已迁移，原数据保留在 {database}.{backup_table}")
+
+    def _active_parts(self, database: str, table: str) -> set:
+        result = self.pool.execute_query(
+            "SELECT name FROM system.parts WHERE database = %s AND table = %s AND active",
+            [database, table],
+        )
+        return {row[0] for row in result}
+
+    def _copy_parts(self, database: str, source: str, target: str, parts: set) -> None:
+        if not parts:
+            return
+        # SELECT * 不包含物化列，新表的ver在插入时生成；按天分区时一次插入会涉及很多分区
+        self.pool.execute_command(
+            f"INSERT INTO {database}.{target} SELECT * FROM {database}.{source} WHERE _part IN %(parts)s "
+            "SETTINGS max_partitions_per_insert_block = 0",
+            {"parts": tuple(sorted(parts))},
+        )
+
     def init_table(self) -> None:
         """初始化K8S事件表"""
         sql_file = os.path.join(os.path.dirname(os.path.dirname(__file__)), 'create_table.sql')
@@ -125,6 +232,7 @@ class ClickHouseClient:
                 raise RuntimeError(f"表 {db_name}.{table_name} 初始化失败")
             if existed:
                 logger.info(f"表 {db_name}.{table_name} 已存在")
+                self.migrate_table_layout(db_name, table_name, stmt)
             else:
                 logger.info(f"表 {db_name}.{table_name} 创建成功")
 
@@ -145,46 +253,7 @@ class ClickHouseClient:
             event_data: 事件数据字典
         """
         try:
-            # 准备插入数据 - 使用clickhouse-connect的insert方法
-            with self.pool.get_client() as client:
-                client.insert(
-                    'k8s_events',
-                    [
-                        [
-                            event_data.get('eventUid', ''),
-                            event_data.get('eventStatus', ''),
-                            event_data.get('level', ''),
-                            event_data.get('count', 0),
-                            event_data.get('kind', ''),
-                            event_data.get('k8s', ''),
-                            event_data.get('namespace', ''),
-                            event_data.get('name', ''),
-                            event_data.get('reason', ''),
-                            event_data.get('message', ''),
-                            event_data.get('firstTimestamp'),
-                            event_data.get('lastTimestamp'),
-                            event_data.get('reportingComponent', ''),
-                            event_data.get('reportingInstance', ''),
-                        ]
-                    ],
-                    column_names=[
-                        'eventUid',
-                        'eventStatus',
-                        'level',
-                        'count',
-                        'kind',
-                        'k8s',
-                        'namespace',
-                        'name',
-                        'reason',
-                        'message',
-                        'firstTimestamp',
-                        'lastTimestamp',
-                        'reportingComponent',
-                        'reportingInstance',
-                    ],
-                )
-
+            self.insert_events(to_columns([event_data]), EVENT_COLUMNS)
             logger.debug(f"已更新事件: {event_data.get('eventUid')} 在命名空间 {event_data.get('namespace')}")
 
         except Exception as e:
@@ -192,6 +261,17 @@ class ClickHouseClient:
             logger.error(f"事件数据: {event_data}")
             raise
 
+    def insert_events(self, columns: List[List[Any]], column_names: List[str]) -> None:
+        """
+        按列批量写入K8S事件
+
+        Args:
+            columns: 列数据，顺序与column_names一致
+            column_names: 列名
+        """
+        with self.pool.get_client() as client:
+            client.insert('k8s_events', columns, column_names=column_names, column_oriented=True)
+
     def query_events_advanced(
         self,
         k8s: str,
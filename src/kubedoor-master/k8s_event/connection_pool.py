@@ -4,14 +4,26 @@
 ClickHouse连接池管理器
 使用clickhouse-connect库提供线程安全的连接池
 解决"Simultaneous queries on single connection detected"问题
+
+连接在使用后归还到池中复用，同一时刻一个连接只被一个线程使用。
+运行本文件可对比"每次查询新建连接"与连接池的耗时，需要可访问的ClickHouse:
+    docker run -d -p 8123:8123 clickhouse/clickhouse-server
+    CK_HOST=127.0.0.1 CK_HTTP_PORT=8123 python3 -m k8s_event.connection_pool
 """
 
 import os
 import threading
+import time
+from collections import deque
 from typing import Optional, Any, Dict, List
 from contextlib import contextmanager
 from loguru import logger
 import clickhouse_connect
+from clickhouse_connect.driver.exceptions import OperationalError
+
+
+class PoolTimeoutError(TimeoutError):
+    """在acquire_timeout内没有可用连接"""
 
 
 class ClickHouseConnectionPool:
@@ -19,10 +31,11 @@ class ClickHouseConnectionPool:
     ClickHouse连接池管理器
 
     特性:
-    - 线程安全的连接池
-    - 自动连接管理和回收
-    - 支持连接超时和重试
-    - 独立于全局连接，避免并发冲突
+    - 线程安全的有界连接池，连接复用
+    - 空闲超时(idle_timeout)和最大存活时间(max_lifetime)到期的连接被关闭
+    - 空闲超过health_check_interval的连接取出时先ping，失败则重建
+    - 获取连接等待超过acquire_timeout抛出PoolTimeoutError
+    - 网络错误的连接不归还到池中
     """
 
     _instance: Optional['ClickHouseConnectionPool'] = None
@@ -52,9 +65,29 @@ class ClickHouseConnectionPool:
         self.pool_size = int(os.environ.get('CK_POOL_SIZE', '10'))  # 最大连接数
         self.connect_timeout = int(os.environ.get('CK_CONNECT_TIMEOUT', '10'))  # 连接超时
         self.send_receive_timeout = int(os.environ.get('CK_QUERY_TIMEOUT', '300'))  # 查询超时
+        self.acquire_timeout = float(os.environ.get('CK_POOL_ACQUIRE_TIMEOUT', '10'))  # 等待空闲连接的超时
+        self.idle_timeout = float(os.environ.get('CK_POOL_IDLE_TIMEOUT', '300'))  # 空闲连接保留时间
+        self.max_lifetime = float(os.environ.get('CK_POOL_MAX_LIFETIME', '3600'))  # 连接最长使用时间
+        self.health_check_interval = float(os.environ.get('CK_POOL_HEALTH_CHECK_INTERVAL', '30'))
 
-        # 连接池状态
+        # 连接池状态: 空闲连接 (client, 最近归还时间)，最近归还的在右侧；等待连接的线程按顺序排队
         self._pool_lock = threading.Lock()
+        self._idle = deque()
+        self._waiters = deque()
+        self._size = 0  # 已创建且未关闭的连接数(空闲 + 使用中)
+        self._created_at = {}
+        self.stats = {
+            "created": 0,
+            "closed": 0,
+            "acquired": 0,
+            "waits": 0,
+            "wait_seconds": 0.0,
+            "timeouts": 0,
+            "evicted_idle": 0,
+            "evicted_lifetime": 0,
+            "health_check_failed": 0,
+            "broken": 0,
+        }
         self._initialized = True
 
         logger.info(
@@ -87,6 +120,116 @@ class ClickHouseConnectionPool:
             logger.error(f"创建ClickHouse连接失败: {e}")
             raise
 
+    def _close_client(self, client):
+        """关闭连接，调用方需已将其从计数中扣除"""
+        self._created_at.pop(id(client), None)
+        self.stats["closed"] += 1
+        try:
+            client.close()
+        except Exception as e:
+            logger.warning(f"关闭连接时出错: {e}")
+
+    def _expired(self, client, now):
+        return now - self._created_at.get(id(client), now) > self.max_lifetime
+
+    def _evict_idle_locked(self, now):
+        """在持有锁时取出过期的空闲连接，返回需要关闭的连接"""
+        evicted = []
+        kept = deque()
+        for client, returned_at in self._idle:
+            if now - returned_at > self.idle_timeout:
+                self.stats["evicted_idle"] += 1
+                evicted.append(client)
+            elif self._expired(client, now):
+                self.stats["evicted_lifetime"] += 1
+                evicted.append(client)
+            else:
+                kept.append((client, returned_at))
+        self._idle = kept
+        self._size -= len(evicted)
+        return evicted
+
+    def _acquire(self):
+        now = time.time()
+        waiter = None
+        with self._pool_lock:
+            evicted = self._evict_idle_locked(now)
+            if self._idle and not self._waiters:
+                client, returned_at = self._idle.pop()
+                action = "reuse"
+            elif self._size < self.pool_size:
+                self._size += 1
+                client, returned_at = None, None
+                action = "create"
+            else:
+                # 按先来后到排队，归还的连接直接交给队首的等待者
+                waiter = {"event": threading.Event(), "action": None, "client": None, "returned_at": None}
+                self._waiters.append(waiter)
+        for old in evicted:
+            self._close_client(old)
+
+        if waiter is not None:
+            wait_begin = time.monotonic()
+            waiter["event"].wait(self.acquire_timeout)
+            with self._pool_lock:
+                if waiter["action"] is None:
+                    self._waiters.remove(waiter)
+                    self.stats["timeouts"] += 1
+                    raise PoolTimeoutError(f"{self.acquire_timeout}秒内没有可用的ClickHouse连接")
+            self.stats["waits"] += 1
+            self.stats["wait_seconds"] += time.monotonic() - wait_begin
+            action, client, returned_at = waiter["action"], waiter["client"], waiter["returned_at"]
+
+        if action == "create":
+            try:
+                client = self._create_client()
+            except Exception:
+                self._discard(None)
+                raise
+            self._created_at[id(client)] = time.time()
+            self.stats["created"] += 1
+        elif time.time() - returned_at > self.health_check_interval and not self._ping(client):
+            # 空闲较久的连接先检查可用性，不可用则关闭后重新获取
+            self.stats["health_check_failed"] += 1
+            self._discard(client)
+            return self._acquire()
+
+        self.stats["acquired"] += 1
+        return client
+
+    @staticmethod
+    def _ping(client):
+        try:
+            return bool(client.ping())
+        except Exception:
+            return False
+
+    def _discard(self, client):
+        """关闭连接并释放名额，有等待者时让队首的等待者新建连接"""
+        with self._pool_lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter["action"] = "create"
+                waiter["event"].set()
+            else:
+                self._size -= 1
+        if client is not None:
+            self._close_client(client)
+
+    def _release(self, client):
+        now = time.time()
+        if self._expired(client, now):
+            self.stats["evicted_lifetime"] += 1
+            self._discard(client)
+            return
+        with self._pool_lock:
+            if self._waiters:
+                waiter = self._waiters.popleft()
+                waiter.update(action="reuse", client=client, returned_at=now)
+                waiter["event"].set()
+            else:
+                self._idle.append((client, now))
+
     @contextmanager
     def get_client(self):
         """
@@ -96,20 +239,24 @@ class ClickHouseConnectionPool:
         with pool.get_client() as client:
             result = client.query("SELECT 1")
         """
-        client = None
+        client = self._acquire()
+        broken = False
         try:
-            client = self._create_client()
             yield client
+        except OperationalError as e:
+            # 网络类错误的连接不再复用
+            broken = True
+            self.stats["broken"] += 1
+            logger.error(f"连接池操作失败: {e}")
+            raise
         except Exception as e:
             logger.error(f"连接池操作失败: {e}")
             raise
         finally:
-            if client:
-                try:
-                    client.close()
-                    logger.debug(f"连接已关闭 - Thread: {threading.current_thread().name}")
-                except Exception as e:
-                    logger.warning(f"关闭连接时出错: {e}")
+            if broken:
+                self._discard(client)
+            else:
+                self._release(client)
 
     def execute_query(self, query: str, parameters=None) -> List[Any]:
         """
@@ -126,11 +273,7 @@ class ClickHouseConnectionPool:
             try:
                 if parameters:
                     # 支持Dict和List两种参数格式
-                    if isinstance(parameters, dict):
-                        result = client.query(query, parameters=parameters)
-                    else:
-                        # List格式参数
-                        result = client.query(query, parameters=parameters)
+                    result = client.query(query, parameters=parameters)
                 else:
                     result = client.query(query)
 
@@ -166,6 +309,33 @@ class ClickHouseConnectionPool:
                 logger.error(f"执行命令失败 - Command: {command[:100]}..., Error: {e}")
                 raise
 
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        连接池使用情况
+
+        Returns:
+            包含连接数、空闲数、使用中数量和累计计数的字典
+        """
+        with self._pool_lock:
+            size, idle = self._size, len(self._idle)
+        return {
+            "pool_size": self.pool_size,
+            "size": size,
+            "idle": idle,
+            "in_use": size - idle,
+            "utilization": round((size - idle) / self.pool_size, 3) if self.pool_size else 0,
+            **self.stats,
+        }
+
+    def close(self):
+        """关闭所有空闲连接，使用中的连接归还后按过期处理"""
+        with self._pool_lock:
+            idle = [client for client, _ in self._idle]
+            self._idle.clear()
+            self._size -= len(idle)
+        for client in idle:
+            self._close_client(client)
+
 
 # 全局连接池实例
 _connection_pool: Optional[ClickHouseConnectionPool] = None
@@ -187,3 +357,34 @@ def get_connection_pool() -> ClickHouseConnectionPool:
                 _connection_pool = ClickHouseConnectionPool()
 
     return _connection_pool
+
+
+def _benchmark(total=500, concurrency=8, query="SELECT 1"):
+    """对比每次新建连接(原实现)与连接池的查询耗时"""
+    from concurrent.futures import ThreadPoolExecutor
+
+    pool = get_connection_pool()
+
+    def per_query_client():
+        client = pool._create_client()
+        try:
+            client.query(query)
+        finally:
+            client.close()
+
+    def pooled():
+        pool.execute_query(query)
+
+    for name, func in (("每次新建连接", per_query_client), ("连接池", pooled)):
+        begin = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            for future in [executor.submit(func) for _ in range(total)]:
+                future.result()
+        cost = time.perf_counter() - begin
+        print(f"{name:8} {total} 次查询, 并发 {concurrency}: 总耗时 {cost:.2f}s, 平均 {cost / total * 1000:.2f}ms, QPS {total / cost:.0f}")
+    print(f"连接池状态: {pool.get_stats()}")
+    pool.close()
+
+
+if __name__ == "__main__":
+    _benchmark()
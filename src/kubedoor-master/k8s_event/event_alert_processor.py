@@ -10,7 +10,6 @@ from typing import Dict, List, Any, Optional
 from datetime import datetime
 from loguru import logger
 from .alert_rule_matcher import AlertRuleMatcher
-from .clickhouse_client import get_clickhouse_client
 from utils import send_msg, ALERT_DEDUP_WINDOW
 
 
@@ -67,19 +66,9 @@ class EventAlertProcessor:
             if alert_result:
                 self.stats['matched_events'] += 1
                 event_uid = event.get('eventUid')
-                # 更新数据库中对应eventUid的level字段为"已告警"
-                try:
-                    clickhouse_client = get_clickhouse_client()
-                    # 使用ALTER UPDATE语句更新level字段
-                    update_sql = """
-                    ALTER TABLE k8s_events 
-                    UPDATE level = '已告警' 
-                    WHERE eventUid = %s
-                    """
-                    clickhouse_client.pool.execute_query(update_sql, [event_uid])
-                    logger.info(f"已更新eventUid {event_uid} 的level字段为'已告警'")
-                except Exception as update_e:
-                    logger.error(f"更新level字段失败: {update_e}")
+                # 事件在告警匹配之后才进入批量写入缓冲区，直接把level写成"已告警"，
+                # ReplacingMergeTree按lastTimestamp保留该版本，不再需要ALTER UPDATE
+                event['level'] = '已告警'
 
                 # 检查告警去重
                 if self._should_skip_alert(event_uid):
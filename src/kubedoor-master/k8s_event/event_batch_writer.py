@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+K8S事件批量写入器
+所有agent上报的事件先进入内存缓冲区，按条数或时间间隔批量列式写入ClickHouse，
+避免事件风暴时大量单行INSERT导致ReplacingMergeTree产生过多part
+"""
+
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+from loguru import logger
+
+EVENT_COLUMNS = [
+    'eventUid',
+    'eventStatus',
+    'level',
+    'count',
+    'kind',
+    'k8s',
+    'namespace',
+    'name',
+    'reason',
+    'message',
+    'firstTimestamp',
+    'lastTimestamp',
+    'reportingComponent',
+    'reportingInstance',
+]
+_COLUMN_DEFAULTS = {'count': 0, 'firstTimestamp': None, 'lastTimestamp': None}
+
+
+def to_columns(events: List[Dict[str, Any]]) -> List[List[Any]]:
+    """把事件字典列表转换为按EVENT_COLUMNS排列的列数据"""
+    return [[event.get(column, _COLUMN_DEFAULTS.get(column, '')) for event in events] for column in EVENT_COLUMNS]
+
+
+class EventBatchWriter:
+    """
+    线程安全的事件批量写入器
+
+    特性:
+    - 同一eventUid在缓冲区内只保留lastTimestamp最新的一条(与ReplacingMergeTree的合并结果一致)
+    - 缓冲达到batch_size条或距上次写入超过flush_interval秒时写入
+    - 写入失败按指数退避重试max_retries次，仍失败的事件放回缓冲区
+    - 缓冲区最多max_buffer条，超出时丢弃最早的事件并计数，内存有上限
+    - stop()时写入剩余事件
+    """
+
+    def __init__(
+        self,
+        insert_func: Callable[[List[List[Any]], List[str]], None],
+        batch_size: int = 5000,
+        flush_interval: float = 1.0,
+        max_buffer: int = 100000,
+        max_retries: int = 3,
+        retry_backoff: float = 0.5,
+    ):
+        """
+        Args:
+            insert_func: 写入函数，参数为(列数据, 列名)
+            batch_size: 触发写入的缓冲条数
+            flush_interval: 最长写入间隔(秒)
+            max_buffer: 缓冲区最大条数
+            max_retries: 单批写入失败后的重试次数
+            retry_backoff: 首次重试等待时间(秒)，之后每次翻倍
+        """
+        self._insert = insert_func
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.max_retries = max_retries
+        self.retry_backoff = retry_backoff
+
+        self._buffer: 'OrderedDict[str, Dict[str, Any]]' = OrderedDict()
+        self._lock = threading.Lock()
+        # 同一时间只有一个线程在写入，保证同一eventUid的写入顺序
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self.stats = {
+            'received': 0,
+            'merged': 0,
+            'written': 0,
+            'batches': 0,
+            'retries': 0,
+            'failed_batches': 0,
+            'dropped': 0,
+        }
+
+    def start(self) -> None:
+        """启动后台写入线程"""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name='k8s-event-writer', daemon=True)
+        self._thread.start()
+        logger.info(f"K8S事件批量写入器已启动 - 批量: {self.batch_size}条, 间隔: {self.flush_interval}秒")
+
+    def add(self, event: Dict[str, Any]) -> None:
+        """
+        添加一条事件到缓冲区，不等待写入
+
+        Args:
+            event: 处理后的事件数据
+        """
+        with self._lock:
+            self.stats['received'] += 1
+            self._put_locked(event)
+            full = len(self._buffer) >= self.batch_size
+        if full:
+            self._wakeup.set()
+
+    def _put_locked(self, event: Dict[str, Any]) -> None:
+        uid = event.get('eventUid')
+        current = self._buffer.get(uid)
+        if current is not None:
+            self.stats['merged'] += 1
+            if current.get('lastTimestamp') and event.get('lastTimestamp') and event['lastTimestamp'] < current['lastTimestamp']:
+                return
+            self._buffer.move_to_end(uid)
+        self._buffer[uid] = event
+        while len(self._buffer) > self.max_buffer:
+            self._buffer.popitem(last=False)
+            self.stats['dropped'] += 1
+
+    def flush(self) -> int:
+        """
+        立即写入缓冲区中的所有事件
+
+        Returns:
+            写入成功的事件条数
+        """
+        written = 0
+        with self._flush_lock:
+            while True:
+                with self._lock:
+                    if not self._buffer:
+                        break
+                    batch = []
+                    while self._buffer and len(batch) < self.batch_size:
+                        batch.append(self._buffer.popitem(last=False)[1])
+                if not self._write(batch):
+                    self._requeue(batch)
+                    break
+                written += len(batch)
+        return written
+
+    def _write(self, batch: List[Dict[str, Any]]) -> bool:
+        columns = to_columns(batch)
+        delay = self.retry_backoff
+        for attempt in range(self.max_retries + 1):
+            try:
+                begin = time.time()
+                self._insert(columns, EVENT_COLUMNS)
+                self.stats['written'] += len(batch)
+                self.stats['batches'] += 1
+                logger.debug(f"批量写入K8S事件 {len(batch)} 条，耗时 {time.time() - begin:.3f}s")
+                return True
+            except Exception as e:
+                if attempt == self.max_retries or self._stopping.is_set() and attempt > 0:
+                    logger.error(f"批量写入K8S事件失败({len(batch)}条)，已重试{attempt}次: {e}")
+                    self.stats['failed_batches'] += 1
+                    return False
+                self.stats['retries'] += 1
+                logger.warning(f"批量写入K8S事件失败，{delay}秒后重试: {e}")
+                time.sleep(delay)
+                delay *= 2
+        return False
+
+    def _requeue(self, batch: List[Dict[str, Any]]) -> None:
+        """写入失败的事件放回缓冲区头部，缓冲区中已有更新版本的事件不覆盖"""
+        with self._lock:
+            newer = self._buffer
+            self._buffer = OrderedDict((event['eventUid'], event) for event in batch if event['eventUid'] not in newer)
+            self._buffer.update(newer)
+            while len(self._buffer) > self.max_buffer:
+                self._buffer.popitem(last=False)
+                self.stats['dropped'] += 1
+
+    def _run(self) -> None:
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.error(f"K8S事件批量写入线程异常: {e}")
+
+    def stop(self, timeout: float = 10.0) -> None:
+        """停止后台线程并写入剩余事件"""
+        self._stopping.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        written = self.flush()
+        with self._lock:
+            remaining = len(self._buffer)
+        logger.info(f"K8S事件批量写入器已停止 - 最后写入 {written} 条, 未写入 {remaining} 条")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {'buffered': len(self._buffer), **self.stats}
+
+
+# 全局写入器实例
+_event_writer: Optional[EventBatchWriter] = None
+_writer_lock = threading.Lock()
+
+
+def get_event_writer() -> EventBatchWriter:
+    """获取全局事件写入器，首次调用时创建并启动后台线程"""
+    global _event_writer
+    if _event_writer is None:
+        with _writer_lock:
+            if _event_writer is None:
+                from .clickhouse_client import get_clickhouse_client
+
+                writer = EventBatchWriter(
+                    get_clickhouse_client().insert_events,
+                    batch_size=int(os.environ.get('EVENT_BATCH_SIZE', '5000')),
+                    flush_interval=float(os.environ.get('EVENT_FLUSH_INTERVAL', '1')),
+                    max_buffer=int(os.environ.get('EVENT_MAX_BUFFER', '100000')),
+                )
+                writer.start()
+                _event_writer = writer
+    return _event_writer
+
+
+def stop_event_writer() -> None:
+    """程序退出时写入缓冲区中剩余的事件"""
+    if _event_writer is not None:
+        _event_writer.stop()
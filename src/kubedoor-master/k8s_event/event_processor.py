@@ -10,6 +10,7 @@ from datetime import datetime, timezone, timedelta
 from loguru import logger
 from .clickhouse_client import get_clickhouse_client
 from .event_alert_processor import EventAlertProcessor
+from .event_batch_writer import get_event_writer
 
 
 class K8SEventProcessor:
@@ -49,10 +50,7 @@ class K8SEventProcessor:
                 logger.warning("处理事件数据失败")
                 return False
 
-            # 存储到ClickHouse
-            self.clickhouse_client.upsert_event(processed_data)
-
-            # 处理告警规则匹配
+            # 处理告警规则匹配，匹配到的事件会被标记为"已告警"后再写入
             try:
                 # 从事件数据中提取msgToken
                 msg_token = event_data.get('msgToken')
@@ -62,6 +60,9 @@ class K8SEventProcessor:
             except Exception as e:
                 logger.error(f"处理告警规则失败: {e}")
 
+            # 放入批量写入缓冲区，由后台线程写入ClickHouse
+            get_event_writer().add(processed_data)
+
             logger.debug(
                 f"成功处理K8S事件: {processed_data.get('eventUid')} " f"命名空间: {processed_data.get('namespace')}"
             )
@@ -5,17 +5,28 @@ import time
 import base64
 import re
 import aiohttp
-from datetime import datetime, timedelta
+from datetime import datetime
 from aiohttp import web, WSMsgType
 from loguru import logger
 import utils, prom_real_time_data
-from multidict import MultiDict
 from istio_route import istio_route
-from func_manager import namespace_cache
+from func_manager import response_cache
 from func_manager import prom_overview
 from func_manager import ck_top_queries
+from func_manager import agent_rpc
+from func_manager import ws_codec
+from func_manager import session_registry
+from func_manager import ws_sender
+from func_manager import single_flight
+from func_manager import admis_worker
+from func_manager import versioned_tables
+from func_manager import ck_http_proxy
+from func_manager import query_cache
+from func_manager import schema_migrations
+from func_manager import prom_client
+from func_manager import peak_scheduler
 import image_tags_fetcher
-from k8s_event import process_k8s_event_async, init_clickhouse_tables
+from k8s_event import process_k8s_event_async, stop_event_writer
 from k8s_event.event_query_api import query_k8s_events_handler, get_k8s_events_menu_options
 from promql import deployment_node
 
@@ -45,19 +56,6 @@ logger.add(
 )
 
 
-def ensure_clickhouse_schema_initialized():
-    """在程序启动时初始化ClickHouse表结构"""
-    try:
-        init_clickhouse_tables()
-        logger.info("ClickHouse表结构初始化成功")
-    except Exception as exc:
-        logger.error(f"ClickHouse表结构初始化失败: {exc}")
-        sys.exit(1)
-
-
-ensure_clickhouse_schema_initialized()
-
-
 async def get_authorization_header(username, password):
     credentials = f'{username}:{password}'
     encoded_credentials = base64.b64encode(credentials.encode('utf-8')).decode('utf-8')
@@ -81,141 +79,177 @@ async def forward_request(request):
         if data.strip().lower().startswith(('alter')):
             table_name_match = re.search(rf'{re.escape(utils.CK_DATABASE)}\.(\w+)', data)
             table_name = table_name_match.group(1) if table_name_match else None
-            utils.ck_alter(data)
-            utils.ck_optimize(table_name)
+            versioned_sql = versioned_tables.rewrite_alter_update(data)
+            if versioned_sql:
+                # 版本表追加新版本，不产生mutation，也不需要OPTIMIZE
+                logger.info(f'📐改写为追加版本: {versioned_sql}')
+                await utils.ck_alter(versioned_sql)
+            else:
+                await utils.ck_alter(data)
+                await utils.ck_optimize(table_name)
             logger.info("📐SQL: 数据更新完成")
             return web.json_response({"success": True, "msg": "SQL: 数据更新完成"})
         else:
-            TARGET_URL = f'http://{utils.CK_HOST}:{utils.CK_HTTP_PORT}/?add_http_cors_header=1&default_format=JSONCompact'
-            headers = {
-                'Authorization': await get_authorization_header(utils.CK_USER, utils.CK_PASSWORD),
-                'Cache-Control': 'no-cache',
-                'Pragma': 'no-cache',
-                'Content-Type': 'text/plain',
-            }
-            async with aiohttp.ClientSession() as session:
-                async with session.post(TARGET_URL, data=data, headers=headers) as response:
-                    if response.content_type == 'application/json':
-                        response_data = await response.json()
-                    else:
-                        text = await response.text()
-                        response_data = {"msg": text}
-                    logger.info("📐SQL: 数据查询完成")
-                    return web.json_response({"success": True, **response_data})
+            authorization = await get_authorization_header(utils.CK_USER, utils.CK_PASSWORD)
+            return await ck_http_proxy.forward(request, request.app["ck_session"], data, authorization)
+    except ck_http_proxy.StreamAbortedError:
+        # 响应已部分发出，中断连接
+        raise
     except Exception as e:
         logger.error(f"Error in forward_request: {e}")
         return web.json_response({"error": str(e)}, status=500)
 
 
 clients = {}
+# 并发查询多个env时单个agent的默认超时(秒)
+FANOUT_TIMEOUT_SECONDS = 30
 # 存储Pod日志WebSocket连接
 pod_logs_connections = {}
+# 登记agent状态的后台任务，持有引用避免被回收
+_agent_status_tasks = set()
+
+
+async def init_agent_status(env):
+    """表结构初始化完成后登记agent，ClickHouse不可用时只记录日志，不影响agent连接"""
+    try:
+        await schema_migrations.wait_ready()
+        await utils.ck_init_agent_status(env)
+    except Exception as e:
+        logger.error(f"登记agent状态失败，env={env}，错误：{e}")
 
 
 async def websocket_handler(request):
     env = request.query.get("env")
     ver = request.query.get("ver", "unknown")
+    # agent支持的协议扩展，旧agent不带该参数
+    caps = set(filter(None, request.query.get("caps", "").split(",")))
     if not env:
         return web.json_response({"error": "缺少 env 参数"}, status=400)
     if env in clients and clients[env]["online"]:
         return web.json_response({"error": "目标客户端已在线"}, status=409)
-
-    ws = web.WebSocketResponse()
+    # 本次连接的ID，agent重连后旧连接的清理只影响旧连接自己的请求和注册
+    conn_id = agent_rpc.new_conn_id()
+    # 登记到共享注册表，同一个agent只能连接一个master副本
+    if not await session_registry.registry.register(env, ver, conn_id):
+        return web.json_response({"error": "目标客户端已在其它master副本在线"}, status=409)
+
+    # 按agent请求的codec协商消息编码和permessage-deflate压缩，旧agent不带该参数则使用json
+    codec, deflate, codec_name = ws_codec.negotiate(request.query.get("codec"))
+    ws = web.WebSocketResponse(compress=deflate)
     await ws.prepare(request)
+    agent_ws = ws_codec.CodecWebSocket(ws, codec)
+    # 协商结果用JSON文本帧告知agent，agent收到后才切换编码
+    await ws.send_json({"type": "codec", "codec": codec_name})
+    # 所有发往该agent的消息经过有界优先级队列，由单独的写协程发送
+    sender = ws_sender.PrioritySender(agent_ws, f"agent:{env}")
 
-    logger.info(f"客户端连接成功，env={env} ver={ver}")
+    logger.info(f"客户端连接成功，env={env} ver={ver} codec={codec_name}")
     if env not in clients:
         # 如果是新客户端，初始化状态
-        clients[env] = {"ws": ws, "ver": ver, "last_heartbeat": time.time(), "online": True}
-        utils.ck_init_agent_status(env)
+        clients[env] = {
+            "ws": sender,
+            "conn": conn_id,
+            "ver": ver,
+            "codec": codec_name,
+            "caps": caps,
+            "last_heartbeat": time.time(),
+            "online": True,
+        }
+        task = asyncio.create_task(init_agent_status(env))
+        _agent_status_tasks.add(task)
+        task.add_done_callback(_agent_status_tasks.discard)
     else:
         # 如果是重连客户端，更新 WebSocket 和状态
-        clients[env]["ws"] = ws
+        clients[env]["ws"] = sender
+        clients[env]["conn"] = conn_id
         clients[env]["ver"] = ver
+        clients[env]["codec"] = codec_name
+        clients[env]["caps"] = caps
         clients[env]["last_heartbeat"] = time.time()
         clients[env]["online"] = True
 
     try:
         async for msg in ws:
-            if msg.type == WSMsgType.TEXT:
-                # 首先尝试解析为JSON
+            if msg.type in (WSMsgType.TEXT, WSMsgType.BINARY):
+                # 文本帧按JSON解析，二进制帧按协商的编码解析
                 try:
-                    data = json.loads(msg.data)
-                    # 处理JSON格式的消息
-                    if data.get("type") == "heartbeat":
-                        # 更新心跳时间
-                        clients[env]["last_heartbeat"] = time.time()
-                        clients[env]["online"] = True
-                        # logger.info(f"[心跳]客户端 env={env} ver={ver}")
-                    elif data.get("type") == "admis":
-                        request_id = data["request_id"]
-                        namespace = data["namespace"]
-                        deployment = data["deployment"]
-                        logger.info(f"==========客户端 env={env} {request_id} {namespace} {deployment}")
-                        deploy_res = utils.get_deploy_admis(env, namespace, deployment)
-                        await ws.send_json({"type": "admis", "request_id": request_id, "deploy_res": deploy_res})
-
-                    elif data.get("type") == "response":
-                        # 收到客户端的响应，存储到客户端的响应队列中
-                        request_id = data["request_id"]
-                        response = data["response"]
-                        if "response_queue" in clients[env]:
-                            clients[env]["response_queue"][request_id] = response
-                        logger.info(f"[响应]客户端 env={env}: request_id={request_id}：{response}")
-
-                    elif data.get("type") == "pod_logs":
-                        # 处理来自agent的Pod日志数据，转发给前端
-                        connection_id = data.get("connection_id")
-                        if connection_id in pod_logs_connections:
-                            frontend_ws = pod_logs_connections[connection_id]["ws"]
-                            try:
-                                await frontend_ws.send_json(data)
-                            except Exception as e:
-                                logger.error(f"转发日志到前端失败: {e}")
-                                # 清理断开的连接
-                                if connection_id in pod_logs_connections:
-                                    del pod_logs_connections[connection_id]
-                    elif data.get("type") == "k8s_event":
-                        # 处理来自agent的K8S事件消息
-                        logger.debug(f"💯[K8S事件]客户端 env={env}: {data}")
-
-                        # 异步存储K8S事件到ClickHouse，避免阻塞WebSocket消息循环
-                        try:
-                            success = await process_k8s_event_async(data)
-                            if success:
-                                logger.debug(f"K8S事件已成功存储到ClickHouse: {data.get('data', {}).get('eventUid')}")
-                            else:
-                                logger.warning(f"K8S事件存储失败: {data.get('data', {}).get('eventUid')}")
-                        except Exception as e:
-                            logger.error(f"处理K8S事件时发生错误: {e}")
-                    else:
-                        logger.info(f"收到客户端消息：{msg.data}")
-
-                except json.JSONDecodeError:
+                    data = agent_ws.decode(msg)
+                except ValueError:
+                    data = None
+                if not isinstance(data, dict):
                     # 如果不是JSON格式，可能是纯文本日志消息
                     # 需要根据当前活跃的日志连接来转发消息
-                    log_message = msg.data.strip()
+                    log_message = msg.data.strip() if msg.type == WSMsgType.TEXT else ""
                     if log_message:
                         # 转发给所有活跃的前端日志连接
                         for connection_id, connection_info in list(pod_logs_connections.items()):
                             if connection_info["env"] == env:
-                                try:
-                                    await connection_info["ws"].send_str(log_message)
-                                except Exception as e:
-                                    logger.error(f"转发纯文本日志到前端失败: {e}")
-                                    # 清理断开的连接
-                                    if connection_id in pod_logs_connections:
-                                        del pod_logs_connections[connection_id]
+                                # 前端消费慢时丢弃日志行，不阻塞agent消息循环
+                                if not connection_info["ws"].send_nowait(log_message):
+                                    logger.debug(f"前端日志队列已满，丢弃日志: {connection_id}")
+                    continue
+
+                # 处理JSON格式的消息
+                if data.get("type") == "heartbeat":
+                    # 更新心跳时间
+                    clients[env]["last_heartbeat"] = time.time()
+                    clients[env]["online"] = True
+                    # logger.info(f"[心跳]客户端 env={env} ver={ver}")
+                elif data.get("type") == "admis":
+                    request_id = data["request_id"]
+                    namespace = data["namespace"]
+                    deployment = data["deployment"]
+                    logger.info(f"==========客户端 env={env} {request_id} {namespace} {deployment}")
+                    # 在独立线程池中查询，不阻塞该agent的消息循环
+                    admis_worker.submit(sender, env, request_id, namespace, deployment)
+
+                elif data.get("type") == "response":
+                    # 收到客户端的响应，立即唤醒等待该请求的协程
+                    request_id = data["request_id"]
+                    response = data["response"]
+                    agent_rpc.resolve(request_id, response)
+                    logger.info(f"[响应]客户端 env={env}: request_id={request_id}：{response}")
+
+                elif data.get("type") == "response_chunk":
+                    # 分块响应按顺序交给正在向前端写出的协程
+                    agent_rpc.feed_chunk(data["request_id"], data)
+
+                elif data.get("type") == "pod_logs":
+                    # 处理来自agent的Pod日志数据，转发给前端
+                    connection_id = data.get("connection_id")
+                    if connection_id in pod_logs_connections:
+                        frontend_ws = pod_logs_connections[connection_id]["ws"]
+                        if not frontend_ws.send_nowait(data):
+                            logger.debug(f"前端日志队列已满，丢弃消息: {connection_id}")
+                elif data.get("type") == "k8s_event":
+                    # 处理来自agent的K8S事件消息
+                    logger.debug(f"💯[K8S事件]客户端 env={env}: {data}")
+
+                    # 异步存储K8S事件到ClickHouse，避免阻塞WebSocket消息循环
+                    try:
+                        success = await process_k8s_event_async(data)
+                        if success:
+                            logger.debug(f"K8S事件已成功存储到ClickHouse: {data.get('data', {}).get('eventUid')}")
+                        else:
+                            logger.warning(f"K8S事件存储失败: {data.get('data', {}).get('eventUid')}")
+                    except Exception as e:
+                        logger.error(f"处理K8S事件时发生错误: {e}")
+                else:
+                    logger.info(f"收到客户端消息：{data}")
 
             elif msg.type == WSMsgType.ERROR:
                 logger.error(f"客户端连接出错，env={env}")
     except Exception as e:
         logger.error(f"客户端连接异常断开，env={env}，错误：{e}")
     finally:
-        # 标记客户端为离线
-        if env in clients:
+        # 标记客户端为离线，agent已重连时clients中是新连接，不修改
+        if env in clients and clients[env]["conn"] == conn_id:
             clients[env]["online"] = False
             logger.info(f"客户端连接关闭，标记为离线，env={env}")
+        # 该连接上等待中的请求不会再有响应，立即结束
+        agent_rpc.fail_env(env, conn_id)
+        await session_registry.registry.unregister(env, conn_id)
+        await sender.stop()
 
     return ws
 
@@ -231,6 +265,10 @@ async def pod_logs_websocket_handler(request):
         return web.json_response({"error": "缺少必要参数"}, status=400)
 
     if env not in clients or not clients[env]["online"]:
+        # agent连接在其它master副本上时桥接过去
+        owner = await session_registry.registry.lookup(env)
+        if session_registry.is_remote(owner) and session_registry.FORWARDED_HEADER not in request.headers:
+            return await session_registry.forward_pod_logs(request, request.app["replica_session"], owner)
         return web.json_response({"error": "目标环境不在线"}, status=404)
 
     ws = web.WebSocketResponse()
@@ -239,9 +277,10 @@ async def pod_logs_websocket_handler(request):
     # 生成唯一连接ID
     connection_id = f"{env}_{namespace}_{pod_name}_{int(time.time())}"
 
-    # 存储前端连接
+    # 存储前端连接，日志经有界队列发送给前端
+    frontend_sender = ws_sender.PrioritySender(ws, f"pod_logs:{connection_id}")
     pod_logs_connections[connection_id] = {
-        "ws": ws,
+        "ws": frontend_sender,
         "env": env,
         "namespace": namespace,
         "pod_name": pod_name,
@@ -260,7 +299,7 @@ async def pod_logs_websocket_handler(request):
             "pod_name": pod_name,
             "container": container,
         }
-        await agent_ws.send_json(start_message)
+        await agent_ws.send_json(start_message, priority=ws_sender.PRIORITY_BULK)
 
         # 处理前端消息
         async for msg in ws:
@@ -270,7 +309,7 @@ async def pod_logs_websocket_handler(request):
                     if data.get("type") == "stop_logs":
                         # 通知agent停止日志流
                         stop_message = {"type": "stop_pod_logs", "connection_id": connection_id}
-                        await agent_ws.send_json(stop_message)
+                        await agent_ws.send_json(stop_message, priority=ws_sender.PRIORITY_BULK)
                         break
                 except json.JSONDecodeError:
                     logger.error(f"收到无法解析的前端消息：{msg.data}")
@@ -288,15 +327,99 @@ async def pod_logs_websocket_handler(request):
         try:
             if env in clients and clients[env]["online"]:
                 stop_message = {"type": "stop_pod_logs", "connection_id": connection_id}
-                await clients[env]["ws"].send_json(stop_message)
+                await clients[env]["ws"].send_json(stop_message, priority=ws_sender.PRIORITY_BULK)
         except Exception as e:
             logger.error(f"通知agent停止日志流失败: {e}")
 
+        await frontend_sender.stop()
         logger.info(f"Pod日志连接关闭: {connection_id}")
 
     return ws
 
 
+async def _request_agent(env, method, path, query_params, body):
+    """向agent发送请求并等待响应，超时抛出asyncio.TimeoutError，连接断开抛出AgentDisconnectedError"""
+    request_id = agent_rpc.new_request_id()
+    message = {
+        "type": "request",
+        "request_id": request_id,
+        "method": method,
+        "path": path,
+        "query": query_params,
+        "body": body,
+    }
+    client = clients[env]
+    # 先注册再发送，避免响应先于注册到达
+    future = agent_rpc.register(env, request_id, path, client["conn"])
+    try:
+        await client["ws"].send_json(message)  # 使用 send_json 发送 JSON 数据
+    except Exception:
+        agent_rpc.discard(request_id)
+        raise
+    logger.info(f"[请求]客户端 env={env}: {message}")
+    return await agent_rpc.wait_response(request_id, future, path)
+
+
+async def _fetch_agent(env, method, path, query_params, body):
+    """
+    请求agent，返回 (请求前的响应缓存代数, 响应)。
+    single_flight合并的请求都通过这里发起，加入已有请求的等待者共用发起时记录的代数
+    """
+    generation = response_cache.generation(response_cache.make_key(env, method, path, query_params))
+    return generation, await _request_agent(env, method, path, query_params, body)
+
+
+async def _stream_agent(request, env, method, path, query_params, body):
+    """请求agent分块返回响应，收到一块就向前端写出一块，master不组装完整响应"""
+    request_id = agent_rpc.new_request_id()
+    message = {
+        "type": "request",
+        "request_id": request_id,
+        "method": method,
+        "path": path,
+        "query": query_params,
+        "body": body,
+        "stream": True,
+    }
+    client = clients[env]
+    queue = agent_rpc.register_stream(env, request_id, path, client["conn"])
+    resp = None
+    try:
+        await client["ws"].send_json(message)
+        logger.info(f"[分块请求]客户端 env={env}: {message}")
+        chunk = await agent_rpc.next_chunk(queue, path)
+        if chunk.get("error"):
+            logger.error(f"客户端分块响应失败，env={env}, path={path}: {chunk['error']}")
+            return web.json_response({"error": chunk["error"]}, status=502)
+        resp = web.StreamResponse(status=chunk.get("status", 200))
+        resp.content_type = chunk.get("content_type", "application/json")
+        await resp.prepare(request)
+        size = 0
+        while True:
+            if chunk.get("error"):
+                raise ValueError(chunk["error"])
+            data = chunk.get("data")
+            if data:
+                data = data.encode("utf-8") if isinstance(data, str) else data
+                size += len(data)
+                await resp.write(data)
+            if chunk.get("last"):
+                break
+            chunk = await agent_rpc.next_chunk(queue, path)
+        await resp.write_eof()
+        logger.info(f"[分块响应]客户端 env={env}: request_id={request_id}, {chunk['seq'] + 1} 块 {size} 字节")
+        return resp
+    except (asyncio.TimeoutError, agent_rpc.AgentDisconnectedError, ValueError) as e:
+        logger.error(f"等待客户端分块响应失败，env={env}, path={path}, request_id={request_id}, 错误：{e!r}")
+        if resp is None:
+            status = 502 if isinstance(e, agent_rpc.AgentDisconnectedError) else 504
+            return web.json_response({"error": "客户端未响应"}, status=status)
+        # 响应头已发出，只能中断连接让前端感知失败
+        raise
+    finally:
+        agent_rpc.discard(request_id)
+
+
 async def http_handler(request):
     path = request.path
     method = request.method
@@ -310,6 +433,10 @@ async def http_handler(request):
         return web.json_response({"error": "缺少 K8S 集群名称参数"}, status=400)
 
     if env not in clients or not clients[env]["online"]:
+        # agent连接在其它master副本上时转发过去
+        owner = await session_registry.registry.lookup(env)
+        if session_registry.is_remote(owner) and session_registry.FORWARDED_HEADER not in request.headers:
+            return await session_registry.forward_http(request, request.app["replica_session"], owner)
         return web.json_response({"error": "目标客户端不在线"}, status=404)
 
     logger.info(path)
@@ -389,10 +516,6 @@ async def http_handler(request):
             if username not in user_list:
                 return web.json_response({"error": f"拒绝操作：当前用户{username}禁止操作"}, status=403)
 
-    elif path == "/api/agent/namespaces" and query_params.get("flush") != 'true':
-        cached_namespaces = namespace_cache.get_namespaces_from_cache(env)
-        if cached_namespaces is not None:
-            return web.json_response({"success": True, "data": cached_namespaces})
     # 扩缩容接口要查询节点cpu使用率并传给agent
     elif path in ["/api/scale", "/api/pod/modify_pod"] and query_params.get("add_label") == 'true':
         res_type = query_params.get("type", "cpu")
@@ -411,8 +534,8 @@ async def http_handler(request):
         logger.info(body)
 
         # 查询源节点所有deployment列表
-        source_deployment_list = utils.get_node_deployments(source, env)
-        target_deployment_list = utils.get_node_deployments(target, env)
+        source_deployment_list = await utils.get_node_deployments(source, env)
+        target_deployment_list = await utils.get_node_deployments(target, env)
         deployment_list = []
         for i in source_deployment_list:
             flag = True
@@ -424,65 +547,178 @@ async def http_handler(request):
                 deployment_list.append(i)
         logger.info(f'deployment_list去重前：{source_deployment_list}')
         logger.info(f'deployment_list去重后：{deployment_list}')
-        top_deployments = utils.get_deployment_from_control_data(deployment_list, num, type, env)
+        top_deployments = await utils.get_deployment_from_control_data(deployment_list, num, type, env)
         body['top_deployments'] = top_deployments
 
-    # 向目标客户端发送消息
-    request_id = str(time.time())  # 使用时间戳作为唯一请求 ID
-    message = {
-        "type": "request",
-        "request_id": request_id,
-        "method": method,
-        "path": path,
-        "query": query_params,
-        "body": body,
-    }
-    await clients[env]["ws"].send_json(message)  # 使用 send_json 发送 JSON 数据
-    logger.info(f"[请求]客户端 env={env}: {message}")
+    # 全集群的大列表由agent分块返回，直接流式写给前端
+    if method == "GET" and agent_rpc.should_stream(path, query_params, clients[env].get("caps", ())):
+        return await _stream_agent(request, env, method, path, query_params, body)
+
+    # 相同的只读请求并发到达时只向agent发送一次
+    key = single_flight.make_key(env, method, path, query_params)
+    request_agent = lambda: single_flight.do(key, lambda: _fetch_agent(env, method, path, query_params, body))
 
-    # 等待客户端响应
-    if "response_queue" not in clients[env]:
-        clients[env]["response_queue"] = {}
+    cache_key = response_cache.make_key(env, method, path, query_params)
+    if cache_key is not None and query_params.get("flush") != 'true':
+        cached, state = response_cache.get(cache_key)
+        if state == response_cache.STALE:
+            response_cache.refresh(cache_key, request_agent)
+        if cached is not None:
+            return web.json_response({"success": True, **cached})
 
     try:
-        for _ in range(120 * 10):  # 等待 120 秒，检查响应队列
-            if request_id in clients[env]["response_queue"]:
-                response = clients[env]["response_queue"].pop(request_id)
-
-                # 特殊处理：如果是 /api/agent/istio/vs 接口，需要对响应进行额外处理
-                if path == "/api/agent/istio/vs":
-                    # 在这里添加你的额外处理逻辑
-                    vs_list = response.get('data', [])
-                    processed_response = await istio_route.sync_vs_from_k8s(env, vs_list)
-                    return web.json_response(processed_response)
-                elif path == '/api/agent/namespaces':
-                    namespace_cache.update_namespace_cache(env, response.get('data', []))
-                return web.json_response({"success": True, **response})
-            await asyncio.sleep(0.1)
+        generation, response = await request_agent()
+    except asyncio.TimeoutError:
+        logger.error(f"等待客户端响应超时，env={env}, path={path}")
+        return web.json_response({"error": "客户端未响应"}, status=504)
+    except agent_rpc.AgentDisconnectedError as e:
+        logger.error(f"等待客户端响应时连接断开，env={env}, 错误：{e}")
+        return web.json_response({"error": "客户端连接已断开"}, status=502)
+    except asyncio.CancelledError:
+        # 前端断开连接，wait_response已清理等待项
+        logger.info(f"前端已断开，取消等待客户端响应，env={env}, path={path}")
+        raise
     except Exception as e:
         logger.error(f"等待客户端响应时发生错误，env={env}, 错误：{e}")
+        return web.json_response({"error": "客户端未响应"}, status=504)
+    finally:
+        # 写操作无论成败都清理相关的响应缓存
+        if method != "GET":
+            response_cache.invalidate(env, path, query_params, body)
+
+    if cache_key is not None:
+        response_cache.put(cache_key, response, generation)
+
+    # 特殊处理：如果是 /api/agent/istio/vs 接口，需要对响应进行额外处理
+    if path == "/api/agent/istio/vs":
+        vs_list = response.get('data', [])
+        processed_response = await istio_route.sync_vs_from_k8s(env, vs_list)
+        return web.json_response(processed_response)
+    return web.json_response({"success": True, **response})
+
+
+async def _fanout_one(session, env, owner, path, query_params, timeout):
+    """向单个env发起只读请求，返回带env标记的结果，超时或失败时返回错误而不抛出"""
+    query = {**query_params, "env": env}
+    try:
+        if owner is None:
+            key = single_flight.make_key(env, "GET", path, query)
+            request_agent = lambda: _fetch_agent(env, "GET", path, query, False)
+            _, response = await asyncio.wait_for(single_flight.do(key, request_agent), timeout)
+            return {"env": env, "success": True, **response}
+        response = await asyncio.wait_for(session_registry.fetch_remote(session, owner, path, query), timeout)
+        return {"env": env, **response}
+    except asyncio.TimeoutError:
+        return {"env": env, "success": False, "error": f"客户端 {timeout} 秒内未响应"}
+    except Exception as e:
+        return {"env": env, "success": False, "error": str(e) or repr(e)}
+
+
+async def fanout_handler(request):
+    """
+    同时向多个env的agent发起同一个只读请求，按完成顺序以NDJSON逐行返回，每行带env字段
+    query: route=/api/agent/pods, envs=env1,env2 或 *, timeout=单个agent超时秒数，其余参数原样转发
+    最后一行为汇总: {"done": true, "total": n, "failed": [...]}
+    """
+    query_params = dict(request.query)
+    path = query_params.pop("route", "")
+    envs = query_params.pop("envs", "*")
+    try:
+        timeout = float(query_params.pop("timeout", FANOUT_TIMEOUT_SECONDS))
+    except ValueError:
+        return web.json_response({"error": "timeout 参数格式错误"}, status=400)
+    query_params.pop("env", None)
+    if path not in single_flight.SINGLE_FLIGHT_ROUTES:
+        return web.json_response({"error": f"不支持并发查询的接口: {path}"}, status=400)
+
+    local_envs = {env for env, data in clients.items() if data["online"]}
+    remote_owners = {
+        env: owner
+        for env, owner in (await session_registry.registry.list_sessions()).items()
+        if session_registry.is_remote(owner) and env not in local_envs
+    }
+    # 请求已被转发过时不再二次转发
+    if session_registry.FORWARDED_HEADER in request.headers:
+        remote_owners = {}
+    online_envs = local_envs | set(remote_owners)
+    targets = sorted(online_envs) if envs == "*" else [env for env in envs.split(",") if env]
+    if not targets:
+        return web.json_response({"error": "没有可查询的在线客户端"}, status=404)
+
+    resp = web.StreamResponse()
+    resp.content_type = "application/x-ndjson"
+    await resp.prepare(request)
+    session = request.app["replica_session"]
+    tasks = []
+    failed = []
+    for env in targets:
+        if env not in online_envs:
+            failed.append(env)
+            line = {"env": env, "success": False, "error": "目标客户端不在线"}
+            await resp.write((json.dumps(line) + "\n").encode("utf-8"))
+        else:
+            tasks.append(_fanout_one(session, env, remote_owners.get(env), path, query_params, timeout))
+    logger.info(f"[并发查询] {path} -> {len(tasks)} 个env，超时 {timeout} 秒")
+    for future in asyncio.as_completed(tasks):
+        line = await future
+        if not line.get("success"):
+            failed.append(line["env"])
+        await resp.write((json.dumps(line) + "\n").encode("utf-8"))
+    await resp.write((json.dumps({"done": True, "total": len(targets), "failed": failed}) + "\n").encode("utf-8"))
+    await resp.write_eof()
+    return resp
+
+
+async def cache_stats_handler(request):
+    """master各级缓存的命中情况"""
+    return web.json_response(
+        {
+            "query_cache": query_cache.metrics(),
+            "response_cache": response_cache.metrics(),
+            "single_flight": single_flight.stats,
+            "prom_cache": prom_client.cache_metrics(),
+        }
+    )
 
-    return web.json_response({"error": "客户端未响应"}, status=504)
+
+async def schema_status_handler(request):
+    """ClickHouse表结构迁移状态"""
+    return web.json_response(schema_migrations.status)
 
 
 async def status_handler(request):
-    agent_info = utils.ck_agent_info()
+    agent_info = await utils.ck_agent_info()
+    # 其它master副本上在线的agent
+    remote_status = {
+        env: {
+            "online": True,
+            "last_heartbeat": datetime.fromtimestamp(data["last_heartbeat"]).strftime("%Y-%m-%d %H:%M:%S"),
+            "ver": data["ver"],
+            "replica": data["replica"],
+        }
+        for env, data in (await session_registry.registry.list_sessions()).items()
+        if session_registry.is_remote(data)
+    }
     agents_status = {
         env: {
             "online": data["online"],
             "last_heartbeat": datetime.fromtimestamp(data["last_heartbeat"]).strftime("%Y-%m-%d %H:%M:%S"),
             "ver": data["ver"],
+            "codec": data.get("codec", ws_codec.DEFAULT_CODEC),
+            "replica": session_registry.REPLICA_ID,
+            "send_queue": data["ws"].metrics(),
         }
         for env, data in clients.items()
+        if data["online"] or env not in remote_status
     }
-    agents = utils.merge_dicts(agents_status, agent_info)
+    agents = utils.merge_dicts({**remote_status, **agents_status}, agent_info)
     return web.json_response({'success': True, 'data': agents})
 
 
 async def prom_query_handler(request):
     env_value = request.query.get('env')
     namespace_value = request.query.get('ns')
-    metrics_data = prom_real_time_data.get_metrics_data(env_value, namespace_value)
+    metrics_data = await prom_real_time_data.get_metrics_data(env_value, namespace_value)
     final_data = prom_real_time_data.process_metrics_data(metrics_data)
     return web.json_response({'success': True, 'data': final_data})
 
@@ -492,7 +728,7 @@ async def prom_ns_handler(request):
     if not env_value:
         return web.json_response({'message': 'env query parameter is required'}, status=400)
     try:
-        namespaces = utils.fetch_prom_namespaces(env_value)
+        namespaces = await utils.fetch_prom_namespaces(env_value)
         return web.json_response({'success': True, 'data': namespaces})
     except Exception as e:
         return web.json_response({'message': str(e)}, status=500)
@@ -504,7 +740,7 @@ async def prom_services_handler(request):
     if not env_value or not namespace:
         return web.json_response({'message': 'env and namespace query parameters are required'}, status=400)
     try:
-        services = utils.fetch_prom_services(env_value, namespace)
+        services = await utils.fetch_prom_services(env_value, namespace)
         return web.json_response({'success': True, 'data': services})
     except Exception as e:
         return web.json_response({'message': str(e)}, status=500)
@@ -514,7 +750,7 @@ async def prom_env_handler(request):
     try:
         username = request.headers.get('X-User-Name', '')
         permission = request.headers.get('X-User-Permission', '')
-        envs = utils.fetch_prom_envs()
+        envs = await utils.fetch_prom_envs()
         return web.json_response({'success': True, 'data': envs, 'username': username, 'permission': permission})
     except Exception as e:
         return web.json_response({'message': str(e), 'username': username, 'permission': permission}, status=500)
@@ -562,7 +798,7 @@ async def prom_overview_handler(request):
 
 async def agent_names(request):
     try:
-        k8s_names = utils.ck_get_k8s_names()
+        k8s_names = await utils.ck_get_k8s_names()
         return web.json_response({'success': True, 'data': k8s_names})
     except Exception as e:
         return web.json_response({'message': str(e)}, status=500)
@@ -571,26 +807,32 @@ async def agent_names(request):
 async def heartbeat_check():
     """定期检查客户端的心跳状态"""
     while True:
-        for env, data in clients.items():
+        for env, data in list(clients.items()):
             if data["online"] and time.time() - data["last_heartbeat"] > 5:
                 # 标记超时客户端为离线
                 data["online"] = False
                 logger.warning(f"客户端 env={env} 超时，标记为离线")
+                await session_registry.registry.unregister(env, data["conn"])
+            elif data["online"]:
+                # 续期共享注册表中的会话
+                try:
+                    await session_registry.registry.refresh(env, data["ver"], data["conn"])
+                except Exception as e:
+                    logger.error(f"续期agent会话注册失败 env={env}: {e}")
         await asyncio.sleep(3)
 
 
 async def cron_peak_data(request):
-    param_combinations = utils.ck_agent_collect_info()
+    """所有开启采集的K8S并发采集高峰期数据，每个K8S完成后逐行返回结果"""
+    param_combinations = await utils.ck_agent_collect_info()
+    days = int(request.query.get("days", 2))
+    force = request.query.get("force") == "1"
+    job = peak_scheduler.create_job([tuple(i) for i in param_combinations], days, force)
 
     # 使用 streaming response 给客户端逐个返回响应
     async def stream_responses():
-        for env, peak_hours in param_combinations:
-            query_params = MultiDict([("env", env), ("peak_hours", peak_hours)])
-            fake_request = request.clone()
-            fake_request._rel_url = fake_request._rel_url.update_query(query_params)
-            response = await init_peak_data(fake_request)
-            # 解析 JSON 响应并确保中文字符不被转义
-            response_json = json.loads(response.body.decode('utf-8'))
+        async for env, (response_json, _) in peak_scheduler.run_job(job):
+            # 确保中文字符不被转义
             json_str = json.dumps(response_json, ensure_ascii=False)
             # 将 JSON 字符串转换为字节对象再返回
             yield (json_str + '\n').encode('utf-8')
@@ -605,61 +847,51 @@ async def cron_peak_data(request):
 
 async def init_peak_data(request):
     """初始化/更新原始资源表k8s_resources，初始化/更新资源管控表k8s_res_control"""
-    try:
-        env_key = utils.PROM_K8S_TAG_KEY
-        env_value = request.query.get("env")
-        days = int(request.query.get("days", 2))  # 不传则采集昨天+今天
-        peak_hours = request.query.get("peak_hours", "10:00:00-11:30:00")
-        logger.info(f"🐛开始获取{env_value}，{days}天，每日【{peak_hours}】高峰期数据")
-        duration_str, start_time_part, end_time_part = utils.calculate_peak_duration_and_end_time(peak_hours)
-
-        for i in range(0, days):
-            # 计算结束时间字符串
-            current_date = datetime.now().date()
-            start_time_full = datetime.combine(current_date, start_time_part) - timedelta(days=i)
-            end_time_full = datetime.combine(current_date, end_time_part) - timedelta(days=i)
-            if datetime.now() < end_time_full:
-                logger.info(f"今天的高峰期还未结束，跳过{current_date}的数据采集")
-                continue
-            utils.check_and_delete_day_data(end_time_full, env_value)
-            logger.info(f"🚀获取{end_time_full}的数据======")
-            k8s_metrics_list = utils.merged_dict(env_key, env_value, duration_str, end_time_full)
-            utils.metrics_to_ck(k8s_metrics_list)
-        logger.info(f"🚀{env_value}: 高峰期数据采集流程结束,开始取最近10天cpu使用最高的一天pod数据, 写入管控表")
-
-        # 采集完成后，取最近10天cpu数据最高的一天pod，数据写入管控表
-        resources = utils.get_list_from_resources(env_value)
-        if utils.is_init_or_update(env_value):
-            # 初始化
-            logger.info(f"🌊{env_value}: 初始化管控表======")
-            flag = utils.init_control_data(resources)
-            logger.info(f"✨{env_value}: 更新完成")
-        else:
-            # 更新
-            logger.info(f"🌊{env_value}: 更新管控表======")
-            flag = utils.update_control_data(resources)
-            logger.info(f"✨{env_value}: 更新完成")
-
-        if not flag:
-            return web.json_response(
-                {"message": f"{env_value}: 写入管控表执行失败，详情见kubedoor-master日志"},
-                status=500,
-            )
-        return web.json_response({"success": True, "message": f"{env_value}: 执行完成"})
-    except Exception as e:
-        logger.error(f"Error in table: {e}")
-        return web.json_response({"message": str(e)}, status=500)
+    env_value = request.query.get("env")
+    days = int(request.query.get("days", 2))  # 不传则采集昨天+今天
+    peak_hours = request.query.get("peak_hours", "10:00:00-11:30:00")
+    # force=1 时忽略已完成的进度，全部重新采集
+    force = request.query.get("force") == "1"
+    job = peak_scheduler.create_job([(env_value, peak_hours)], days, force)
+    async for _, (response_json, status) in peak_scheduler.run_job(job):
+        return web.json_response(response_json, status=status)
+
+
+async def peak_jobs_handler(request):
+    """高峰期数据采集任务的进度，按 job_id 查询单个任务"""
+    job_id = request.query.get("job_id")
+    if job_id:
+        job = peak_scheduler.jobs.get(job_id)
+        if not job:
+            return web.json_response({"message": f"采集任务 {job_id} 不存在"}, status=404)
+        return web.json_response({"success": True, "data": job.summary()})
+    return web.json_response({"success": True, "data": [job.summary() for job in reversed(peak_scheduler.jobs.values())]})
 
 
 async def start_background_tasks(app):
     """启动后台任务"""
     app["heartbeat_task"] = asyncio.create_task(heartbeat_check())
+    # ClickHouse表结构迁移在后台执行，ClickHouse不可用时重试，不阻塞启动
+    app["schema_task"] = asyncio.create_task(schema_migrations.run())
+    # 副本之间转发请求使用的长连接会话
+    app["replica_session"] = aiohttp.ClientSession()
+    # /api/sql 访问ClickHouse HTTP接口的共享会话
+    app["ck_session"] = ck_http_proxy.create_session()
 
 
 async def cleanup_background_tasks(app):
     """清理后台任务"""
     app["heartbeat_task"].cancel()
     await app["heartbeat_task"]
+    app["schema_task"].cancel()
+    await app["replica_session"].close()
+    await app["ck_session"].close()
+    await session_registry.registry.close()
+    await utils.ck.close()
+    await admis_worker.close()
+    await prom_client.close()
+    # 写入缓冲区中剩余的K8S事件
+    await asyncio.to_thread(stop_event_writer)
 
 
 app = web.Application()
@@ -683,9 +915,13 @@ app.router.add_get("/api/events/menu", get_k8s_events_menu_options)  # 获取K8S
 
 # ==========需要rw权限==========
 app.router.add_get("/api/agent_status", status_handler)  # 获取agent状态
+app.router.add_get("/api/cache_stats", cache_stats_handler)  # 缓存命中统计
+app.router.add_get("/api/schema_status", schema_status_handler)  # ClickHouse表结构迁移状态
+app.router.add_get("/api/fanout", fanout_handler)  # 多个K8S并发查询同一个只读接口
 app.router.add_get("/api/agent_names", agent_names)  # istio管理获取K8S列表
 app.router.add_get("/api/init_peak_data", init_peak_data)
 app.router.add_get("/api/cron_peak_data", cron_peak_data)
+app.router.add_get("/api/peak_jobs", peak_jobs_handler)  # 高峰期数据采集进度
 
 
 # ==================== Istio Route 路由注册 ====================
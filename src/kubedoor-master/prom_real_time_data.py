@@ -1,6 +1,8 @@
-import requests
-import json
+import asyncio
+from loguru import logger
+
 import utils
+from func_manager import prom_client
 
 
 PROM_K8S_TAG_KEY = utils.PROM_K8S_TAG_KEY
@@ -28,102 +30,68 @@ def process_promql_queries(env_key, env_value, namespace_value):
     return promql_queries
 
 
+# 除pod_count外的指标，顺序与返回的每行中的字段顺序一致
+METRICS = [
+    'avg_cpu_usage',
+    'max_cpu_usage',
+    'cpu_requests',
+    'cpu_limit',
+    'avg_memory_wss',
+    'max_memory_wss',
+    'mem_requests',
+    'mem_limit',
+]
+
+
 # Prometheus查询函数
-def query_prometheus(promql):
-    params = {'query': promql}
+async def query_prometheus(metric, promql):
     try:
-        response = requests.get(PROMETHEUS_URL, params=params)
-        response.raise_for_status()
-        data = response.json()
-        return data['data']['result']
-    except requests.exceptions.RequestException as e:
-        print(f"Error querying Prometheus: {e}")
+        return await prom_client.query(PROMETHEUS_URL, promql, name=f"real_time {metric}")
+    except prom_client.PromQueryError as e:
+        logger.error(f"Error querying Prometheus: {e}")
         return []
 
 
-# 获取所有指标的数据
-def get_metrics_data(env_value, namespace_value):
-    # 用于存储所有数据的字典
-    metrics_data = {}
+# 并发获取所有指标的数据
+async def get_metrics_data(env_value, namespace_value):
     query_dict = process_promql_queries(PROM_K8S_TAG_KEY, env_value, namespace_value)
-    # 执行每个查询
-    for metric, query in query_dict.items():
-        result = query_prometheus(query)
-        metrics_data[metric] = result
-
-    return metrics_data
+    results = await asyncio.gather(*(query_prometheus(metric, query) for metric, query in query_dict.items()))
+    return dict(zip(query_dict, results))
 
 
 # 四舍五入到整数
 def round_to_int(value):
     try:
         return round(float(value))
-    except ValueError:
+    except (ValueError, OverflowError):
+        # NaN、±Inf
         return 0
 
 
+def _deployment_key(labels):
+    return labels.get(PROM_K8S_TAG_KEY), labels.get('namespace'), labels.get('deployment')
+
+
 # 处理并整合指标数据
 def process_metrics_data(metrics_data):
-    # 最终的结果列表
-    final_data = []
-
-    # 提取所有的env, namespace, deployment组合
-    deployments = set()
+    """
+    按pod_count中的deployment生成结果行，每项指标的结果只遍历一次，按 (env, namespace, deployment) 索引写入对应行
+    同一deployment有多个序列时以最后一个为准
+    """
+    # (env, namespace, deployment) -> 结果行
+    rows = {}
     for metric in metrics_data['pod_count']:
-        env = metric['metric'][PROM_K8S_TAG_KEY]
-        namespace = metric['metric']['namespace']
-        deployment = metric['metric']['deployment']
-        deployments.add((env, namespace, deployment))
-
-    # 遍历每个deployment，匹配所有指标
-    for env, namespace, deployment in deployments:
-        # 创建每个deployment的结果列表
-        row = [
-            env,
-            namespace,
-            deployment,
-            0,  # pod_count
-            0,  # avg_cpu_usage
-            0,  # max_cpu_usage
-            0,  # cpu_requests
-            0,  # cpu_limit
-            0,  # avg_memory_wss
-            0,  # max_memory_wss
-            0,  # mem_requests
-            0,  # mem_limit
-        ]
-
-        # 获取Pod数
-        for metric in metrics_data['pod_count']:
-            if (
-                metric['metric'][PROM_K8S_TAG_KEY] == env
-                and metric['metric']['namespace'] == namespace
-                and metric['metric']['deployment'] == deployment
-            ):
-                row[3] = round_to_int(metric['value'][1])
-
-        # 获取其他指标
-        for metric_idx, metric in enumerate(
-            [
-                'avg_cpu_usage',
-                'max_cpu_usage',
-                'cpu_requests',
-                'cpu_limit',
-                'avg_memory_wss',
-                'max_memory_wss',
-                'mem_requests',
-                'mem_limit',
-            ],
-            start=4,
-        ):
-            for data in metrics_data[metric]:
-                if (
-                    data['metric'][PROM_K8S_TAG_KEY] == env
-                    and data['metric']['namespace'] == namespace
-                    and data['metric']['deployment'] == deployment
-                ):
-                    row[metric_idx] = round_to_int(data['value'][1])
-
-        final_data.append(row)
-
-    return final_data
+        key = _deployment_key(metric['metric'])
+        row = rows.get(key)
+        if row is None:
+            # env, namespace, deployment, pod_count, METRICS中的各项指标
+            row = rows[key] = [*key, 0] + [0] * len(METRICS)
+        row[3] = round_to_int(metric['value'][1])
+
+    for metric_idx, metric in enumerate(METRICS, start=4):
+        for data in metrics_data[metric]:
+            row = rows.get(_deployment_key(data['metric']))
+            if row is not None:
+                row[metric_idx] = round_to_int(data['value'][1])
+
+    return list(rows.values())
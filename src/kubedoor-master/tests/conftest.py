@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 测试直接导入master的模块(utils、func_manager、k8s_event)，与运行kubedoor-master.py时的路径一致
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,60 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+import utils
+from func_manager import day_partition, session_registry
+from func_manager.session_registry import MemorySessionRegistry
+
+
+class FakeCK:
+    """utils.ck的替身，记录执行的SQL，count()查询返回固定行数"""
+
+    def __init__(self):
+        self.statements = []
+
+    async def execute(self, sql, params=None, columnar=False):
+        self.statements.append(sql)
+        if "count()" in sql:
+            return [(3,)]
+        return []
+
+    def replaced(self):
+        return [sql for sql in self.statements if "REPLACE PARTITION" in sql]
+
+
+@pytest.fixture
+def ck(monkeypatch):
+    fake = FakeCK()
+    monkeypatch.setattr(utils, "ck", fake)
+    monkeypatch.setattr(session_registry, "registry", MemorySessionRegistry())
+    monkeypatch.setattr(day_partition, "_staging_ready", True)
+    monkeypatch.setattr(day_partition, "_pending", {})
+    return fake
+
+
+DATE = datetime(2024, 5, 1, 12)
+
+
+def test_empty_columns_keep_existing_rows(ck):
+    assert asyncio.run(day_partition.reload_day(DATE, "c1", [[], []])) is False
+    assert asyncio.run(day_partition.reload_day(DATE, "c1", [])) is False
+    # 未写入暂存表也未替换分区，该env已有的数据不变
+    assert ck.statements == []
+
+
+def test_envs_of_the_same_day_share_one_replace(ck):
+    async def main():
+        # 另一次替换持有该天的锁期间到达的env合并写入
+        async with session_registry.registry.lock("k8s_resources:20240501"):
+            tasks = [
+                asyncio.create_task(day_partition.reload_day(DATE, "c1", [[DATE], ["c1"]])),
+                asyncio.create_task(day_partition.reload_day(DATE, "c2", [[DATE], ["c2"]])),
+                asyncio.create_task(day_partition.reload_day(DATE, "c3", [[], []])),
+            ]
+            await asyncio.sleep(0)
+        return await asyncio.gather(*tasks)
+
+    assert asyncio.run(main()) == [True, True, False]
+    assert len(ck.replaced()) == 1
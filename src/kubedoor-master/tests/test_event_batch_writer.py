@@ -0,0 +1,141 @@
+import time
+
+from k8s_event.event_batch_writer import EVENT_COLUMNS, EventBatchWriter
+
+
+class FakeClickHouse:
+    """记录每批写入的列数据，前fail_times次写入抛出异常"""
+
+    def __init__(self, fail_times=0, on_insert=None):
+        self.fail_times = fail_times
+        self.on_insert = on_insert
+        self.calls = 0
+        self.batches = []
+
+    def insert(self, columns, column_names):
+        self.calls += 1
+        if self.on_insert:
+            self.on_insert()
+        if self.calls <= self.fail_times:
+            raise ConnectionError("clickhouse unavailable")
+        assert column_names == EVENT_COLUMNS
+        self.batches.append(dict(zip(column_names, columns)))
+
+    def uids(self):
+        return [uid for batch in self.batches for uid in batch["eventUid"]]
+
+
+def event(uid, last="2026-10-17T11:30:00Z", **fields):
+    return {"eventUid": uid, "k8s": "c1", "namespace": "ns", "reason": "BackOff", "lastTimestamp": last, **fields}
+
+
+def wait_until(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if predicate():
+            return True
+        time.sleep(0.01)
+    return predicate()
+
+
+def test_flush_when_batch_size_reached():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert, batch_size=3, flush_interval=60)
+    writer.start()
+    try:
+        for i in range(3):
+            writer.add(event(f"uid-{i}"))
+        assert wait_until(lambda: ck.batches)
+        assert ck.uids() == ["uid-0", "uid-1", "uid-2"]
+        assert writer.get_stats()["batches"] == 1
+    finally:
+        writer.stop()
+
+
+def test_flush_after_interval_below_batch_size():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert, batch_size=100, flush_interval=0.05)
+    writer.start()
+    try:
+        writer.add(event("uid-0"))
+        assert wait_until(lambda: ck.batches)
+        assert ck.uids() == ["uid-0"]
+    finally:
+        writer.stop()
+
+
+def test_flush_splits_buffer_into_batches():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert, batch_size=2)
+    for i in range(5):
+        writer.add(event(f"uid-{i}"))
+    assert writer.flush() == 5
+    assert [len(batch["eventUid"]) for batch in ck.batches] == [2, 2, 1]
+
+
+def test_retry_until_insert_succeeds():
+    ck = FakeClickHouse(fail_times=2)
+    writer = EventBatchWriter(ck.insert, max_retries=3, retry_backoff=0)
+    writer.add(event("uid-0"))
+    assert writer.flush() == 1
+    stats = writer.get_stats()
+    assert stats["retries"] == 2
+    assert stats["failed_batches"] == 0
+    assert stats["buffered"] == 0
+
+
+def test_failed_batch_is_requeued_without_overwriting_newer_events():
+    writer = None
+
+    def newer_event_arrives():
+        # 写入期间同一事件有了更新的版本
+        writer.add(event("uid-0", last="2026-10-17T11:31:00Z", message="newer"))
+
+    ck = FakeClickHouse(fail_times=10, on_insert=newer_event_arrives)
+    writer = EventBatchWriter(ck.insert, max_retries=1, retry_backoff=0)
+    writer.add(event("uid-0", message="older"))
+    writer.add(event("uid-1"))
+    assert writer.flush() == 0
+    stats = writer.get_stats()
+    assert stats["failed_batches"] == 1
+    assert stats["buffered"] == 2
+
+    ck.fail_times = 0
+    ck.on_insert = None
+    assert writer.flush() == 2
+    written = ck.batches[0]
+    assert written["eventUid"] == ["uid-1", "uid-0"]
+    assert written["message"][written["eventUid"].index("uid-0")] == "newer"
+
+
+def test_buffer_bound_drops_oldest_events():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert, max_buffer=3)
+    for i in range(5):
+        writer.add(event(f"uid-{i}"))
+    stats = writer.get_stats()
+    assert stats["dropped"] == 2
+    assert stats["buffered"] == 3
+    writer.flush()
+    assert ck.uids() == ["uid-2", "uid-3", "uid-4"]
+
+
+def test_same_event_keeps_latest_version():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert)
+    writer.add(event("uid-0", last="2026-10-17T11:31:00Z", message="newer"))
+    writer.add(event("uid-0", last="2026-10-17T11:30:00Z", message="older"))
+    writer.flush()
+    assert ck.batches[0]["message"] == ["newer"]
+    assert writer.get_stats()["merged"] == 1
+
+
+def test_stop_drains_buffer():
+    ck = FakeClickHouse()
+    writer = EventBatchWriter(ck.insert, batch_size=100, flush_interval=60)
+    writer.start()
+    writer.add(event("uid-0"))
+    writer.add(event("uid-1"))
+    writer.stop()
+    assert ck.uids() == ["uid-0", "uid-1"]
+    assert writer.get_stats()["buffered"] == 0
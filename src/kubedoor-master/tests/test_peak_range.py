@@ -0,0 +1,142 @@
+"""PEAK_BACKEND=range 与 *_over_time 子查询的结果一致性，使用模拟Prometheus"""
+
+import asyncio
+import math
+import random
+import zlib
+from datetime import datetime
+
+import pytest
+from aiohttp import web
+
+import promql
+import utils
+from func_manager import peak_range, prom_client
+
+STEP = 15
+WORKLOADS = 300
+
+
+def sample(inner, i, t):
+    """内层表达式第i个序列在t时刻的值"""
+    seed = zlib.crc32(inner.encode())
+    if "count by" in inner:
+        return float(3 + (t // 600 + i) % 3)
+    if "limits" in inner or "requests" in inner:
+        return float(seed % 7 + i % 5 + 1)
+    rng = random.Random(seed * 1000003 + i * 7919 + int(t))
+    return rng.lognormvariate(0, 1) * (1 + math.sin(t / 900) / 2)
+
+
+def labels(i):
+    return {"k8s": "c1", "namespace": f"ns{i % 7}", "owner_name": f"rs{i}", "workload": f"d{i}"}
+
+
+def series_ids(inner):
+    # 部分序列只有pod_num没有其它指标
+    return [i for i in range(WORKLOADS) if i % 50 != 7 or "count by" in inner]
+
+
+async def instant_query(request):
+    """按PromQL语义计算 func_over_time(inner[d:]) * 系数: 取 (T-d, T] 内步长整数倍的点"""
+    end = float(request.query["time"])
+    func, q, inner, duration, scale = peak_range.parse_over_time(request.query["query"])
+    times = [k * STEP for k in range(int((end - duration) // STEP) + 1, int(end // STEP) + 1)]
+    result = []
+    for i in series_ids(inner):
+        values = sorted(sample(inner, i, t) for t in times)
+        if func == "quantile":
+            rank = q * (len(values) - 1)
+            lower = math.floor(rank)
+            upper = min(lower + 1, len(values) - 1)
+            value = values[lower] + (values[upper] - values[lower]) * (rank - lower)
+        else:
+            value = values[-1] if func == "max" else values[0]
+        result.append({"metric": labels(i), "value": [end, peak_range.format_value(value * scale)]})
+    return web.json_response({"status": "success", "data": {"resultType": "vector", "result": result}})
+
+
+async def range_query(request):
+    inner = request.query["query"]
+    start, end, step = float(request.query["start"]), float(request.query["end"]), int(request.query["step"])
+    times = [start + k * step for k in range(int((end - start) // step) + 1)]
+    result = [
+        {"metric": labels(i), "values": [[t, peak_range.format_value(sample(inner, i, t))] for t in times]}
+        for i in series_ids(inner)
+    ]
+    return web.json_response({"status": "success", "data": {"resultType": "matrix", "result": result}})
+
+
+@pytest.fixture
+def fake_prometheus(monkeypatch):
+    monkeypatch.setattr(utils, "PROM_K8S_TAG_KEY", "k8s")
+    requests = []
+
+    async def serve(test):
+        app = web.Application()
+
+        @web.middleware
+        async def record(request, handler):
+            requests.append(request.path)
+            return await handler(request)
+
+        app.middlewares.append(record)
+        app.router.add_get("/api/v1/query", instant_query)
+        app.router.add_get("/api/v1/query_range", range_query)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        monkeypatch.setattr(utils, "PROM_URL", f"http://{host}:{port}")
+        try:
+            return await test()
+        finally:
+            await prom_client.close()
+            await runner.cleanup()
+
+    return lambda test: asyncio.run(serve(test)), requests
+
+
+@pytest.mark.parametrize("name", ["pod_num", *utils.query_list])
+def test_peak_queries_are_parsed(name):
+    query = promql.query_dict[name].replace("{env}", 'k8s="c1",').replace("{env_key}", "k8s,").replace("{duration}", "1h30m")
+    func, q, inner, duration, scale = peak_range.parse_over_time(query)
+    assert func in ("quantile", "max", "min")
+    assert duration == 5400
+    assert inner and scale > 0
+
+
+def test_range_backend_matches_subqueries(monkeypatch, fake_prometheus):
+    run, requests = fake_prometheus
+    end = datetime(2026, 10, 17, 11, 30, 0)
+
+    async def collect(backend):
+        monkeypatch.setattr(utils, "PEAK_BACKEND", backend)
+        return (await utils.merged_dict("k8s", "c1", "1h30m", end, cache=False)).rows()
+
+    subquery_rows = run(lambda: collect("promql"))
+    assert set(requests) == {"/api/v1/query"}
+    requests.clear()
+    range_rows = run(lambda: collect("range"))
+    assert set(requests) == {"/api/v1/query_range"}
+    # 1.5小时高峰期按15分钟分段，每个指标6段
+    assert len(requests) == 6 * (len(utils.query_list) + 1)
+
+    assert len(subquery_rows) == len(range_rows) == WORKLOADS
+    for range_row, subquery_row in zip(range_rows, subquery_rows):
+        # 维度列和pod数完全一致，指标只有浮点运算顺序造成的误差
+        assert range_row[:5] == subquery_row[:5]
+        assert range_row[5:] == pytest.approx(subquery_row[5:], rel=1e-9)
+
+
+def test_streaming_quantile_switches_to_estimate(monkeypatch):
+    monkeypatch.setattr(peak_range, "PEAK_RANGE_EXACT_POINTS", 100)
+    rng = random.Random(0)
+    values = [rng.lognormvariate(0, 1) for _ in range(1440)]
+    estimator = peak_range.StreamingQuantile(0.8)
+    for value in values:
+        estimator.add(value)
+    assert estimator.sketch is not None
+    exact = peak_range.quantile(values, 0.8)
+    assert abs(estimator.value() - exact) / exact < 0.1
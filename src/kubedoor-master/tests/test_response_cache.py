@@ -0,0 +1,63 @@
+import asyncio
+
+import pytest
+
+from func_manager import response_cache
+
+
+@pytest.fixture(autouse=True)
+def empty_cache(monkeypatch):
+    monkeypatch.setattr(response_cache, "_cache", response_cache.OrderedDict())
+    monkeypatch.setattr(response_cache, "_generation", {})
+    monkeypatch.setattr(response_cache, "_refreshing", {})
+
+
+KEY = response_cache.make_key("c1", "GET", "/api/agent/services", {"namespace": "ns1"})
+RESPONSE = {"success": True, "data": ["svc"]}
+
+
+def test_put_skipped_when_invalidated_during_read():
+    generation = response_cache.generation(KEY)
+    # 读请求进行期间写请求清理了该接口的缓存
+    response_cache.invalidate("c1", "/api/agent/res/ops", {"namespace": "ns1"}, {})
+    response_cache.put(KEY, RESPONSE, generation)
+    assert response_cache.get(KEY) == (None, None)
+
+    response_cache.put(KEY, RESPONSE, response_cache.generation(KEY))
+    assert response_cache.get(KEY) == (RESPONSE, response_cache.FRESH)
+
+
+def test_other_env_and_namespaces_route_unaffected():
+    namespaces_key = response_cache.make_key("c1", "GET", "/api/agent/namespaces", {})
+    generations = response_cache.generation(KEY), response_cache.generation(namespaces_key)
+    response_cache.invalidate("c2", "/api/agent/res/ops", {}, {})
+    response_cache.invalidate("c1", "/api/agent/scale", {}, {})
+    response_cache.put(namespaces_key, RESPONSE, generations[1])
+    assert response_cache.get(namespaces_key)[0] == RESPONSE
+    response_cache.put(KEY, RESPONSE, generations[0])
+    assert response_cache.get(KEY) == (None, None)
+
+
+def test_refresh_drops_result_of_read_started_before_write():
+    skipped = response_cache.stats["skip_stale"]
+
+    async def main():
+        started = asyncio.Event()
+        release = asyncio.Event()
+
+        async def fetch():
+            generation = response_cache.generation(KEY)
+            started.set()
+            await release.wait()
+            return generation, RESPONSE
+
+        response_cache.refresh(KEY, fetch)
+        task = response_cache._refreshing[KEY]
+        await started.wait()
+        response_cache.invalidate("c1", "/api/agent/res/delete", {"namespace": "ns1"}, {})
+        release.set()
+        await task
+        assert response_cache.stats["skip_stale"] == skipped + 1
+
+    asyncio.run(main())
+    assert response_cache.get(KEY) == (None, None)
@@ -0,0 +1,177 @@
+import asyncio
+
+import pytest
+
+from func_manager import session_registry
+from func_manager.session_registry import MemorySessionRegistry, RedisSessionRegistry
+
+
+class FakeRedis:
+    """redis.asyncio客户端的替身，实现注册表用到的命令，过期时间使用可手动推进的时钟"""
+
+    def __init__(self):
+        self.now = 0.0
+        self.data = {}
+        self.closed = False
+
+    def _alive(self, key):
+        if isinstance(key, bytes):
+            key = key.decode()
+        item = self.data.get(key)
+        if item is None:
+            return None
+        value, expires = item
+        if expires is not None and self.now >= expires:
+            del self.data[key]
+            return None
+        return value
+
+    async def set(self, key, value, ex=None, nx=False):
+        if nx and self._alive(key) is not None:
+            return None
+        self.data[key] = (value.encode() if isinstance(value, str) else value, self.now + ex if ex else None)
+        return True
+
+    async def get(self, key):
+        return self._alive(key)
+
+    async def delete(self, key):
+        return 1 if self.data.pop(key, None) else 0
+
+    async def mget(self, keys):
+        return [self._alive(key) for key in keys]
+
+    async def scan_iter(self, match):
+        prefix = match.rstrip("*")
+        for key in list(self.data):
+            if key.startswith(prefix) and self._alive(key) is not None:
+                yield key.encode()
+
+    async def aclose(self):
+        self.closed = True
+
+
+@pytest.fixture
+def redis():
+    return FakeRedis()
+
+
+def as_replica(monkeypatch, replica):
+    monkeypatch.setattr(session_registry, "REPLICA_ID", replica)
+
+
+def run(coro):
+    return asyncio.run(coro)
+
+
+def test_register_conflicts_with_other_replica(monkeypatch, redis):
+    registry = RedisSessionRegistry(redis, ttl=15)
+    as_replica(monkeypatch, "master-a")
+    assert run(registry.register("c1", "v1", "conn-1"))
+    # 其它副本登记同一env失败，websocket_handler据此返回409
+    as_replica(monkeypatch, "master-b")
+    assert not run(registry.register("c1", "v1", "conn-2"))
+    assert run(registry.lookup("c1"))["replica"] == "master-a"
+    # 同一副本上agent重连时覆盖为新连接
+    as_replica(monkeypatch, "master-a")
+    assert run(registry.register("c1", "v1", "conn-3"))
+    assert run(registry.lookup("c1"))["conn"] == "conn-3"
+
+
+def test_refresh_extends_ttl_and_registration_expires(monkeypatch, redis):
+    registry = RedisSessionRegistry(redis, ttl=15)
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-1"))
+    redis.now += 10
+    run(registry.refresh("c1", "v1", "conn-1"))
+    redis.now += 10
+    assert run(registry.lookup("c1"))["conn"] == "conn-1"
+    # 副本停止续期后注册过期，其它副本可以接管
+    redis.now += 6
+    assert run(registry.lookup("c1")) is None
+    as_replica(monkeypatch, "master-b")
+    assert run(registry.register("c1", "v1", "conn-2"))
+
+
+def test_refresh_does_not_take_over_other_owner(monkeypatch, redis):
+    registry = RedisSessionRegistry(redis, ttl=15)
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-1"))
+    as_replica(monkeypatch, "master-b")
+    run(registry.refresh("c1", "v1", "conn-2"))
+    assert run(registry.lookup("c1"))["replica"] == "master-a"
+    # 过期后续期重新登记
+    redis.now += 16
+    run(registry.refresh("c1", "v1", "conn-2"))
+    assert run(registry.lookup("c1"))["replica"] == "master-b"
+
+
+def test_unregister_only_removes_own_connection(monkeypatch, redis):
+    registry = RedisSessionRegistry(redis, ttl=15)
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-1"))
+    as_replica(monkeypatch, "master-b")
+    run(registry.unregister("c1", "conn-1"))
+    assert run(registry.lookup("c1")) is not None
+
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-2"))
+    # 旧连接断开的清理不影响重连后的新连接
+    run(registry.unregister("c1", "conn-1"))
+    assert run(registry.lookup("c1"))["conn"] == "conn-2"
+    run(registry.unregister("c1", "conn-2"))
+    assert run(registry.lookup("c1")) is None
+
+
+def test_list_sessions(monkeypatch, redis):
+    registry = RedisSessionRegistry(redis, ttl=15)
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-1"))
+    redis.now += 10
+    run(registry.register("c2", "v2", "conn-2"))
+    assert set(run(registry.list_sessions())) == {"c1", "c2"}
+    redis.now += 6
+    assert set(run(registry.list_sessions())) == {"c2"}
+
+
+def test_memory_registry_matches_redis_ownership(monkeypatch):
+    registry = MemorySessionRegistry(ttl=15)
+    as_replica(monkeypatch, "master-a")
+    assert run(registry.register("c1", "v1", "conn-1"))
+    as_replica(monkeypatch, "master-b")
+    assert not run(registry.register("c1", "v1", "conn-2"))
+    as_replica(monkeypatch, "master-a")
+    run(registry.register("c1", "v1", "conn-2"))
+    run(registry.unregister("c1", "conn-1"))
+    assert run(registry.lookup("c1"))["conn"] == "conn-2"
+
+
+@pytest.mark.parametrize("make_registry", [lambda: RedisSessionRegistry(FakeRedis()), MemorySessionRegistry])
+def test_lock_is_mutually_exclusive(make_registry):
+    registry = make_registry()
+    events = []
+
+    async def hold(name):
+        async with registry.lock("k8s_resources:20261017"):
+            events.append(("enter", name))
+            await asyncio.sleep(0.02)
+            events.append(("exit", name))
+
+    async def main():
+        await asyncio.gather(hold("a"), hold("b"))
+
+    asyncio.run(main())
+    assert [kind for kind, _ in events] == ["enter", "exit", "enter", "exit"]
+
+
+def test_redis_lock_release_keeps_lock_taken_over_after_expiry(redis):
+    registry = RedisSessionRegistry(redis)
+
+    async def main():
+        async with registry.lock("day", ttl=5):
+            # 持有时间超过ttl，锁被其它副本取得
+            redis.now += 6
+            assert await redis.set("kubedoor:lock:day", "other", ex=5, nx=True)
+        assert await redis.get("kubedoor:lock:day") == b"other"
+
+    asyncio.run(main())
@@ -1,14 +1,18 @@
 import os
 import sys
+import asyncio
 import time
 import json
+import struct
 import requests
 from datetime import datetime
-from clickhouse_driver import Client
 from clickhouse_driver.errors import ServerException
-from functools import wraps
 from loguru import logger
 from promql import query_dict, node_rank_query
+from func_manager.ck_async import ClickHousePool
+from func_manager import prom_client
+from func_manager import peak_range
+from func_manager.peak_columns import PeakColumns
 
 
 logger.remove()
@@ -34,6 +38,8 @@ ALERT_DEDUP_WINDOW = int(os.environ.get('ALERT_DEDUP_WINDOW', '300'))
 PROM_TYPE = os.environ.get('PROM_TYPE')
 PROM_URL = os.environ.get('PROM_URL')
 UPDATE_IMAGE = os.environ.get('UPDATE_IMAGE')
+# 高峰期指标的计算方式: promql为*_over_time子查询，range为分段区间查询后在本地计算
+PEAK_BACKEND = os.environ.get('PEAK_BACKEND', 'promql')
 
 # Istio Route 数据库配置
 DB_HOST = os.environ.get('DB_HOST', 'localhost')
@@ -43,38 +49,15 @@ DB_PASSWORD = os.environ.get('DB_PASSWORD', '123456')
 DB_NAME = os.environ.get('DB_NAME', 'istio_route')
 
 
-ckclient = Client(
-    host=CK_HOST,
-    port=CK_PORT,
-    user=CK_USER,
-    password=CK_PASSWORD,
-    database=CK_DATABASE,
-)
-
-
-def retry_on_exception(retries=3, delay=1, backoff=2):
-    def decorator_retry(func):
-        @wraps(func)
-        def wrapper(*args, **kwargs):
-            attempt = 0
-            while attempt < retries:
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    attempt += 1
-                    logger.warning(f"尝试第 {attempt} 次遇到错误: {e}")
-                    if attempt < retries:
-                        time.sleep(delay * (backoff ** (attempt - 1)))
-            raise Exception("达到最大重试次数，无数据可用")
-
-        return wrapper
-
-    return decorator_retry
-
-
-@retry_on_exception()
-def execute_query(query):
-    return ckclient.execute(query)
+CK_CONNECTION = {
+    "host": CK_HOST,
+    "port": CK_PORT,
+    "user": CK_USER,
+    "password": CK_PASSWORD,
+    "database": CK_DATABASE,
+}
+# master所有ClickHouse查询共用的异步连接池
+ck = ClickHousePool(**CK_CONNECTION)
 
 
 query_list = [
@@ -108,21 +91,6 @@ def calculate_peak_duration_and_end_time(peak_hours):
     return duration_str, start_time_part, end_time_part
 
 
-def check_and_delete_day_data(date, env_value):
-    """检查是否有当天的数据，有则删除"""
-    query_sql = f"""select * from kubedoor.k8s_resources where date = '{date}' and env = '{env_value}'"""
-    delete_sql = f"""delete from kubedoor.k8s_resources where date = '{date}' and env = '{env_value}'"""
-    logger.info(f"query_sql==={query_sql}")
-    result = ckclient.execute(query_sql)
-    ckclient.disconnect()
-    if result:
-        logger.info(f"从表k8s_resources删除{env_value} {date}的数据")
-        logger.info(f"delete_sql==={delete_sql}")
-        ckclient.execute("SET allow_experimental_lightweight_delete = 1")
-        ckclient.execute(delete_sql)
-    return result
-
-
 def get_prom_url():
     """按类型选择查询指标的方式"""
     # url = f"{PROM_URL}/api/v1/query_range"
@@ -136,60 +104,45 @@ def get_prom_url():
     return url
 
 
-def fetch_prom_namespaces(env_value):
+def get_prom_range_url():
+    return f"{PROM_URL}/api/v1/query_range"
+
+
+async def fetch_prom_namespaces(env_value):
     # 使用 max_over_time 来获取最近一小时的数据
     # query = f'group by (namespace) (max_over_time(kube_namespace_created{{{PROM_K8S_TAG_KEY}="{env_value}"}}[1h]))'
     query = f'group by (namespace) (kube_namespace_created{{{PROM_K8S_TAG_KEY}="{env_value}"}})'
     try:
-        response = requests.get(get_prom_url(), params={'query': query})
-        response.raise_for_status()  # 检查请求是否成功
-        data = response.json()
-        namespaces = []
-        for result in data['data']['result']:
-            labels = result['metric']
-            namespaces.append(labels.get('namespace'))
-        return namespaces
-    except requests.exceptions.RequestException as e:
+        data = await prom_client.query(get_prom_url(), query, name="namespaces")
+        return [result['metric'].get('namespace') for result in data]
+    except prom_client.PromQueryError as e:
         raise Exception(f"Error fetching data from Prometheus: {e}")
 
 
-def fetch_prom_services(env_value, namespace):
+async def fetch_prom_services(env_value, namespace):
     """
     获取指定环境和命名空间的service列表
     """
     query = f'group by(service)(kube_service_info{{{PROM_K8S_TAG_KEY}="{env_value}",namespace="{namespace}"}})'
     try:
-        response = requests.get(get_prom_url(), params={'query': query})
-        response.raise_for_status()  # 检查请求是否成功
-        data = response.json()
-        services = []
-        for result in data['data']['result']:
-            labels = result['metric']
-            services.append(labels.get('service'))
-        return services
-    except requests.exceptions.RequestException as e:
+        data = await prom_client.query(get_prom_url(), query, name="services")
+        return [result['metric'].get('service') for result in data]
+    except prom_client.PromQueryError as e:
         raise Exception(f"Error fetching data from Prometheus: {e}")
 
 
-def fetch_prom_envs():
+async def fetch_prom_envs():
     # query = f'group by ({PROM_K8S_TAG_KEY}) (kube_state_metrics_build_info)'
     query = f'group by ({PROM_K8S_TAG_KEY}) (kube_node_info)'
     try:
-        response = requests.get(get_prom_url(), params={'query': query})
-        response.raise_for_status()  # 检查请求是否成功
-        data = response.json()
-        envs = []
-        for result in data['data']['result']:
-            labels = result['metric']
-            envs.append(labels.get(PROM_K8S_TAG_KEY))
-        return envs
-    except requests.exceptions.RequestException as e:
+        data = await prom_client.query(get_prom_url(), query, name="envs")
+        return [result['metric'].get(PROM_K8S_TAG_KEY) for result in data]
+    except prom_client.PromQueryError as e:
         raise Exception(f"Error fetching data from Prometheus: {e}")
 
 
-def get_prom_data(promql, env_key, env_value, end_time_full, duration, workload_dict={}):
-    """获取指标源数据"""
-    url = get_prom_url()
+async def get_prom_data(promql, env_value, end_time_full, duration, cache=True):
+    """获取一个指标在高峰期结束时间的源数据，cache为False时不使用查询缓存(强制重新采集)"""
     k8s_filter = f'{PROM_K8S_TAG_KEY}="{env_value}",'
     query = (
         query_dict.get(promql)
@@ -197,74 +150,32 @@ def get_prom_data(promql, env_key, env_value, end_time_full, duration, workload_
         .replace("{env_key}", f"{PROM_K8S_TAG_KEY},")
         .replace("{duration}", duration)
     )
-    querystring = {"query": query, "time": end_time_full.timestamp(), "step": "15"}
-    logger.info(querystring)
-    response = requests.request("GET", url, params=querystring).json()
-    print(json.dumps(response), flush=True)
-    if response.get("status") == "success":
-        result = response["data"]["result"]
-        if promql == "pod_num":
-            workload_dict = {}
-            for x in result:
-                k8s = x['metric'][PROM_K8S_TAG_KEY]
-                ns = x['metric'].get('namespace')
-                dpm = x['metric'].get('workload')
-                replicaset = x['metric'].get('owner_name')
-                endtime = datetime.fromtimestamp(int(x["value"][0]))
-                workload_dict[f'{k8s}@{ns}@{replicaset}'] = [endtime, k8s, ns, dpm, int(x['value'][1])]
-            logger.info(f'处理指标{promql}完成: 服务数{len(workload_dict)}')
-        else:
-            workload_metrics_dict = {}
-            for x in result:
-                k8s = x['metric'][PROM_K8S_TAG_KEY]
-                ns = x['metric'].get('namespace')
-                replicaset = x['metric'].get('owner_name')
-                workload_metrics_dict[f'{k8s}@{ns}@{replicaset}'] = float(x['value'][1])
-
-            for k in workload_dict.keys():
-                if k in workload_metrics_dict:
-                    workload_dict[k].append(workload_metrics_dict[k])
-                else:
-                    workload_dict[k].append(-1)
-            logger.info(f'处理指标{promql}完成: 服务数{len(workload_dict)}, 指标数{len(workload_metrics_dict)}')
-        return workload_dict
-    else:
-        logger.error('ERROR {} {}', promql, env_key)
-        return {}
-
-
-def merged_dict(env_key, env_value, duration_str, end_time_full):
-    """解析指标源数据，处理成列表"""
-    k8s_metrics_list = []
-    workload_dict = get_prom_data("pod_num", env_key, env_value, end_time_full, duration_str)
-
-    for promql in query_list:
-        workload_dict = get_prom_data(promql, env_key, env_value, end_time_full, duration_str, workload_dict)
-
-    for v in workload_dict.values():
-        logger.debug(v)
-        k8s_metrics_list.append(v + [-1, -1, -1])
-
-    return k8s_metrics_list
-
-
-def metrics_to_ck(k8s_metrics_list):
-    """将指标数据存入ck"""
-    batch_size = 10000
-    for i in range(0, len(k8s_metrics_list), batch_size):
-        begin = time.time()
-        batch_data = k8s_metrics_list[i : i + batch_size]
-        try:
-            ckclient.execute("INSERT INTO k8s_resources VALUES", batch_data)
-            logger.info(
-                f"🌊高峰期数据写入CK == count: 正在插入批次: {i//batch_size}",
-                "耗时：{:.2f}s".format(time.time() - begin),
-            )
-        except ServerException as e:
-            logger.exception("Failed to insert batch {}:// {}", i // batch_size, e)
+    logger.debug(query)
+    if PEAK_BACKEND == "range":
+        return await peak_range.query(get_prom_range_url(), query, end_time_full.timestamp(), name=f"{env_value} {promql}")
+    return await prom_client.query(
+        get_prom_url(), query, name=f"{env_value} {promql}", cache=cache, time=end_time_full.timestamp(), step="15"
+    )
 
-    ckclient.disconnect()
-    return True
+
+async def merged_dict(env_key, env_value, duration_str, end_time_full, cache=True):
+    """并发查询一天的所有指标，按 K8S@命名空间@ReplicaSet 合并为k8s_resources的列"""
+    names = ["pod_num", *query_list]
+    results = await asyncio.gather(
+        *(get_prom_data(promql, env_value, end_time_full, duration_str, cache) for promql in names),
+        return_exceptions=True,
+    )
+    for result in results:
+        if isinstance(result, BaseException):
+            # 任一指标缺失时不返回部分数据，避免覆盖当天已有的完整数据
+            raise result
+
+    data = PeakColumns(PROM_K8S_TAG_KEY, results[0])
+    logger.info(f'处理指标pod_num完成: 服务数{len(data)}')
+    for promql, result in zip(query_list, results[1:]):
+        matched = data.join(result)
+        logger.info(f'处理指标{promql}完成: 服务数{len(data)}, 指标数{len(result)}, 匹配{matched}')
+    return data
 
 
 def merge_dicts(dict1, dict2):
@@ -277,10 +188,9 @@ def merge_dicts(dict1, dict2):
     return merged_dict
 
 
-def get_node_deployments(node, env_value):
+async def get_node_deployments(node, env_value):
     logger.info(f"开始查询节点 {node} 上的所有deployment (env: {env_value})")
     deployment_list = []
-    url = get_prom_url()
     k8s_filter = f'{PROM_K8S_TAG_KEY}="{env_value}",'
     query = (
         query_dict.get('deployments_by_node')
@@ -288,72 +198,67 @@ def get_node_deployments(node, env_value):
         .replace("{namespace}", namespace_str_exclude)
         .replace("{node}", node)
     )
-    querystring = {"query": query, "step": "15"}
-    logger.info(f"查询参数: {querystring}")
-    response = requests.request("GET", url, params=querystring).json()
-    print(json.dumps(response), flush=True)
-    if response.get("status") == "success":
-        result = response["data"]["result"]
-        logger.info(f"在节点 {node} 上找到 {len(result)} 个deployment")
-        for x in result:
-            ns = x['metric'].get('namespace', x['metric'].get('k8s_ns')) or x['metric'].get(
-                'namespace', x['metric'].get('destination_workload_namespace')
-            )
-            deployment_list.append(
-                {
-                    "namespace": ns,
-                    "pod": x['metric'].get('pod'),
-                    "created_by_name": x['metric'].get('created_by_name'),
-                }
-            )
-        logger.info(f"节点 {node} 上的deployment列表: {json.dumps(deployment_list)}")
-        return deployment_list
-    else:
-        logger.error(f'查询节点 {node} 上的deployment列表失败')
+    try:
+        result = await prom_client.query(get_prom_url(), query, name=f"{env_value} deployments_by_node", step="15")
+    except prom_client.PromQueryError as e:
+        logger.error(f'查询节点 {node} 上的deployment列表失败: {e}')
+        return None
+    logger.info(f"在节点 {node} 上找到 {len(result)} 个deployment")
+    for x in result:
+        ns = x['metric'].get('namespace', x['metric'].get('k8s_ns')) or x['metric'].get(
+            'namespace', x['metric'].get('destination_workload_namespace')
+        )
+        deployment_list.append(
+            {
+                "namespace": ns,
+                "pod": x['metric'].get('pod'),
+                "created_by_name": x['metric'].get('created_by_name'),
+            }
+        )
+    logger.info(f"节点 {node} 上的deployment列表: {json.dumps(deployment_list)}")
+    return deployment_list
 
 
-def ck_optimize(table_name):
-    result = ckclient.execute(f'OPTIMIZE TABLE {table_name}')
+async def ck_optimize(table_name):
+    result = await ck.execute(f'OPTIMIZE TABLE {table_name}')
     return True
 
 
-def ck_alter(sql):
-    result = ckclient.execute(sql)
+async def ck_alter(sql):
+    result = await ck.execute(sql)
     return True
 
 
-def ck_agent_collect_info():
+async def ck_agent_collect_info():
     """从ck中读取agent的信息"""
-    result = ckclient.execute('SELECT env, peak_hours FROM k8s_agent_status WHERE collect = 1')
+    result = await ck.execute('SELECT env, peak_hours FROM k8s_agent_status WHERE collect = 1')
     formatted_result = [list(row) for row in result]
     return formatted_result
 
 
-def ck_init_agent_status(env):
-    result = ckclient.execute(f"SELECT 1 FROM k8s_agent_status where env = '{env}'")
+async def ck_init_agent_status(env):
+    result = await ck.execute("SELECT 1 FROM k8s_agent_status where env = %(env)s", {"env": env})
     if not result:
-        ckclient.execute(f"INSERT INTO k8s_agent_status (env) VALUES ('{env}')")
+        await ck.execute("INSERT INTO k8s_agent_status (env) VALUES", [(env,)])
     return True
 
 
-def ck_get_k8s_names():
+async def ck_get_k8s_names():
     """从ck中获取所有K8S环境名称，按顺序排序"""
     try:
-        result = ckclient.execute("SELECT env FROM k8s_agent_status ORDER BY env")
+        result = await ck.execute("SELECT env FROM k8s_agent_status ORDER BY env")
         k8s_names = [row[0] for row in result]
         return k8s_names
     except ServerException as e:
         logger.exception(e)
         return []
-    finally:
-        ckclient.disconnect()
 
 
-def ck_agent_info():
+async def ck_agent_info():
     """从ck中读取agent的信息"""
     agent_info = {}
     try:
-        rows = ckclient.execute(
+        rows = await ck.execute(
             "SELECT env, collect, peak_hours, admission, admission_namespace, nms_not_confirm, scheduler FROM k8s_agent_status"
         )
         if rows:
@@ -370,45 +275,119 @@ def ck_agent_info():
 
     except ServerException as e:
         logger.exception(e)
-    ckclient.disconnect()
     return agent_info
 
 
-def get_deploy_admis(env, namespace, deployment):
-    """从ck中读取agent的信息"""
+# 批量查询时每条SQL最多包含的服务数
+CONTROL_BATCH_SIZE = 1000
+
+
+def _in_values(values):
+    """
+    IN 右侧的参数，clickhouse_driver把元组渲染为 (a, b, ...)；
+    只有一个元素时 (x) 会被当作单个值，重复一次保证仍是集合
+    """
+    values = tuple(values)
+    return values * 2 if len(values) == 1 else values
+
+
+async def get_control_data_batch(keys, columns, pool=None):
+    """
+    一次查询多个服务的管控数据
+
+    Args:
+        keys: [(env, namespace, deployment), ...]
+        columns: 需要的k8s_res_control字段
+        pool: 为空时使用全局连接池
+
+    Returns:
+        {(env, namespace, deployment): (字段值, ...)}，管控表中没有的服务不在结果中
+    """
+    pool = pool or ck
+    keys = list(dict.fromkeys(keys))
+    result = {}
+    for i in range(0, len(keys), CONTROL_BATCH_SIZE):
+        rows = await pool.execute(
+            f"SELECT env, namespace, deployment, {', '.join(columns)} FROM kubedoor.k8s_res_control FINAL "
+            "WHERE (env, namespace, deployment) IN %(keys)s",
+            {"keys": _in_values(keys[i : i + CONTROL_BATCH_SIZE])},
+        )
+        for row in rows:
+            result[tuple(row[:3])] = tuple(row[3:])
+    return result
+
+
+async def get_deploy_admis(env, namespace, deployment, pool=None):
+    """从ck中读取agent的信息，pool为空时使用全局连接池"""
+    key = (env, namespace, deployment)
+    return (await get_deploy_admis_batch([key], pool))[key]
+
+
+async def get_deploy_admis_batch(keys, pool=None):
+    """
+    批量查询准入结果，不论服务数量只查询两次数据库
+
+    Args:
+        keys: [(env, namespace, deployment), ...]
+
+    Returns:
+        {(env, namespace, deployment): 准入结果}
+    """
+    pool = pool or ck
+    keys = list(dict.fromkeys(keys))
     try:
-        result = ckclient.execute(
-            f"""SELECT scheduler,nms_not_confirm FROM k8s_agent_status where env = '{env}' and admission = 1 and admission_namespace like '%"{namespace}"%'"""
+        rows = await pool.execute(
+            "SELECT env, scheduler, nms_not_confirm, admission_namespace FROM k8s_agent_status "
+            "WHERE env IN %(envs)s AND admission = 1",
+            {"envs": _in_values({env for env, _, _ in keys})},
         )
-        if result:
-            query = (
-                f"SELECT pod_count, pod_count_ai, pod_count_manual, request_cpu_m, request_mem_mb, limit_cpu_m, limit_mem_mb "
-                f"FROM k8s_res_control "
-                f"WHERE env='{env}' AND namespace='{namespace}' "
-                f"AND deployment='{deployment}'"
-            )
-            deploy_res = ckclient.execute(query)
-            if deploy_res:
-                deploy_res_list = list(deploy_res[0])
-                deploy_res_list.append(result[0][0])  # scheduler
-                logger.info(f"🔊master(admis)返回:【{env}】【{namespace}】【{deployment}】{deploy_res_list}")
-                return deploy_res_list
-            else:
-                nms_not_confirm = result[0][1]
-                if nms_not_confirm:
-                    content = f'master(admis)返回: 新服务免确认已启用【{env}】【{namespace}】【{deployment}】允许部署/扩缩容,因为k8s_res_control表中找不到该服务,该服务不会被管控，也不会配置固定节点均衡模式（未开启则忽略）。'
-                    logger.warning(content)
-                    return [200, content]
-                else:
-                    content = f"master(admis)返回:【{env}】【{namespace}】【{deployment}】部署失败: k8s_res_control表中找不到该服务，且未开启新服务免确认，请先新增服务。"
-                    logger.warning(content)
-                    return [404, content]
-        else:
-            return [200, '非管控命名空间，直接放行']
+        agents = {}
+        for env, scheduler, nms_not_confirm, admission_namespace in rows:
+            agents.setdefault(env, []).append((scheduler, nms_not_confirm, admission_namespace))
+        # 与原来的 admission_namespace like '%"namespace"%' 条件一致
+        status = {}
+        for env, namespace, deployment in keys:
+            matched = [agent for agent in agents.get(env, []) if f'"{namespace}"' in agent[2]]
+            if matched:
+                status[(env, namespace, deployment)] = matched[0]
+        deploy_res = await get_control_data_batch(
+            list(status),
+            [
+                "pod_count",
+                "pod_count_ai",
+                "pod_count_manual",
+                "request_cpu_m",
+                "request_mem_mb",
+                "limit_cpu_m",
+                "limit_mem_mb",
+            ],
+            pool,
+        ) if status else {}
     except ServerException as e:
-        content = f"master(admis)返回:【{env}】【{namespace}】【{deployment}】查询数据库失败：{e}"
-        logger.error(content)
-        return [503, '查询数据库异常']
+        logger.error(f"master(admis)批量查询{len(keys)}个服务失败：{e}")
+        for env, namespace, deployment in keys:
+            logger.error(f"master(admis)返回:【{env}】【{namespace}】【{deployment}】查询数据库失败：{e}")
+        return {key: [503, '查询数据库异常'] for key in keys}
+
+    results = {}
+    for key in keys:
+        env, namespace, deployment = key
+        if key not in status:
+            results[key] = [200, '非管控命名空间，直接放行']
+        elif key in deploy_res:
+            deploy_res_list = list(deploy_res[key])
+            deploy_res_list.append(status[key][0])  # scheduler
+            logger.info(f"🔊master(admis)返回:【{env}】【{namespace}】【{deployment}】{deploy_res_list}")
+            results[key] = deploy_res_list
+        elif status[key][1]:  # nms_not_confirm
+            content = f'master(admis)返回: 新服务免确认已启用【{env}】【{namespace}】【{deployment}】允许部署/扩缩容,因为k8s_res_control表中找不到该服务,该服务不会被管控，也不会配置固定节点均衡模式（未开启则忽略）。'
+            logger.warning(content)
+            results[key] = [200, content]
+        else:
+            content = f"master(admis)返回:【{env}】【{namespace}】【{deployment}】部署失败: k8s_res_control表中找不到该服务，且未开启新服务免确认，请先新增服务。"
+            logger.warning(content)
+            results[key] = [404, content]
+    return results
 
 
 def send_msg(content, msgToken=None):
@@ -490,9 +469,9 @@ def slack(webhook, content, at=""):
     return response.json()
 
 
-def get_list_from_resources(env_value):
+async def get_list_from_resources(env_value):
     """获取资源表信息，取最近10天cpu数据最高的一天的数据"""
-    query = f"""
+    query = """
         select
             `date`,
             env,
@@ -511,24 +490,23 @@ def get_list_from_resources(env_value):
         where date = (
             SELECT `date`
             FROM kubedoor.k8s_resources
-            WHERE `date` >= toDate(today() - 10) and env = '{env_value}'
+            WHERE `date` >= toDate(today() - 10) and env = %(env)s
             GROUP BY `date`
             order by SUM(pod_count * p95_pod_load) desc
             limit 1
-        ) and env = '{env_value}'
+        ) and env = %(env)s
     """
-    result = ckclient.execute(query)
-    ckclient.disconnect()
+    result = await ck.execute(query, {"env": env_value})
     logger.info("提取最近10天cpu最高的一天的数据：")
     for i in result:
         logger.debug(i)
     return result
 
 
-def is_init_or_update(env_value):
+async def is_init_or_update(env_value):
     """判断管控表是初始化还是更新"""
-    query = f"""select * from kubedoor.k8s_res_control where env = '{env_value}'"""
-    result = ckclient.execute(query)
+    query = "select 1 from kubedoor.k8s_res_control where env = %(env)s limit 1"
+    result = await ck.execute(query, {"env": env_value})
     if not result:  # 初始化
         return True
     else:  # 更新
@@ -567,7 +545,7 @@ def parse_insert_data(srv):
     return tmp
 
 
-def init_control_data(metrics_list_ck):
+async def init_control_data(metrics_list_ck):
     '''初始化管控表'''
     metrics_list = list()
     for srv in metrics_list_ck:
@@ -579,7 +557,7 @@ def init_control_data(metrics_list_ck):
         begin = time.time()
         batch_data = metrics_list[i : i + batch_size]
         try:
-            ckclient.execute("INSERT INTO k8s_res_control VALUES", batch_data, types_check=True)
+            await ck.execute("INSERT INTO k8s_res_control VALUES", batch_data, types_check=True)
             logger.info(
                 f"== count: 正在插入批次: {i//batch_size}",
                 "耗时：{:.2f}s".format(time.time() - begin),
@@ -587,71 +565,147 @@ def init_control_data(metrics_list_ck):
         except ServerException as e:
             logger.exception("Failed to insert batch {}: {}", i // batch_size, e)
             return False
-
-    ckclient.disconnect()
     return True
 
 
-def update_control_data(metrics_list_ck):
-    """更新管控表"""
-    for i in metrics_list_ck:
-        (
-            date,
-            env,
-            namespace,
-            deployment,
-            pod_count,
-            p95_pod_cpu_pct,
-            p95_pod_wss_pct,
-            request_pod_cpu_m,
-            request_pod_mem_mb,
-            limit_pod_cpu_m,
-            limit_pod_mem_mb,
-            p95_pod_load,
-            p95_pod_wss_mb,
-        ) = i
-        date_str = date.strftime('%Y-%m-%d %H:%M:%S')
-        sql = f"select 1 from kubedoor.k8s_res_control where env = '{env}' and namespace = '{namespace}' and deployment = '{deployment}'"
-        data = ckclient.execute(sql)
-        if data:  # 更新
-            request_cpu_m = p95_pod_load * 1000
-            try:
-                update_sql = f"""
-                    alter table kubedoor.k8s_res_control
-                    update
-                        `update` = '{date_str}',
-                        pod_count = {pod_count},
-                        p95_pod_cpu_pct = {p95_pod_cpu_pct},
-                        p95_pod_mem_pct = {p95_pod_wss_pct},
-                        request_cpu_m = {int(request_cpu_m)},
-                        request_mem_mb = {int(p95_pod_wss_mb)}
-                    where
-                        env = '{env}' and namespace = '{namespace}' and deployment = '{deployment}'
-                """
-                update_data = ckclient.execute(update_sql)
-            except Exception as e:
-                logger.exception("Failed to execute {}: {}", update_sql, e)
-                ckclient.disconnect()
-                return False
-        else:  # 添加
-            content = (
-                f"采集高峰期数据更新到管控表时，检测到新服务【{env}】【{namespace}】【{deployment}】,将新增到管控表。"
-            )
-            logger.info(content)
-            send_msg(content)
-            tmp = ""
-            try:
-                tmp = parse_insert_data(i)
-                ckclient.execute("INSERT INTO k8s_res_control VALUES", [tuple(tmp)], types_check=True)
-            except Exception as e:
-                logger.exception("Failed to insert {}: {}", [tuple(tmp)], e)
-                ckclient.disconnect()
-                return False
-    ckclient.disconnect()
+def control_data_changes(current, metrics):
+    """
+    高峰期数据转换为管控表需要更新的字段，值与current(管控表当前行)相同时返回空字典
+    """
+    (
+        date,
+        env,
+        namespace,
+        deployment,
+        pod_count,
+        p95_pod_cpu_pct,
+        p95_pod_wss_pct,
+        request_pod_cpu_m,
+        request_pod_mem_mb,
+        limit_pod_cpu_m,
+        limit_pod_mem_mb,
+        p95_pod_load,
+        p95_pod_wss_mb,
+    ) = metrics
+    values = {
+        "update": date,
+        "pod_count": pod_count,
+        "p95_pod_cpu_pct": p95_pod_cpu_pct,
+        "p95_pod_mem_pct": p95_pod_wss_pct,
+        "request_cpu_m": int(p95_pod_load * 1000),
+        "request_mem_mb": int(p95_pod_wss_mb),
+    }
+    # 百分比字段在管控表中为Float32，按Float32精度比较，避免精度差异导致每行都被认为有变化
+    changes = {
+        field: value
+        for field, value in values.items()
+        if field != "update" and _comparable(field, current[field]) != _comparable(field, value)
+    }
+    if changes or _naive(current["update"]) != _naive(date):
+        changes["update"] = date
+    return changes
+
+
+# 管控表中由高峰期数据计算的Float32字段
+_FLOAT32_FIELDS = {"p95_pod_cpu_pct", "p95_pod_mem_pct"}
+
+
+def _comparable(field, value):
+    if field in _FLOAT32_FIELDS and value is not None:
+        return struct.unpack("f", struct.pack("f", value))[0]
+    return value
+
+
+def _naive(value):
+    return value.replace(tzinfo=None) if value else value
+
+
+async def update_control_data(metrics_list_ck):
+    """
+    更新管控表
+
+    一次查询读取相关env的管控数据，在内存中对比后，只为有变化的服务和新服务插入新版本的行
+    (k8s_res_control为ReplacingMergeTree，新版本替换旧版本)，查询次数与服务数量无关。
+    对比期间页面可能修改了手动pod数、limit等字段，写入前重新读取有变化的服务的最新版本，
+    只替换高峰期数据计算的字段，其它字段保持最新值
+    """
+    if not metrics_list_ck:
+        return True
+    envs = sorted({row[1] for row in metrics_list_ck})
+    try:
+        rows, column_types = await ck.execute(
+            "SELECT * FROM kubedoor.k8s_res_control FINAL WHERE env IN %(envs)s",
+            {"envs": _in_values(envs)},
+            with_column_types=True,
+        )
+    except Exception as e:
+        logger.exception("读取管控表失败: {}", e)
+        return False
+    columns = [name for name, _ in column_types]
+    existing = {}
+    for row in rows:
+        current = dict(zip(columns, row))
+        existing[(current["env"], current["namespace"], current["deployment"])] = current
+
+    # { key: 需要更新的字段 }
+    updates = {}
+    new_services = {}
+    unchanged = 0
+    for metrics in metrics_list_ck:
+        key = (metrics[1], metrics[2], metrics[3])
+        current = existing.get(key)
+        if current is None:  # 添加
+            new_services[key] = metrics
+            continue
+        changes = control_data_changes(current, metrics)
+        if not changes:
+            unchanged += 1
+            continue
+        updates[key] = changes
+    logger.info(
+        f"管控表对比完成: 更新 {len(updates)} 个服务，新增 {len(new_services)} 个服务，{unchanged} 个服务无变化"
+    )
+
+    try:
+        # 写入前重新读取最新版本，合并期间页面的修改
+        latest = await get_control_data_batch([*updates, *new_services], columns)
+    except Exception as e:
+        logger.exception("读取管控表失败: {}", e)
+        return False
+    insert_rows = []
+    for key, changes in updates.items():
+        current = dict(zip(columns, latest[key])) if key in latest else existing[key]
+        current.update(changes)
+        insert_rows.append(tuple(current[column] for column in columns))
+    for key, metrics in list(new_services.items()):
+        if key in latest:
+            # 对比期间已被添加，按更新处理
+            current = dict(zip(columns, latest[key]))
+            current.update(control_data_changes(current, metrics))
+            insert_rows.append(tuple(current[column] for column in columns))
+            del new_services[key]
+        else:
+            insert_rows.append(tuple(parse_insert_data(metrics)))
+
+    if new_services:
+        names = "、".join(f"【{env}】【{namespace}】【{deployment}】" for env, namespace, deployment in list(new_services)[:20])
+        more = f"等{len(new_services)}个服务" if len(new_services) > 20 else ""
+        content = f"采集高峰期数据更新到管控表时，检测到新服务{names}{more},将新增到管控表。"
+        logger.info(content)
+        send_msg(content)
+
+    # parse_insert_data和SELECT *的结果都按表的字段顺序排列
+    batch_size = 10000
+    try:
+        for i in range(0, len(insert_rows), batch_size):
+            await ck.execute("INSERT INTO k8s_res_control VALUES", insert_rows[i : i + batch_size], types_check=True)
+    except Exception as e:
+        logger.exception("Failed to insert control data: {}", e)
+        return False
     return True
 
 
-def get_deployment_from_control_data(deployment_list, num, type, env):
+async def get_deployment_from_control_data(deployment_list, num, type, env):
     """根据指定指标获取排名靠前的deployment"""
     logger.info(f"开始获取 {env} 环境中排名靠前的deployment，类型: {type}，数量限制: {num}")
     top_deployments = []
@@ -659,42 +713,33 @@ def get_deployment_from_control_data(deployment_list, num, type, env):
     # 构造排序字段
     order_field = "request_cpu_m" if type == "cpu" else "request_mem_mb"
 
-    # 为每个deployment查询资源控制数据
-    for index, deployment in enumerate(deployment_list):
-        namespace = deployment.get('namespace')
+    # 从pod名称提取deployment_name，去掉最后两个由-分隔的部分
+    keys = []
+    for deployment in deployment_list:
         pod = deployment.get('pod')
-        # 从pod名称提取deployment_name，去掉最后两个由-分隔的部分
-        deployment_name = pod.rsplit('-', 2)[0] if pod else ""
-        logger.info(
-            f"[{index+1}/{len(deployment_list)}] 查询deployment: {namespace}/{deployment_name}，原始Pod名称: {pod}"
-        )
+        keys.append((env, deployment.get('namespace'), pod.rsplit('-', 2)[0] if pod else ""))
 
-        # 构建查询语句
-        query = f"""
-            SELECT deployment, namespace, request_cpu_m, request_mem_mb 
-            FROM kubedoor.k8s_res_control 
-            WHERE env = '{env}' AND deployment = '{deployment_name}' AND namespace = '{namespace}'
-        """
-
-        try:
-            # 执行查询
-            result = ckclient.execute(query)
-            if result and len(result) > 0:
-                # 结果转为字典
-                deployment_data = {
-                    'deployment': result[0][0],  # deployment
-                    'namespace': result[0][1],  # namespace
-                    'request_cpu_m': result[0][2],  # CPU
-                    'request_mem_mb': result[0][3],  # 内存
+    # 一次查询所有deployment的资源控制数据
+    try:
+        control_data = await get_control_data_batch(keys, ["request_cpu_m", "request_mem_mb"])
+    except Exception as e:
+        logger.error(f"批量查询 {len(keys)} 个deployment资源数据失败: {e}")
+        control_data = {}
+    for key in keys:
+        _, namespace, deployment_name = key
+        if key in control_data:
+            request_cpu_m, request_mem_mb = control_data[key]
+            top_deployments.append(
+                {
+                    'deployment': deployment_name,
+                    'namespace': namespace,
+                    'request_cpu_m': request_cpu_m,
+                    'request_mem_mb': request_mem_mb,
                 }
-                logger.info(
-                    f"查询成功: {namespace}/{deployment_name}, CPU: {deployment_data['request_cpu_m']}m, 内存: {deployment_data['request_mem_mb']}MB"
-                )
-                top_deployments.append(deployment_data)
-            else:
-                logger.warning(f"未找到 {namespace}/{deployment_name} 的资源管控数据")
-        except Exception as e:
-            logger.error(f"查询 deployment {deployment_name} 资源数据失败: {e}")
+            )
+            logger.info(f"查询成功: {namespace}/{deployment_name}, CPU: {request_cpu_m}m, 内存: {request_mem_mb}MB")
+        else:
+            logger.warning(f"未找到 {namespace}/{deployment_name} 的资源管控数据")
 
     logger.info(f"查询完成，共找到 {len(top_deployments)} 个deployment的资源管控数据")
 
@@ -724,9 +769,7 @@ async def get_deployment_node(promql, k8s, namespace, deployment):
         .replace("{deployment}", deployment)
     )
     logger.info(f"查询节点信息，query: {query}")
-    response = requests.get(get_prom_url(), params={'query': query})
-    response.raise_for_status()
-    data = response.json().get("data").get("result")
+    data = await prom_client.query(get_prom_url(), query, name=f"{k8s} {namespace}/{deployment} 节点")
 
     # 处理Prometheus响应数据，返回节点IP和对应值的字典
     node_dict = {}
@@ -749,9 +792,7 @@ async def get_deployment_image(promql, k8s, namespace, deployment):
         .replace("{deployment}", deployment)
     )
     logger.info(f"查询镜像信息，query: {query}")
-    response = requests.get(get_prom_url(), params={'query': query})
-    response.raise_for_status()
-    data = response.json().get("data").get("result")
+    data = await prom_client.query(get_prom_url(), query, name=f"{k8s} {namespace}/{deployment} 镜像")
 
     # 过滤有效数据
     valid_data = [i for i in data if i.get('metric', {}).get('image_spec', i.get('metric', {}).get('image', False))]
@@ -771,10 +812,7 @@ async def get_node_res_rank(env_value, res_type):
     try:
         logger.info(f'查询节点{res_type}排名，环境: {env_value}')
         logger.info(query)
-        response = requests.get(get_prom_url(), params={'query': query})
-        logger.info(get_prom_url())
-        response.raise_for_status()
-        data = response.json().get("data").get("result")
+        data = await prom_client.query(get_prom_url(), query, name=f"{env_value} node_rank_{res_type}")
         res_list = [
             {
                 'name': i.get('metric').get('instance', i.get('metric').get('node')),
@@ -787,5 +825,5 @@ async def get_node_res_rank(env_value, res_type):
         res_list.sort(key=lambda x: x['percent'])
         logger.info(f'节点{res_type}从小到大排序{res_list}')
         return res_list
-    except requests.exceptions.RequestException as e:
+    except prom_client.PromQueryError as e:
         raise Exception(f"Error getting node cpu usage percent from Prometheus: {e}")